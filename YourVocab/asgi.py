@@ -0,0 +1,18 @@
+"""
+ASGI config for YourVocab project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+The Procfile serves the WSGI one; to serve this instead, use for example
+``gunicorn YourVocab.asgi -k uvicorn.workers.UvicornWorker``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'YourVocab.settings')
+
+application = get_asgi_application()
@@ -4,13 +4,14 @@ Django settings for YourVocab project.
 Generated by 'django-admin startproject' using Django 2.2.6.
 
 For more information on this file, see
-https://docs.djangoproject.com/en/2.2/topics/settings/
+https://docs.djangoproject.com/en/4.2/topics/settings/
 
 For the full list of settings and their values, see
-https://docs.djangoproject.com/en/2.2/ref/settings/
+https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 import os
+
 import dj_database_url
 
 DEBUG = False
@@ -20,7 +21,7 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 # Quick-start development settings - unsuitable for production
-# See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
+# See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = '2+w((=crbui%u5+-ira@_&%sr%(2j-nm&a$skbjds5bu)1*-dx'
@@ -38,6 +39,34 @@ if not DEBUG:
 else:
     EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# Run queued jobs (email) right after the request instead of in the run_jobs worker
+YOURVOCAB_JOBS_INLINE = os.environ.get('YOURVOCAB_JOBS_INLINE', '1' if DEBUG else '') == '1'
+
+# Deleted lessons can be restored for this long, then they are purged by the worker
+YOURVOCAB_LESSON_UNDO_SECONDS = int(os.environ.get('YOURVOCAB_LESSON_UNDO_SECONDS', 24 * 60 * 60))
+
+# Finished runs are kept one by one for this many days; compact_attempts rolls older ones
+# into 'day' or 'week' summaries, archiving them to gzipped JSON Lines when a directory is set
+YOURVOCAB_ATTEMPTS_RAW_DAYS = int(os.environ.get('YOURVOCAB_ATTEMPTS_RAW_DAYS', 180))
+YOURVOCAB_ATTEMPTS_SUMMARY = os.environ.get('YOURVOCAB_ATTEMPTS_SUMMARY', 'day')
+YOURVOCAB_ATTEMPTS_ARCHIVE_DIR = os.environ.get('YOURVOCAB_ATTEMPTS_ARCHIVE_DIR', '')
+
+# Collect per-question mistakes in the quiz run and write them once per lesson run
+YOURVOCAB_BUFFER_MISTAKES = os.environ.get('YOURVOCAB_BUFFER_MISTAKES', '') == '1'
+
+# Let the lesson page grade answers itself and submit them in batches
+YOURVOCAB_BATCH_ANSWERS = True
+
+# Threads per process for the database work of the async views (see yourvocab.pool), which
+# is also the most database connections they hold. 0 runs it in the thread of the request.
+YOURVOCAB_DB_THREADS = int(os.environ.get('YOURVOCAB_DB_THREADS', 8))
+
+# Requests slower or chattier than this are logged with their slowest SQL
+YOURVOCAB_SLOW_REQUEST_MS = int(os.environ.get('YOURVOCAB_SLOW_REQUEST_MS', 500))
+YOURVOCAB_SLOW_REQUEST_QUERIES = int(os.environ.get('YOURVOCAB_SLOW_REQUEST_QUERIES', 50))
+# Bearer token required to read /metrics, open when empty
+YOURVOCAB_METRICS_TOKEN = os.environ.get('YOURVOCAB_METRICS_TOKEN', '')
+
 APPEND_SLASH = True
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
@@ -55,6 +84,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'yourvocab.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -62,6 +92,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'yourvocab.routing.StickyPrimaryMiddleware',
 ]
 
 ROOT_URLCONF = 'YourVocab.urls'
@@ -87,12 +118,43 @@ WSGI_APPLICATION = 'YourVocab.wsgi.application'
 
 
 # Database
-# https://docs.djangoproject.com/en/2.2/ref/settings/#databases
+# https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
 DATABASES = {'default': dj_database_url.config(engine='django.db.backends.postgresql_psycopg2')}
 
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+# Reads of the views marked with yourvocab.routing.replica_reads go here, when configured.
+# Locally, two SQLite files will do: REPLICA_DATABASE_URL=sqlite:////tmp/replica.sqlite3
+YOURVOCAB_REPLICA = 'replica'
+if os.environ.get('REPLICA_DATABASE_URL'):
+    DATABASES[YOURVOCAB_REPLICA] = dj_database_url.config('REPLICA_DATABASE_URL')
+    DATABASES[YOURVOCAB_REPLICA]['TEST'] = {'MIRROR': 'default'}
+
+DATABASE_ROUTERS = ['yourvocab.routing.ReplicaRouter']
+
+# How long a user reads from the primary after a write of theirs
+YOURVOCAB_STICKY_SECONDS = int(os.environ.get('YOURVOCAB_STICKY_SECONDS', 10))
+
+# Cache
+# Every process has to see the same cache without DEBUG (see yourvocab.checks): the database
+# cache by default (python manage.py createcachetable), or Redis/Memcached through
+# YOURVOCAB_CACHE_BACKEND/YOURVOCAB_CACHE_LOCATION
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('YOURVOCAB_CACHE_BACKEND',
+                                  'django.core.cache.backends.locmem.LocMemCache' if DEBUG
+                                  else 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.environ.get('YOURVOCAB_CACHE_LOCATION', '' if DEBUG else 'yourvocab_cache'),
+    }
+}
+
+# Cache alias used for the course pages and lesson payloads
+YOURVOCAB_CACHE = 'default'
+
 # Password validation
-# https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
+# https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -111,7 +173,7 @@ AUTH_PASSWORD_VALIDATORS = [
 
 
 # Internationalization
-# https://docs.djangoproject.com/en/2.2/topics/i18n/
+# https://docs.djangoproject.com/en/4.2/topics/i18n/
 
 LANGUAGE_CODE = 'en-us'
 
@@ -119,17 +181,22 @@ TIME_ZONE = 'UTC'
 
 USE_I18N = True
 
-USE_L10N = True
-
 USE_TZ = True
 
 
 # Static files (CSS, JavaScript, Images)
-# https://docs.djangoproject.com/en/2.2/howto/static-files/
+# https://docs.djangoproject.com/en/4.2/howto/static-files/
 
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'yourvocab/templates/yourvocab/../yourvocab/static')
 
+# Pages only link the hashed bundles (see yourvocab.assets), the unhashed copies are not needed
+WHITENOISE_KEEP_ONLY_HASHED_FILES = True
+
 if not DEBUG:
     import django_heroku
     django_heroku.settings(locals())
+    # The async-capable subclass, so that requests under ASGI are not all moved to threads
+    MIDDLEWARE = [
+        'yourvocab.middleware.StaticFilesMiddleware' if name == 'whitenoise.middleware.WhiteNoiseMiddleware' else name
+        for name in MIDDLEWARE]
@@ -0,0 +1,20 @@
+"""
+Settings for the replica routing tests, with two SQLite aliases:
+python manage.py test --settings=YourVocab.test_replica_settings yourvocab.tests.ReplicaRoutingTests
+"""
+
+from YourVocab.test_settings import *  # noqa: F401,F403
+
+# Files rather than memory, so that both aliases open the same test database
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'primary.sqlite3'),
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_primary.sqlite3')},
+    },
+    YOURVOCAB_REPLICA: {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'replica.sqlite3'),
+        'TEST': {'MIRROR': 'default'},
+    },
+}
@@ -0,0 +1,16 @@
+"""
+Settings for the test suite: python manage.py test --settings=YourVocab.test_settings
+"""
+
+from YourVocab.settings import *  # noqa: F401,F403
+
+# The query budgets count every query of a request, which the database cache would add to
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+# The tests run in a single process
+SILENCED_SYSTEM_CHECKS = ['yourvocab.E001']
+# The tests render pages without collectstatic having built the manifest
+STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
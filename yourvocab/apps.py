@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class YourvocabConfig(AppConfig):
     name = 'yourvocab'
+
+    def ready(self):
+        # Connects the cache invalidation and catalog signals, registers the purge job handler
+        # and the shared cache check
+        from yourvocab import caching, catalog, checks, purging  # noqa: F401
+        from django.db.backends.signals import connection_created
+        from yourvocab.middleware import install_recorder
+
+        connection_created.connect(install_recorder)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Query budgets of the views.
+
+Every view states with @budget how many SQL queries a request to it may run and how much
+session data it may write. The budgets do not depend on the amount of data: the tests in
+yourvocab/tests.py request every URL against a small and a large dataset and fail on any
+request over budget, which is how per-row queries show up. PerformanceMiddleware logs the
+requests over budget in production.
+"""
+import re
+from collections import Counter, namedtuple
+
+Budget = namedtuple('Budget', 'queries session_bytes')
+
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'(?<![\w."])-?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b')
+SAVEPOINT = re.compile(r'"s\d+_x\d+"')
+VALUES = re.compile(r'\((?:\s*(?:\?|%s|NULL)\s*,)+\s*(?:\?|%s|NULL)\s*\)')
+
+
+def budget(queries, session_bytes=0):
+    """Declare the budget of a view: at most `queries` SQL queries and `session_bytes` of session data written."""
+    def declare(view):
+        view.budget = Budget(queries, session_bytes)
+        return view
+    return declare
+
+
+def view_budget(view):
+    return getattr(view, 'budget', None)
+
+
+def normalize(sql):
+    """The statement of a query without its literal values, lists of them collapsed."""
+    sql = NUMBER.sub('?', STRING.sub('?', SAVEPOINT.sub('"?"', sql)))
+    return VALUES.sub('(...)', sql)
+
+
+def report(queries):
+    """Diff-friendly listing of queries: one normalized statement per line, in order of first
+    appearance, with the number of times it ran."""
+    counts = Counter(normalize(sql) for sql in queries)
+    return '\n'.join(F'{count:>4} x {statement}' for statement, count in counts.items())
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Cached read models of the course list and the course pages.
+
+Both listings are paginated by id (pass the last id of a page to get the next one) and
+every page is cached on its own. Entries are per user and live under generation
+counters: moving a counter on drops every page at once. Counters are moved by the model
+signals below and, for the bulk statements that bypass signals, by explicit calls to
+`course_changed`.
+"""
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count, FilteredRelation, Q
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from yourvocab import models
+
+TIMEOUT = 60 * 60
+PAGE_SIZE = 50
+
+PROGRESS_FIELDS = ('attempts_count', 'best_points', 'last_points', 'last_date_time', 'mistakes_total')
+
+
+def get_cache():
+    return caches[settings.YOURVOCAB_CACHE]
+
+
+def course_list_generation_key(user_id):
+    return F'yourvocab:courses-generation:{user_id}'
+
+
+def course_list_key(user_id, generation, after):
+    return F'yourvocab:courses:{user_id}:{generation}:{after}'
+
+
+def course_generation_key(course_id):
+    return F'yourvocab:course-generation:{course_id}'
+
+
+def course_user_generation_key(user_id, course_id):
+    return F'yourvocab:course-generation:{course_id}:{user_id}'
+
+
+def course_detail_key(user_id, course_id, generations, after):
+    return F'yourvocab:course:{course_id}:{":".join(map(str, generations))}:{user_id}:{after}'
+
+
+def generations(cache, *keys):
+    """Current values of the generation counters under `keys`, starting the missing ones."""
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            found[key] = 1
+            cache.add(key, 1, None)
+    return [found[key] for key in keys]
+
+
+def bump(*keys):
+    cache = get_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Nothing cached under the counter yet
+            pass
+
+
+def paginate(rows, after):
+    """The first PAGE_SIZE rows of a queryset ordered by id, after the id `after`; returns (rows, next cursor)."""
+    if after:
+        rows = rows.filter(id__gt=after)
+    rows = list(rows[:PAGE_SIZE + 1])
+    if len(rows) > PAGE_SIZE:
+        return rows[:PAGE_SIZE], rows[PAGE_SIZE - 1]['id']
+    return rows, None
+
+
+def split_progress(row):
+    """Move the progress__* values of a row into row['progress'], None when there is no attempt yet."""
+    progress = {field: row.pop(F'progress__{field}') for field in PROGRESS_FIELDS if F'progress__{field}' in row}
+    row['progress'] = progress if progress.get('attempts_count') else None
+    return row
+
+
+def course_list(user, after=None):
+    """{'courses', 'next'}: a page of the user's courses with their lesson counts and the user's progress."""
+    cache = get_cache()
+    generation, = generations(cache, course_list_generation_key(user.id))
+    key = course_list_key(user.id, generation, after)
+    page = cache.get(key)
+    if page is None:
+        rows = (models.Course.objects
+                .filter(coursestudent__student=user)
+                .annotate(lessons_count=Count('lesson', filter=Q(lesson__deleted_at=None)),
+                          progress=FilteredRelation('courseprogress', condition=Q(courseprogress__student=user)))
+                .order_by('id')
+                .values('id', 'name', 'lessons_count', 'progress__attempts_count', 'progress__last_date_time',
+                        'progress__mistakes_total'))
+        courses, next_cursor = paginate(rows, after)
+        page = {'courses': [split_progress(course) for course in courses], 'next': next_cursor}
+        cache.set(key, page, TIMEOUT)
+    return page
+
+
+def course_detail(user, course_id, after=None):
+    """{'course', 'setup', 'lessons', 'next'} of a course page.
+
+    Lessons carry their question counts and the user's progress, read in the same query.
+    """
+    cache = get_cache()
+    key = course_detail_key(user.id, course_id,
+                            generations(cache, course_generation_key(course_id),
+                                        course_user_generation_key(user.id, course_id)),
+                            after)
+    detail = cache.get(key)
+    if detail is not None:
+        return detail
+
+    setup = models.CourseStudent.objects.select_related('course').get(course_id=course_id, student=user)
+    rows = (models.Lesson.objects
+            .filter(course_id=course_id)
+            .annotate(questions_count=Count('question'),
+                      progress=FilteredRelation('lessonprogress', condition=Q(lessonprogress__student=user)))
+            .order_by('id')
+            .values('id', 'name', 'questions_count', *[F'progress__{field}' for field in PROGRESS_FIELDS]))
+    lessons, next_cursor = paginate(rows, after)
+
+    course = setup.course
+    detail = {
+        'course': {'id': course.id, 'name': course.name, 'public': course.public,
+                   'helper_symbols': course.helper_symbols, 'author_id': course.author_id,
+                   'lessons_count': models.Lesson.objects.filter(course_id=course_id).count()},
+        'setup': {'answer_bonus': setup.answer_bonus, 'mistake_penalty': setup.mistake_penalty,
+                  'show_answer_penalty': setup.show_answer_penalty},
+        'lessons': [split_progress(lesson) for lesson in lessons],
+        'next': next_cursor,
+    }
+    cache.set(key, detail, TIMEOUT)
+    return detail
+
+
+def course_changed(course_id):
+    """Drop the course pages of every user by moving the course to a new generation."""
+    bump(course_generation_key(course_id))
+
+
+def user_course_changed(user_id, course_id):
+    bump(course_list_generation_key(user_id), course_user_generation_key(user_id, course_id))
+
+
+def course_students_changed(course_id):
+    """Drop the course lists of everybody enrolled in the course, e.g. when its lesson count changes."""
+    students = models.CourseStudent.objects.filter(course_id=course_id).values_list('student_id', flat=True)
+    bump(*[course_list_generation_key(student_id) for student_id in students])
+
+
+@lru_cache(maxsize=4096)
+def lesson_course_id(lesson_id):
+    # Lessons never move between courses, so the answer can be kept for good
+    return models.Lesson.all_objects.filter(pk=lesson_id).values_list('course_id', flat=True).first()
+
+
+@receiver(post_save, sender=models.Course)
+def course_saved(sender, instance, **kwargs):
+    course_changed(instance.id)
+    course_students_changed(instance.id)
+
+
+@receiver(pre_delete, sender=models.Course)
+def course_deleted(sender, instance, **kwargs):
+    # CourseStudent rows are gone by post_delete, so the students are collected beforehand
+    students = list(models.CourseStudent.objects.filter(course=instance).values_list('student_id', flat=True))
+    course_id = instance.id
+    transaction.on_commit(lambda: bump(*[course_list_generation_key(student_id) for student_id in students]))
+    transaction.on_commit(lambda: course_changed(course_id))
+
+
+@receiver(post_save, sender=models.CourseStudent)
+@receiver(post_delete, sender=models.CourseStudent)
+def course_student_changed(sender, instance, **kwargs):
+    user_course_changed(instance.student_id, instance.course_id)
+
+
+@receiver(post_save, sender=models.Lesson)
+@receiver(post_delete, sender=models.Lesson)
+def lesson_changed(sender, instance, created=True, **kwargs):
+    course_changed(instance.course_id)
+    if created:
+        # Lessons are counted on the course lists; renames do not show there
+        course_students_changed(instance.course_id)
+
+
+@receiver(post_save, sender=models.Question)
+@receiver(post_delete, sender=models.Question)
+def question_changed(sender, instance, **kwargs):
+    course_id = lesson_course_id(instance.lesson_id)
+    if course_id is not None:
+        course_changed(course_id)
+
+
+@receiver(post_save, sender=models.LessonStudent)
+@receiver(post_delete, sender=models.LessonStudent)
+def lesson_student_changed(sender, instance, **kwargs):
+    # The progress rollup is updated next to the attempt, so wait for the transaction to finish
+    course_id = lesson_course_id(instance.lesson_id)
+    if course_id is not None:
+        student_id = instance.student_id
+        transaction.on_commit(lambda: user_course_changed(student_id, course_id))
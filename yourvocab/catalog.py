@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Search over the public courses.
+
+Every public course has its words (course and lesson names, questions and answers) in
+CatalogTerm, an inverted index that works the same on PostgreSQL and SQLite. A search
+looks every query word up as an indexed prefix (LIKE 'word%', which PostgreSQL serves
+from the varchar_pattern_ops index Django creates for the term column) and pages through
+the matching courses by id, so deep pages cost as much as the first one. Words shorter
+than MIN_PREFIX_LENGTH only match whole terms, as their prefixes would match too much.
+"""
+import re
+import unicodedata
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Q, Value, When
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from yourvocab import models
+
+PAGE_SIZE = 20
+MIN_TERM_LENGTH = 2
+MIN_PREFIX_LENGTH = 3
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 5
+BATCH_SIZE = 1000
+
+WORD = re.compile(r'\w+')
+# Course-level term of every public course, even one whose name has no terms; no query matches it
+LISTED = ''
+
+
+def normalize(text):
+    """Case-folded text without diacritics."""
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def terms(text):
+    return {word[:MAX_TERM_LENGTH] for word in WORD.findall(normalize(text)) if len(word) >= MIN_TERM_LENGTH}
+
+
+def course_terms(course):
+    return terms(course.name) | {LISTED}
+
+
+def line_terms(question_text, answer_text):
+    return terms(question_text) | terms(answer_text)
+
+
+def write_terms(course_id, lesson_id, counts):
+    """Insert the terms of {term: count}."""
+    models.CatalogTerm.objects.bulk_create(
+        [models.CatalogTerm(term=term, course_id=course_id, lesson_id=lesson_id, count=count)
+         for term, count in counts.items()],
+        batch_size=BATCH_SIZE)
+
+
+def index_lesson(lesson, public=None):
+    """Replace the index entries of a lesson; lessons of private courses are just dropped."""
+    if public is None:
+        public = models.Course.objects.filter(pk=lesson.course_id, public=True).exists()
+    with transaction.atomic():
+        models.CatalogTerm.objects.filter(lesson=lesson).delete()
+        if not public:
+            return
+        counts = Counter(terms(lesson.name))
+        for question_text, answer_text in (models.Question.objects
+                                           .filter(lesson=lesson)
+                                           .values_list('question_text', 'answer_text')
+                                           .iterator()):
+            counts.update(line_terms(question_text, answer_text))
+        write_terms(lesson.course_id, lesson.id, counts)
+
+
+def index_changes(lesson, changes):
+    """Update the index entries of a lesson for an edit (see editing.LessonChanges).
+
+    Only the terms of the questions created, updated and deleted, and of a renamed lesson
+    name, are counted; a term goes when no question or name holds it any more.
+    """
+    if not models.Course.objects.filter(pk=lesson.course_id, public=True).exists():
+        return
+    delta = Counter()
+    for question_text, answer_text in changes.replaced:
+        delta.subtract(line_terms(question_text, answer_text))
+    for q in changes.created + changes.updated:
+        delta.update(line_terms(q.question_text, q.answer_text))
+    if changes.renamed_from is not None:
+        delta.subtract(terms(changes.renamed_from))
+        delta.update(terms(lesson.name))
+    delta = {term: count for term, count in delta.items() if count}
+    if not delta:
+        return
+
+    with transaction.atomic():
+        rows = models.CatalogTerm.objects.filter(lesson=lesson, term__in=list(delta))
+        indexed = set(rows.values_list('term', flat=True))
+        if indexed:
+            rows.update(count=F('count') + Case(*[When(term=term, then=Value(delta[term])) for term in indexed],
+                                                default=Value(0), output_field=IntegerField()))
+            rows.filter(count__lte=0).delete()
+        write_terms(lesson.course_id, lesson.id,
+                    {term: count for term, count in delta.items() if term not in indexed and count > 0})
+
+
+def index_course_name(course):
+    with transaction.atomic():
+        models.CatalogTerm.objects.filter(course=course, lesson=None).delete()
+        if course.public:
+            write_terms(course.id, None, dict.fromkeys(course_terms(course), 1))
+
+
+def index_course(course):
+    with transaction.atomic():
+        models.CatalogTerm.objects.filter(course=course).delete()
+        if course.public:
+            write_terms(course.id, None, dict.fromkeys(course_terms(course), 1))
+            for lesson in models.Lesson.objects.filter(course=course):
+                index_lesson(lesson, public=True)
+
+
+def search(query, after=None, limit=PAGE_SIZE):
+    """One page of public courses matching all words of `query`, newest first.
+
+    Returns (courses, cursor of the next page or None).
+    """
+    courses = models.Course.objects.filter(public=True)
+    for word in sorted(terms(query), key=len, reverse=True)[:MAX_QUERY_TERMS]:
+        if len(word) >= MIN_PREFIX_LENGTH:
+            matching = models.CatalogTerm.objects.filter(term__startswith=word)
+        else:
+            matching = models.CatalogTerm.objects.filter(term=word)
+        courses = courses.filter(pk__in=matching.values('course_id'))
+    if after:
+        courses = courses.filter(pk__lt=after)
+
+    page = list(courses
+                .order_by('-pk')
+                .select_related('author')
+                .annotate(lessons_count=Count('lesson', filter=Q(lesson__deleted_at=None)))[:limit + 1])
+    if len(page) > limit:
+        return page[:limit], page[limit - 1].pk
+    return page, None
+
+
+@receiver(post_save, sender=models.Course)
+def course_saved(sender, instance, update_fields=None, **kwargs):
+    """Reindex what changed of the course: everything when it went public or private, else its name."""
+    if update_fields is not None and not {'name', 'public'} & set(update_fields):
+        return
+    if not instance.public:
+        if models.CatalogTerm.objects.filter(course=instance).exists():
+            index_course(instance)
+        return
+    indexed = set(models.CatalogTerm.objects.filter(course=instance, lesson=None).values_list('term', flat=True))
+    if not indexed:
+        # Just made public, or indexed before LISTED was
+        index_course(instance)
+    elif indexed != course_terms(instance):
+        index_course_name(instance)
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Backends whose entries live in the memory of a single process
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',)
+
+
+@register(Tags.caches)
+def shared_cache_check(app_configs, **kwargs):
+    """Without DEBUG, YOURVOCAB_CACHE has to be shared by every process.
+
+    The generation counters of yourvocab.caching are moved by the process that saved the
+    data; the other web processes and the run_jobs worker would keep serving stale pages.
+    """
+    backend = settings.CACHES[settings.YOURVOCAB_CACHE]['BACKEND']
+    if settings.DEBUG or backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error(F'The {settings.YOURVOCAB_CACHE!r} cache is local to each process.',
+                  hint='Point YOURVOCAB_CACHE_BACKEND and YOURVOCAB_CACHE_LOCATION at Redis, Memcached '
+                       'or the database cache.',
+                  id='yourvocab.E001')]
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict, deque, namedtuple
+
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Max, Q, When
+
+from yourvocab import caching, matching, models, quiz
+
+
+class PatchRejected(Exception):
+    """The patch does not apply; `conflict` is set when it was made against another lesson version."""
+
+    def __init__(self, message, conflict=False):
+        super().__init__(message)
+        self.conflict = conflict
+
+
+# `delete` lines from line `start` are replaced by `lines`, a list of (question, answer)
+Hunk = namedtuple('Hunk', 'start delete lines')
+
+
+class LessonChanges:
+    """Row-level difference between the stored questions of a lesson and its new lines."""
+
+    def __init__(self):
+        self.created = []
+        self.updated = []
+        self.deleted = []
+        self.kept = []
+        # (question, answer) of the updated and deleted rows before the change, and the
+        # lesson name before a rename, for yourvocab.catalog.index_changes
+        self.replaced = []
+        self.renamed_from = None
+
+    def __bool__(self):
+        return bool(self.created or self.updated or self.deleted)
+
+    def extend(self, other):
+        self.created += other.created
+        self.updated += other.updated
+        self.deleted += other.deleted
+        self.kept += other.kept
+        self.replaced += other.replaced
+
+
+def diff_questions(existing, lines, options, start=0):
+    """Match stored questions against new (question, answer) lines.
+
+    `existing` must be ordered by position. Lines are matched first by their exact
+    (question, answer) pair, so unchanged questions keep their rows wherever they moved,
+    and then by position, so an edited line keeps the row (and the statistics) it had.
+    Whatever is left over is inserted or deleted. Answer keys are (re)computed with the
+    course matching `options`. The lines get positions from `start` on.
+    """
+    changes = LessonChanges()
+
+    by_text = defaultdict(deque)
+    for q in existing:
+        by_text[(q.question_text, q.answer_text)].append(q)
+
+    matched = [None] * len(lines)
+    used = set()
+    for i, key in enumerate(lines):
+        bucket = by_text.get(key)
+        if bucket:
+            matched[i] = bucket.popleft()
+            used.add(matched[i].id)
+
+    for i, (question_text, answer_text) in enumerate(lines):
+        q = matched[i]
+        if q is None and i < len(existing) and existing[i].id not in used:
+            q = existing[i]
+            used.add(q.id)
+
+        answer_key = matching.answer_key(options, answer_text)
+        position = start + i
+        if q is None:
+            changes.created.append(models.Question(question_text=question_text,
+                                                   answer_text=answer_text,
+                                                   answer_key=answer_key,
+                                                   position=position))
+        elif (q.question_text, q.answer_text, q.answer_key, q.position) != (question_text, answer_text, answer_key,
+                                                                             position):
+            changes.replaced.append((q.question_text, q.answer_text))
+            q.question_text, q.answer_text, q.answer_key, q.position = question_text, answer_text, answer_key, position
+            changes.updated.append(q)
+        else:
+            changes.kept.append(q)
+
+    changes.deleted = [q.id for q in existing if q.id not in used]
+    changes.replaced += [(q.question_text, q.answer_text) for q in existing if q.id not in used]
+    return changes
+
+
+def create_questions(lesson, questions, options=None):
+    """Insert new questions of a lesson in a bulk statement.
+
+    Questions are shared by the author and every subscriber of the course, so no progress
+    rows are made here; they appear on the first mistake or review of each student.
+    """
+    options = options or matching.Options.for_course(lesson.course)
+    for q in questions:
+        q.lesson = lesson
+        if not q.answer_key:
+            q.answer_key = matching.answer_key(options, q.answer_text)
+    models.Question.objects.bulk_create(questions)
+
+
+def apply_changes(lesson, changes, options):
+    """Write the changes of a lesson with bulk statements; call inside a transaction.
+
+    Any change bumps the lesson version, which retires the cached quiz payload.
+    """
+    if changes.deleted:
+        models.QuestionStudent.objects.filter(question_id__in=changes.deleted).delete()
+        # Dependent rows are gone already, no need for the cascade collector to walk them again
+        deleted = models.Question.objects.filter(id__in=changes.deleted)
+        deleted._raw_delete(deleted.db)
+
+    if changes.updated:
+        models.Question.objects.bulk_update(changes.updated, ['question_text', 'answer_text', 'answer_key', 'position'])
+
+    if changes.created:
+        create_questions(lesson, changes.created, options)
+
+    if changes:
+        models.Lesson.objects.filter(pk=lesson.pk).update(version=F('version') + 1)
+        transaction.on_commit(lambda version=lesson.version: quiz.invalidate_payload(lesson.pk, version))
+        # Bulk statements do not send model signals
+        transaction.on_commit(lambda: caching.course_changed(lesson.course_id))
+        lesson.version += 1
+
+
+def save_questions(lesson, lines):
+    """Bring the questions of a saved lesson in line with `lines` in a single transaction.
+
+    The number of queries does not depend on the lesson length, nor on the number of
+    subscribers: everything is applied with bulk statements to the shared rows.
+    """
+    with transaction.atomic():
+        existing = list(models.Question.objects.filter(lesson=lesson).order_by('position', 'id'))
+        options = matching.Options.for_course(lesson.course)
+        changes = diff_questions(existing, lines, options)
+        apply_changes(lesson, changes, options)
+
+    return changes
+
+
+def lock_version(lesson, version):
+    """Lock the lesson row for the rest of the transaction, making sure it is still at `version`.
+
+    Raises PatchRejected as a conflict otherwise. The name is refreshed from the row.
+    """
+    current, name = (models.Lesson.objects
+                     .select_for_update()
+                     .filter(pk=lesson.pk)
+                     .values_list('version', 'name')
+                     .get())
+    if current != version:
+        raise PatchRejected('The lesson has been changed since it was opened', conflict=True)
+    lesson.version, lesson.name = current, name
+
+
+def rename_lesson(lesson, name):
+    """Returns the former name when the lesson is renamed."""
+    if name is not None and name != lesson.name:
+        models.Lesson.objects.filter(pk=lesson.pk).update(name=name)
+        former, lesson.name = lesson.name, name
+        transaction.on_commit(lambda: caching.course_changed(lesson.course_id))
+        return former
+    return None
+
+
+def save_lesson(lesson, version, name, lines):
+    """Save an existing lesson posted whole with LessonForm, as edited from `version`.
+
+    Like patch_lesson, refuses to overwrite changes made since `version`, and writes only
+    the name and the questions, not the rest of a lesson instance that may be stale.
+    """
+    with transaction.atomic():
+        lock_version(lesson, version)
+        renamed_from = rename_lesson(lesson, name)
+        changes = save_questions(lesson, lines)
+        changes.renamed_from = renamed_from
+        return changes
+
+
+def parse_hunks(data):
+    """Hunks of a patch, [{"start", "delete", "questions", "answers"}, ...] in line order.
+
+    Lines are checked the way LessonForm checks a whole lesson. Malformed input raises
+    KeyError or TypeError, lines that do not pass raise PatchRejected.
+    """
+    hunks = []
+    end = 0
+    for item in data:
+        start, delete = item['start'], item['delete']
+        if not all(type(n) is int and n >= 0 for n in (start, delete)):
+            raise TypeError('Line numbers should be non-negative integers')
+        if start < end:
+            raise PatchRejected('Changes should be in line order and should not overlap')
+
+        questions, answers = list(item['questions']), list(item['answers'])
+        if len(questions) != len(answers):
+            raise PatchRejected('Questions should have as many lines as answers')
+        lines = []
+        for question_text, answer_text in zip(questions, answers):
+            if not isinstance(question_text, str) or not isinstance(answer_text, str):
+                raise TypeError('Lines should be strings')
+            if '\n' in question_text or '\n' in answer_text:
+                raise PatchRejected('A line should not span several lines')
+            if not question_text.strip() or not answer_text.strip():
+                raise PatchRejected('Empty lines are not permitted')
+            lines.append((question_text.strip(), answer_text.strip()))
+
+        hunks.append(Hunk(start, delete, lines))
+        end = start + delete
+    return hunks
+
+
+def patch_lesson(lesson, version, hunks, name=None):
+    """Apply hunks to the questions of a lesson, reading and writing only the rows they cover.
+
+    Line numbers are those of the lesson `version` the editor started from; a patch made
+    against another version raises PatchRejected as a conflict. The rows between and after
+    hunks that change the number of lines are moved along in a single UPDATE.
+    """
+    with transaction.atomic():
+        lock_version(lesson, version)
+
+        rows = models.Question.objects.filter(lesson=lesson).aggregate(count=Count('id'),
+                                                                       last=Max('position'),
+                                                                       positions=Count('position', distinct=True))
+        count = rows['count']
+        if count and (rows['last'] != count - 1 or rows['positions'] != count):
+            number_questions(list(models.Question.objects
+                                  .filter(lesson=lesson)
+                                  .order_by('position', 'id')
+                                  .only('id', 'position')))
+
+        if hunks and hunks[-1].start + hunks[-1].delete > count:
+            raise PatchRejected('The changes go past the end of the lesson')
+
+        window = Q(pk__in=[])
+        for hunk in hunks:
+            if hunk.delete:
+                window |= Q(position__gte=hunk.start, position__lt=hunk.start + hunk.delete)
+        existing = defaultdict(list)
+        for q in models.Question.objects.filter(window, lesson=lesson).order_by('position', 'id'):
+            existing[q.position].append(q)
+
+        options = matching.Options.for_course(lesson.course)
+        changes = LessonChanges()
+        shifts = []
+        shift = 0
+        for hunk in hunks:
+            stored = [q for position in range(hunk.start, hunk.start + hunk.delete) for q in existing[position]]
+            if len(stored) != hunk.delete:
+                raise PatchRejected('The lesson lines are out of order, reload the lesson')
+            changes.extend(diff_questions(stored, hunk.lines, options, start=hunk.start + shift))
+            shift += len(hunk.lines) - hunk.delete
+            shifts.append((hunk.start + hunk.delete, shift))
+
+        # Move the rows outside the hunks first, the hunk rows are then written by id
+        if any(shift for (_, shift) in shifts):
+            moves = [When(position__gte=start, then=F('position') + shift) for (start, shift) in reversed(shifts)]
+            (models.Question.objects
+             .filter(lesson=lesson, position__gte=shifts[0][0])
+             .exclude(window)
+             .update(position=Case(*moves, default=F('position'), output_field=IntegerField())))
+
+        apply_changes(lesson, changes, options)
+        changes.renamed_from = rename_lesson(lesson, name)
+
+    return changes
+
+
+def number_questions(questions):
+    """Give questions ordered by (position, id) the positions 0..n-1 patches count lines by.
+
+    Rows saved before positions existed all have position 0; patch_lesson numbers them
+    once, in their current order, so the line numbers of the editor and the quiz order do
+    not change. Saving a lesson whole numbers its rows anyway.
+    """
+    stale = []
+    for i, q in enumerate(questions):
+        if q.position != i:
+            q.position = i
+            stale.append(q)
+    if stale:
+        models.Question.objects.bulk_update(stale, ['position'], batch_size=1000)
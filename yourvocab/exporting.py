@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import csv
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from yourvocab import models
+
+# Rows are read from server-side cursors in chunks of this size
+CHUNK_SIZE = 2000
+# and sent to the client in pieces of this many rows
+ROWS_PER_PIECE = 500
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def tables(courses, student=None):
+    """Yield (table name, field names, row iterator) for everything in `courses`.
+
+    Progress rows are limited to `student` when given. Rows are streamed, never loaded
+    into memory at once.
+    """
+    lesson_filter = {'course__in': courses, 'deleted_at__isnull': True}
+    question_filter = {'lesson__course__in': courses, 'lesson__deleted_at': None}
+    student_filter = {'student': student} if student else {}
+
+    exported = [
+        ('course', ('id', 'name', 'public', 'helper_symbols', 'ignore_case', 'ignore_diacritics', 'split_alternatives',
+                    'max_typos', 'author__username'),
+         models.Course.objects.filter(pk__in=courses)),
+        ('lesson', ('id', 'course_id', 'name', 'attendance_count'),
+         models.Lesson.objects.filter(**lesson_filter)),
+        ('question', ('id', 'lesson_id', 'position', 'question_text', 'answer_text'),
+         models.Question.objects.filter(**question_filter)),
+        ('question_progress', ('question_id', 'student__username', 'mistakes_count', 'ease', 'interval',
+                               'repetitions', 'due'),
+         models.QuestionStudent.objects.filter(question__in=models.Question.objects.filter(**question_filter),
+                                               **student_filter)),
+        ('attempt', ('lesson_id', 'student__username', 'date_time', 'elapsed_time', 'points', 'mistakes_count'),
+         models.LessonStudent.objects.filter(lesson__in=models.Lesson.objects.filter(**lesson_filter),
+                                             **student_filter)),
+        ('attempt_summary', ('lesson_id', 'student__username', 'granularity', 'period', 'count', 'points_total',
+                             'points_min', 'points_max', 'elapsed_time_total', 'mistakes_total', 'last_date_time',
+                             'last_points'),
+         models.LessonAttemptSummary.objects.filter(lesson__in=models.Lesson.objects.filter(**lesson_filter),
+                                                    **student_filter)),
+    ]
+
+    for name, fields, queryset in exported:
+        rows = queryset.order_by('pk').values_list(*fields).iterator(chunk_size=CHUNK_SIZE)
+        yield name, fields, rows
+
+
+def user_courses(user):
+    return models.Course.objects.filter(coursestudent__student=user)
+
+
+def in_pieces(lines):
+    piece = []
+    for line in lines:
+        piece.append(line)
+        if len(piece) >= ROWS_PER_PIECE:
+            yield ''.join(piece)
+            piece = []
+    if piece:
+        yield ''.join(piece)
+
+
+class Echo:
+    """File-like object that hands back whatever csv.writer writes to it."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(exported):
+    """Every table becomes a section opening with a '#<table>' header row."""
+    writer = csv.writer(Echo())
+    for name, fields, rows in exported:
+        yield writer.writerow(('#' + name,) + fields)
+        for row in rows:
+            yield writer.writerow(('',) + row)
+
+
+def jsonl_lines(exported):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    for name, fields, rows in exported:
+        for row in rows:
+            record = dict(zip(fields, row))
+            record['type'] = name
+            yield encoder.encode(record) + '\n'
+
+
+def render(exported, output_format):
+    lines = csv_lines(exported) if output_format == 'csv' else jsonl_lines(exported)
+    return in_pieces(lines)
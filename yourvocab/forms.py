@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 from django import forms
-from django.contrib.auth.forms import UserCreationForm
+from django.contrib.auth.forms import PasswordResetForm, UserCreationForm
 from django.contrib.auth.models import User
+from django.template import loader
 
-from yourvocab import models
+from yourvocab import jobs, matching, models
 
 
 class SignUpForm(UserCreationForm):
@@ -14,23 +15,41 @@ class SignUpForm(UserCreationForm):
         fields = ('username', 'email', 'password1', 'password2', )
 
 
+class QueuedPasswordResetForm(PasswordResetForm):
+    """Password reset form that leaves the email to the job queue."""
+
+    def send_mail(self, subject_template_name, email_template_name,
+                  context, from_email, to_email, html_email_template_name=None):
+        subject = ''.join(loader.render_to_string(subject_template_name, context).splitlines())
+        body = loader.render_to_string(email_template_name, context)
+        html_body = loader.render_to_string(html_email_template_name, context) if html_email_template_name else None
+        jobs.send_mail(subject, body, from_email, [to_email], html_body=html_body)
+
+
 class CourseForm(forms.ModelForm):
     right_answer_bonus = forms.IntegerField(min_value=0, max_value=10, initial=5, help_text='How much should we increase your score after right answer?')
     wrong_answer_penalty = forms.IntegerField(min_value=0, max_value=10, initial=1, help_text='How much should we decrease your score after wrong answer?')
     show_answer_penalty = forms.IntegerField(min_value=0, max_value=10, initial=2, help_text='How much should we decrease your score after showing the answer as a hint?')
+    max_typos = forms.IntegerField(min_value=0, max_value=matching.MAX_TYPOS, initial=0, help_text='How many typos should an answer still be accepted with?')
 
     class Meta:
         model = models.Course
-        fields = ('name', 'public', 'helper_symbols', 'right_answer_bonus', 'wrong_answer_penalty', 'show_answer_penalty')
+        fields = ('name', 'public', 'helper_symbols', 'right_answer_bonus', 'wrong_answer_penalty', 'show_answer_penalty',
+                  'ignore_case', 'ignore_diacritics', 'split_alternatives', 'max_typos')
         help_texts = {
             'helper_symbols': 'For example, for German that could be: ÄäÖöÜüß (no spaces or commas are required)',
             'public': 'Check, if you want to share the course with everyone',
+            'ignore_case': 'Check, if "Haus" and "haus" should both be right',
+            'ignore_diacritics': 'Check, if "Hauser" should be right for "Häuser"',
+            'split_alternatives': 'Check, if answers like "house; home" or "house / home" list several right answers',
         }
 
 
 class LessonForm(forms.ModelForm):
     questions = forms.CharField(widget=forms.Textarea())
     answers = forms.CharField(widget=forms.Textarea())
+    # Of the lesson the form was opened with, see editing.save_lesson
+    version = forms.IntegerField(required=False, widget=forms.HiddenInput())
 
     class Meta:
         model = models.Lesson
@@ -60,3 +79,9 @@ class LessonForm(forms.ModelForm):
 
         return is_valid
 
+
+
+class ImportForm(forms.Form):
+    file = forms.FileField(help_text='CSV, TSV or an Anki text export: question, answer and an optional lesson name per line')
+    name = forms.CharField(max_length=200, help_text='Name of the new lesson')
+    split_every = forms.IntegerField(min_value=1, required=False, help_text='Start a new lesson every N words')
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import csv
+import itertools
+import re
+
+from django.db import transaction
+
+from yourvocab import caching, catalog, editing, models
+
+BATCH_SIZE = 500
+MAX_ERRORS = 50
+
+# Anki text exports start with "#key:value" header lines, such as "#separator:tab"
+HEADER = re.compile(r'#([a-z ]+):(.*)')
+HEADER_KEYS = {'separator', 'html', 'tags', 'columns', 'notetype', 'deck',
+               'notetype column', 'deck column', 'tags column', 'guid column', 'if matches'}
+SEPARATORS = {
+    'tab': '\t',
+    'comma': ',',
+    'semicolon': ';',
+    'pipe': '|',
+    'space': ' ',
+}
+
+
+class ImportFailed(Exception):
+    def __init__(self, errors):
+        super().__init__(F'{len(errors)} invalid rows')
+        self.errors = errors
+
+
+def guess_delimiter(line):
+    if '\t' in line:
+        return '\t'
+    if ';' in line and ',' not in line:
+        return ';'
+    return ','
+
+
+def read_rows(lines, delimiter=None):
+    """Yield (line_number, fields) from an iterable of text lines, one row at a time.
+
+    The lines go through a single csv.reader, so quoted fields may span lines; they
+    should be read with newline=''. Only Anki header lines (HEADER_KEYS) before the
+    first row are headers; the delimiter comes from a "#separator:" one or is guessed from
+    the first row when not given. A '#' anywhere else is text like any other. Blank
+    lines are skipped, and the line number is the one a row starts on.
+    """
+    lines = iter(lines)
+    line_number = 0
+    for line in lines:
+        line_number += 1
+        header = HEADER.fullmatch(line.rstrip('\r\n'))
+        if header and header.group(1) in HEADER_KEYS:
+            if header.group(1) == 'separator':
+                value = header.group(2).strip()
+                delimiter = SEPARATORS.get(value.lower(), value or delimiter)
+        elif line.strip():
+            break
+    else:
+        return
+
+    if delimiter is None:
+        delimiter = guess_delimiter(line)
+    reader = csv.reader(itertools.chain((line,), lines), delimiter=delimiter)
+    start = line_number
+    for fields in reader:
+        if len(fields) > 1 or fields and fields[0].strip():
+            yield start, fields
+        start = line_number + reader.line_num
+
+
+def validate_row(fields):
+    """The same rules LessonForm applies to its textareas, for one row."""
+    if len(fields) < 2:
+        return 'A row needs a question and an answer'
+    if not fields[0].strip():
+        return 'Empty questions are not permitted'
+    if not fields[1].strip():
+        return 'Empty answers are not permitted'
+    # The editor shows a lesson as one line per question and answer
+    if any('\r' in field or '\n' in field for field in fields[:2]):
+        return 'A line should not span several lines'
+    return None
+
+
+def import_lessons(course, lines, name, delimiter=None, split_every=None, batch_size=BATCH_SIZE):
+    """Stream (question, answer[, lesson name]) rows into new lessons of `course`.
+
+    Rows are written in bulk batches of `batch_size`, so memory use does not grow with
+    the file. A third column, when present, names the lesson a row goes to; otherwise
+    every `split_every` rows start a new lesson. Any invalid row rolls the whole import
+    back with ImportFailed listing the line numbers. Returns {lesson: question count}.
+    """
+    lessons = {}
+    counts = {}
+    errors = []
+    batch = []
+
+    def flush():
+        for lesson, questions in group_by_lesson(batch):
+            editing.create_questions(lesson, questions)
+        batch.clear()
+
+    def get_lesson(lesson_name):
+        lesson = lessons.get(lesson_name)
+        if lesson is None:
+            lesson = lessons[lesson_name] = models.Lesson.objects.create(course=course, name=lesson_name[:200])
+            counts[lesson] = 0
+        return lesson
+
+    with transaction.atomic():
+        for row_number, (line_number, fields) in enumerate(read_rows(lines, delimiter)):
+            error = validate_row(fields)
+            if error:
+                errors.append((line_number, error))
+                if len(errors) >= MAX_ERRORS:
+                    break
+                continue
+            if errors:
+                # Nothing will be saved, keep on validating only
+                continue
+
+            if len(fields) > 2 and fields[2].strip():
+                lesson_name = fields[2].strip()
+            elif split_every:
+                lesson_name = F'{name} {row_number // split_every + 1}'
+            else:
+                lesson_name = name
+
+            lesson = get_lesson(lesson_name)
+            batch.append((lesson, models.Question(question_text=fields[0].strip(),
+                                                  answer_text=fields[1].strip(),
+                                                  position=counts[lesson])))
+            counts[lesson] += 1
+            if len(batch) >= batch_size:
+                flush()
+
+        if errors:
+            raise ImportFailed(errors)
+
+        if batch:
+            flush()
+
+        # Bulk statements do not send model signals
+        transaction.on_commit(lambda: caching.course_changed(course.id))
+        for lesson in counts:
+            transaction.on_commit(lambda lesson=lesson: catalog.index_lesson(lesson, public=course.public))
+
+    return counts
+
+
+def group_by_lesson(batch):
+    groups = {}
+    for lesson, question in batch:
+        groups.setdefault(lesson, []).append(question)
+    return groups.items()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""A small job queue kept in the database.
+
+Views enqueue work (sending email for now) and return; the run_jobs management command
+picks due jobs up in batches, hands every batch of one kind to its handler at once and
+retries failures with exponential backoff. Jobs are claimed with SELECT ... FOR UPDATE
+SKIP LOCKED, so several workers can share the queue on PostgreSQL, and leased by moving
+their run_after ahead in the same short transaction. The handlers run after it commits,
+so slow work such as an SMTP conversation holds no locks, and the results are recorded
+in a second short transaction. A job whose worker died is taken again once its lease is over.
+"""
+import datetime
+import json
+import logging
+import random
+
+from django.conf import settings
+from django.core import mail
+from django.db import transaction
+from django.utils import timezone
+
+from yourvocab import models
+
+logger = logging.getLogger('yourvocab.jobs')
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 6 * 60 * 60
+# How long a taken job is left to its worker before another one may take it
+LEASE_SECONDS = 10 * 60
+
+# kind -> function taking a list of payloads and returning a list of errors (None on success)
+handlers = {}
+
+
+def handler(kind):
+    def register(function):
+        handlers[kind] = function
+        return function
+    return register
+
+
+def enqueue(kind, payload, delay=0):
+    """Store a job for the worker; with YOURVOCAB_JOBS_INLINE it runs once the transaction commits."""
+    job = models.Job.objects.create(kind=kind,
+                                    payload=json.dumps(payload),
+                                    run_after=timezone.now() + datetime.timedelta(seconds=delay))
+    if settings.YOURVOCAB_JOBS_INLINE:
+        transaction.on_commit(lambda: run_pending(job_ids=[job.id]))
+    return job
+
+
+def backoff(attempts):
+    """Seconds to wait before the next attempt, doubling with every failure, with some jitter."""
+    delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.75, 1.25)
+
+
+def take(batch_size=BATCH_SIZE, job_ids=None):
+    """Lease a batch of due jobs to this worker and commit, so their handlers run without locks."""
+    now = timezone.now()
+    with transaction.atomic():
+        due = models.Job.objects.filter(failed=False, run_after__lte=now)
+        if job_ids is not None:
+            due = due.filter(pk__in=job_ids)
+        jobs = list(due.select_for_update(skip_locked=True).order_by('run_after')[:batch_size])
+        if jobs:
+            (models.Job.objects
+             .filter(pk__in=[job.id for job in jobs])
+             .update(run_after=now + datetime.timedelta(seconds=LEASE_SECONDS)))
+    return jobs
+
+
+def run_pending(batch_size=BATCH_SIZE, job_ids=None):
+    """Run one batch of due jobs and return how many were taken."""
+    jobs = take(batch_size, job_ids)
+
+    by_kind = {}
+    for job in jobs:
+        by_kind.setdefault(job.kind, []).append(job)
+
+    done, retried = [], []
+    for kind, batch in by_kind.items():
+        function = handlers.get(kind)
+        try:
+            if function is None:
+                raise LookupError(F'No handler for {kind} jobs')
+            errors = function([json.loads(job.payload) for job in batch])
+        except Exception as e:
+            logger.exception('%s jobs failed', kind)
+            errors = [e] * len(batch)
+
+        now = timezone.now()
+        for job, error in zip(batch, errors):
+            if error is None:
+                done.append(job.id)
+                continue
+            job.attempts += 1
+            job.last_error = str(error)
+            job.failed = job.attempts >= MAX_ATTEMPTS
+            job.run_after = now + datetime.timedelta(seconds=backoff(job.attempts))
+            retried.append(job)
+            if job.failed:
+                logger.error('Giving up on %s job %d after %d attempts: %s', kind, job.id, job.attempts, error)
+
+    with transaction.atomic():
+        if done:
+            models.Job.objects.filter(pk__in=done).delete()
+        if retried:
+            models.Job.objects.bulk_update(retried, ['attempts', 'last_error', 'failed', 'run_after'])
+    return len(jobs)
+
+
+def send_mail(subject, body, from_email, recipients, html_body=None):
+    return enqueue('send_mail', {'subject': subject, 'body': body, 'from_email': from_email,
+                                 'recipients': recipients, 'html_body': html_body})
+
+
+@handler('send_mail')
+def send_mail_batch(payloads):
+    """Send a batch of messages over one SMTP connection."""
+    errors = []
+    with mail.get_connection() as connection:
+        for payload in payloads:
+            message = mail.EmailMultiAlternatives(payload['subject'], payload['body'], payload['from_email'],
+                                                  payload['recipients'], connection=connection)
+            if payload.get('html_body'):
+                message.attach_alternative(payload['html_body'], 'text/html')
+            try:
+                message.send()
+            except Exception as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+    return errors
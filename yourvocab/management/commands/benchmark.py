@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import re
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from yourvocab import models, quiz
+
+RUN_DATA = re.compile(r'<script id="run_data" type="application/json">(.*?)</script>', re.S)
+RUN_TOKEN = re.compile(r'<input type="hidden" name="token" value="([^"]+)">')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = ('Drives the hot views through the test client against a seeded database (see seed_data) '
+            'and reports latency percentiles and query counts. Runs write attempts and lesson edits.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', default='bench-user-0')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=2)
+        parser.add_argument('--scenario', action='append', help='Run only these scenarios, can be repeated')
+        parser.add_argument('--label', default='', help='Stored with the results, e.g. a commit id')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        try:
+            self.user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(F'No user {options["user"]}, run seed_data first')
+
+        self.lesson = (models.Lesson.objects
+                       .filter(course__coursestudent__student=self.user)
+                       .annotate(size=Count('question'))
+                       .order_by('-size', 'id')
+                       .first())
+        if self.lesson is None:
+            raise CommandError(F'{options["user"]} has no lessons')
+        self.course = self.lesson.course
+        self.lines = list(models.Question.objects
+                          .filter(lesson=self.lesson)
+                          .order_by('position', 'id')
+                          .values_list('question_text', 'answer_text'))
+
+        self.client = Client(HTTP_HOST='127.0.0.1')
+        self.client.force_login(self.user)
+
+        scenarios = {
+            'courses': self.courses,
+            'course': self.course_page,
+            'check': self.check_run,
+            'lesson_save': self.lesson_save,
+            'lesson_patch': self.lesson_patch,
+            'lesson_stats': self.lesson_stats,
+        }
+        selected = options['scenario'] or list(scenarios)
+
+        results = {}
+        for name in selected:
+            if name not in scenarios:
+                raise CommandError(F'Unknown scenario {name}, pick from {", ".join(scenarios)}')
+            for i in range(options['warmup']):
+                scenarios[name](i)
+
+            timings, queries = [], []
+            for i in range(options['repeat']):
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    scenarios[name](i)
+                    timings.append((time.perf_counter() - started) * 1000)
+                queries.append(len(captured.captured_queries))
+
+            results[name] = {
+                'samples': len(timings),
+                'p50_ms': round(percentile(timings, 0.5), 2),
+                'p90_ms': round(percentile(timings, 0.9), 2),
+                'p99_ms': round(percentile(timings, 0.99), 2),
+                'max_ms': round(max(timings), 2),
+                'mean_ms': round(statistics.mean(timings), 2),
+                'queries': max(queries),
+            }
+            r = results[name]
+            self.stdout.write(F'{name:<14} p50 {r["p50_ms"]:>9.2f}ms  p90 {r["p90_ms"]:>9.2f}ms  '
+                              F'p99 {r["p99_ms"]:>9.2f}ms  queries {r["queries"]}')
+
+        if options['output']:
+            report = {
+                'label': options['label'],
+                'date_time': datetime.datetime.utcnow().isoformat(),
+                'vendor': connection.vendor,
+                'lesson_size': len(self.lines),
+                'results': results,
+            }
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    def get(self, url):
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise CommandError(F'GET {url} answered {response.status_code}')
+        return response
+
+    def courses(self, i):
+        self.get('/')
+
+    def course_page(self, i):
+        self.get(F'/course/{self.course.id}')
+
+    def lesson_stats(self, i):
+        self.get(F'/course/{self.course.id}/lesson/{self.lesson.id}/stats')
+
+    def lesson_save(self, i):
+        # Every save fixes a "typo" in one line and the next one reverts it
+        lines = list(self.lines)
+        if i % 2 == 0:
+            question, answer = lines[i % len(lines)]
+            lines[i % len(lines)] = (question + '*', answer)
+        self.client.post(F'/course/{self.course.id}/lesson/{self.lesson.id}',
+                         {'name': self.lesson.name,
+                          'questions': '\r\n'.join(q for (q, _) in lines),
+                          'answers': '\r\n'.join(a for (_, a) in lines)})
+
+    def lesson_patch(self, i):
+        """The edit of lesson_save, sent the way the lesson editor does: just the changed line."""
+        row = (i - i % 2) % len(self.lines)
+        question, answer = self.lines[row]
+        if i % 2 == 0:
+            question += '*'
+        if not hasattr(self, 'version'):
+            self.version = models.Lesson.objects.filter(pk=self.lesson.pk).values_list('version', flat=True).get()
+        response = self.client.post(F'/course/{self.course.id}/lesson/{self.lesson.id}/patch',
+                                    json.dumps({'version': self.version,
+                                                'hunks': [{'start': row, 'delete': 1, 'questions': [question],
+                                                           'answers': [answer]}]}),
+                                    content_type='application/json')
+        if response.status_code != 200:
+            raise CommandError(F'Patch answered {response.status_code}: {response.content}')
+        self.version = response.json()['version']
+
+    def check_run(self, i):
+        """A full lesson run, answered right, the way the lesson page does it."""
+        url = F'/course/{self.course.id}/lesson/{self.lesson.id}'
+        page = self.get(url + '/check')
+
+        embedded = RUN_DATA.search(page.content.decode('utf-8'))
+        if embedded:
+            run = json.loads(embedded.group(1))
+            events = [{'question': q['id'], 'answer': q['answer']} for q in run['questions']]
+            self.client.post(url + '/run', json.dumps({'token': run['token'], 'events': events, 'finish': True}),
+                             content_type='application/json')
+            return
+
+        token = RUN_TOKEN.search(page.content.decode('utf-8')).group(1)
+        while True:
+            state = quiz.QuizRun.from_token(token)
+            payload = quiz.lesson_payload(self.lesson.id, state.version)
+            answer = payload[state.position()][2]
+            response = self.client.post(url + '/check', {'token': token, 'answer': answer, 'show_answer': 'false',
+                                                         'no_score_upd': 'false'}).json()
+            if response['last']:
+                return
+            token = response['token']
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from django.contrib.staticfiles.management.commands import collectstatic
+
+from yourvocab import assets
+
+
+class Command(collectstatic.Command):
+    help = 'Builds the static bundles (see yourvocab.assets), then collects the static files'
+
+    def handle(self, **options):
+        for path in assets.build():
+            self.stdout.write(F'Built {path}')
+        return super().handle(**options)
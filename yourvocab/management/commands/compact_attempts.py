@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from yourvocab import models, retention
+
+
+class Command(BaseCommand):
+    help = ('Rolls the lesson attempts older than the retention window into per-day or per-week summaries. '
+            'Safe to interrupt and run again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-days', type=int, default=settings.YOURVOCAB_ATTEMPTS_RAW_DAYS,
+                            help='Keep the attempts of this many last days as they are')
+        parser.add_argument('--summary', choices=[g for (g, _) in models.LessonAttemptSummary.GRANULARITIES],
+                            default=settings.YOURVOCAB_ATTEMPTS_SUMMARY)
+        parser.add_argument('--archive-dir', default=settings.YOURVOCAB_ATTEMPTS_ARCHIVE_DIR,
+                            help='Write the compacted attempts to a gzipped JSON Lines file in this directory')
+        parser.add_argument('--batch-size', type=int, default=retention.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        def progress(count):
+            if options['verbosity'] > 1:
+                self.stdout.write(F'{count} attempts compacted')
+
+        count = retention.compact(keep_days=options['keep_days'],
+                                  granularity=options['summary'],
+                                  archive_dir=options['archive_dir'],
+                                  batch_size=options['batch_size'],
+                                  progress=progress)
+        self.stdout.write(self.style.SUCCESS(F'Compacted {count} attempts'))
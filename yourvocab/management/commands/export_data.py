@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from yourvocab import exporting, models
+
+
+class Command(BaseCommand):
+    help = 'Exports courses and learning history as CSV or JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Export the courses and progress of this username')
+        parser.add_argument('--course', type=int, action='append', help='Export this course, can be repeated')
+        parser.add_argument('--format', choices=sorted(exporting.FORMATS), default='jsonl')
+        parser.add_argument('--output', help='File to write, stdout by default')
+
+    def handle(self, *args, **options):
+        student = None
+        courses = models.Course.objects.all()
+        if options['user']:
+            try:
+                student = User.objects.get(username=options['user'])
+            except User.DoesNotExist as e:
+                raise CommandError(str(e))
+            courses = exporting.user_courses(student)
+        if options['course']:
+            courses = courses.filter(pk__in=options['course'])
+
+        output = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else sys.stdout
+        try:
+            for piece in exporting.render(exporting.tables(courses, student=student), options['format']):
+                output.write(piece)
+        finally:
+            if output is not sys.stdout:
+                output.close()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from yourvocab import importing, models
+
+
+class Command(BaseCommand):
+    help = 'Imports lessons into a course from a CSV, TSV or Anki text export file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_id', type=int)
+        parser.add_argument('path')
+        parser.add_argument('--name', help='Lesson name, the file name by default')
+        parser.add_argument('--delimiter', help='Field delimiter, guessed by default')
+        parser.add_argument('--split-every', type=int, help='Start a new lesson every N rows')
+        parser.add_argument('--batch-size', type=int, default=importing.BATCH_SIZE)
+        parser.add_argument('--encoding', default='utf-8-sig')
+
+    def handle(self, *args, **options):
+        try:
+            course = models.Course.objects.get(pk=options['course_id'])
+        except models.Course.DoesNotExist as e:
+            raise CommandError(str(e))
+
+        name = options['name'] or options['path'].rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        with open(options['path'], encoding=options['encoding'], newline='') as lines:
+            try:
+                imported = importing.import_lessons(course, lines, name,
+                                                    delimiter=options['delimiter'],
+                                                    split_every=options['split_every'],
+                                                    batch_size=options['batch_size'])
+            except importing.ImportFailed as e:
+                for line_number, error in e.errors:
+                    self.stderr.write(F'{options["path"]}:{line_number}: {error}')
+                raise CommandError('Nothing has been imported')
+
+        for lesson, count in imported.items():
+            self.stdout.write(F'{lesson.name}: {count} questions')
+        self.stdout.write(self.style.SUCCESS(F'Imported {sum(imported.values())} questions into {len(imported)} lessons'))
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import json
+import random
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client, override_settings
+
+from yourvocab import models, quiz
+from yourvocab.management.commands.benchmark import RUN_TOKEN, percentile
+
+
+class ASGIClient:
+    """Just enough of an HTTP client to call the ASGI application in-process, keeping cookies.
+
+    The request body arrives `link_seconds` after the request starts, like from a client on
+    a slow link; the latency recorded is the time from then until the response is complete.
+    """
+
+    def __init__(self, application, cookies, link_seconds):
+        self.application = application
+        self.cookies = dict(cookies)
+        self.link_seconds = link_seconds
+
+    async def request(self, method, path, data=None):
+        body = urlencode(data).encode('utf-8') if data else b''
+        headers = [(b'host', b'localhost'),
+                   (b'cookie', '; '.join(F'{name}={value}' for name, value in self.cookies.items()).encode('latin-1'))]
+        if method == 'POST':
+            headers += [(b'content-type', b'application/x-www-form-urlencoded'),
+                        (b'content-length', str(len(body)).encode('latin-1')),
+                        (b'x-csrftoken', self.cookies.get(settings.CSRF_COOKIE_NAME, '').encode('latin-1'))]
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+                 'scheme': 'http', 'path': path, 'raw_path': path.encode('utf-8'), 'query_string': b'',
+                 'root_path': '', 'headers': headers, 'client': ('127.0.0.1', 0), 'server': ('localhost', 80)}
+
+        started = None
+        sent = False
+
+        async def receive():
+            nonlocal started, sent
+            if sent:
+                # Nothing more to read; wait for the application to finish with the request
+                await asyncio.Future()
+            await asyncio.sleep(self.link_seconds)
+            started = time.perf_counter()
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        status = None
+        chunks = []
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                for name, value in message['headers']:
+                    if name.lower() == b'set-cookie':
+                        for morsel in SimpleCookie(value.decode('latin-1')).values():
+                            self.cookies[morsel.key] = morsel.value
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+
+        await self.application(scope, receive, send)
+        return status, b''.join(chunks).decode('utf-8'), time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = ('Answers lessons from many simulated students at once through the ASGI application, in this process, '
+            'one request per answer (the lesson page with YOURVOCAB_BATCH_ANSWERS off), and reports the throughput '
+            'and latency for each number of concurrent quiz sessions. Run it against a database seeded with '
+            'seed_data; it writes attempts.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', default='bench-user-', help='Prefix of the usernames to answer as')
+        parser.add_argument('--sessions', default='10,50,100,250,500,1000',
+                            help='Comma separated numbers of concurrent quiz sessions to try')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds per number of sessions')
+        parser.add_argument('--think-ms', type=float, default=1000, help='Mean pause of a student before an answer')
+        parser.add_argument('--link-ms', type=float, default=100,
+                            help='Delay before the request body arrives, as from a slow mobile link')
+        parser.add_argument('--mistakes', type=float, default=0.1, help='Share of wrong answers')
+        parser.add_argument('--target-ms', type=float, default=250, help='p95 answer latency to stay within')
+        parser.add_argument('--label', default='', help='Stored with the results, e.g. a commit id')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['sessions'].split(',')]
+        except ValueError:
+            raise CommandError('--sessions takes numbers separated by commas')
+
+        students = []
+        for user in User.objects.filter(username__startswith=options['users']).order_by('id'):
+            lesson = (models.Lesson.objects
+                      .filter(course__coursestudent__student=user)
+                      .annotate(size=Count('question'))
+                      .filter(size__gt=0)
+                      .order_by('-size', 'id')
+                      .first())
+            if lesson is None:
+                continue
+            login = Client()
+            login.force_login(user)
+            answers = [answer_text for (_, _, answer_text, _) in quiz.lesson_payload(lesson.id, lesson.version)]
+            students.append(({settings.SESSION_COOKIE_NAME: login.cookies[settings.SESSION_COOKIE_NAME].value},
+                             F'/course/{lesson.course_id}/lesson/{lesson.id}/check', answers))
+        if not students:
+            raise CommandError(F'No users {options["users"]}* with lessons, run seed_data first')
+
+        self.stdout.write(F'{len(students)} students, {settings.YOURVOCAB_DB_THREADS} database threads, '
+                          F'think {options["think_ms"]:.0f}ms, link {options["link_ms"]:.0f}ms')
+        if connection.vendor == 'sqlite' and settings.YOURVOCAB_DB_THREADS > 1:
+            self.stdout.write(self.style.WARNING(
+                'SQLite takes one writer at a time and fails the others with "database is locked"; '
+                'use YOURVOCAB_DB_THREADS=1 or PostgreSQL'))
+        self.stdout.write(F'{"sessions":>8} {"answers":>8} {"per s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+                          F'{"runs":>6} {"errors":>6} {"threads":>7}')
+
+        results = []
+        with override_settings(YOURVOCAB_BATCH_ANSWERS=False):
+            application = get_asgi_application()
+            for level in levels:
+                r = asyncio.run(self.run_level(application, students, level, options))
+                results.append(r)
+                self.stdout.write(F'{r["sessions"]:>8} {r["answers"]:>8} {r["answers_per_second"]:>8.1f} '
+                                  F'{r["p50_ms"]:>8.1f} {r["p95_ms"]:>8.1f} {r["p99_ms"]:>8.1f} '
+                                  F'{r["runs"]:>6} {r["errors"]:>6} {r["threads"]:>7}')
+
+        within = [r['sessions'] for r in results if r['answers'] and not r['errors']
+                  and r['p95_ms'] <= options['target_ms']]
+        target = F'p95 {options["target_ms"]:.0f}ms'
+        if within:
+            self.stdout.write(self.style.SUCCESS(
+                F'One process kept up with {max(within)} concurrent quiz sessions within {target}'))
+        else:
+            self.stdout.write(self.style.WARNING(F'No number of sessions stayed within {target}'))
+
+        if options['output']:
+            report = {
+                'label': options['label'],
+                'date_time': datetime.datetime.utcnow().isoformat(),
+                'vendor': connection.vendor,
+                'db_threads': settings.YOURVOCAB_DB_THREADS,
+                'options': {name: options[name] for name in ('think_ms', 'link_ms', 'mistakes', 'duration')},
+                'results': results,
+            }
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    async def run_level(self, application, students, sessions, options):
+        deadline = time.monotonic() + options['duration']
+        latencies, counts = [], {'runs': 0, 'errors': 0}
+        threads = [threading.active_count()]
+
+        async def student(i):
+            cookies, url, answers = students[i % len(students)]
+            client = ASGIClient(application, cookies, options['link_ms'] / 1000)
+            # Spread the starts over one think time
+            await asyncio.sleep(random.uniform(0, options['think_ms'] / 1000))
+            while time.monotonic() < deadline:
+                status, page, _ = await client.request('GET', url)
+                found = RUN_TOKEN.search(page) if status == 200 else None
+                if found is None:
+                    counts['errors'] += 1
+                    return
+                token = found.group(1)
+
+                while time.monotonic() < deadline:
+                    await asyncio.sleep(random.expovariate(1000 / options['think_ms']))
+                    run = quiz.QuizRun.from_token(token)
+                    answer = 'wrong' if random.random() < options['mistakes'] else answers[run.position()]
+                    status, body, latency = await client.request('POST', url, {'token': token,
+                                                                               'answer': answer,
+                                                                               'show_answer': 'false',
+                                                                               'no_score_upd': 'false'})
+                    threads[0] = max(threads[0], threading.active_count())
+                    if status != 200:
+                        counts['errors'] += 1
+                        return
+                    latencies.append(latency * 1000)
+                    data = json.loads(body)
+                    if data['last']:
+                        counts['runs'] += 1
+                        break
+                    token = data['token']
+
+        started = time.monotonic()
+        await asyncio.gather(*[student(i) for i in range(sessions)])
+        elapsed = time.monotonic() - started
+        return {
+            'sessions': sessions,
+            'answers': len(latencies),
+            'answers_per_second': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.5), 2) if latencies else 0,
+            'p95_ms': round(percentile(latencies, 0.95), 2) if latencies else 0,
+            'p99_ms': round(percentile(latencies, 0.99), 2) if latencies else 0,
+            'runs': counts['runs'],
+            'errors': counts['errors'],
+            'threads': threads[0],
+        }
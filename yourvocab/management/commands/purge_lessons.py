@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from yourvocab import models, purging
+
+
+class Command(BaseCommand):
+    help = ('Removes the lessons deleted longer ago than the undo window, in batches. '
+            'The worker does this by itself; the command catches up on anything left and can be stopped at any time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=purging.BATCH_SIZE)
+        parser.add_argument('--lesson', type=int, action='append', help='Purge only these lessons, can be repeated')
+
+    def handle(self, *args, **options):
+        cutoff = purging.purge_cutoff()
+        lessons = models.Lesson.all_objects.filter(deleted_at__lte=cutoff)
+        if options['lesson']:
+            lessons = lessons.filter(pk__in=options['lesson'])
+
+        purged = 0
+        for lesson_id in lessons.order_by('deleted_at').values_list('id', flat=True):
+            removed = {}
+
+            def progress(description, count):
+                removed[description] = removed.get(description, 0) + count
+                if options['verbosity'] > 1:
+                    self.stdout.write(F'Lesson {lesson_id}: {removed[description]} {description} removed')
+
+            purging.purge_lesson(lesson_id, cutoff, options['batch_size'], progress=progress)
+            purged += 1
+            summary = ', '.join(F'{count} {description}' for description, count in removed.items() if description != 'lesson')
+            self.stdout.write(F'Purged lesson {lesson_id}' + (F' ({summary})' if summary else ''))
+        self.stdout.write(self.style.SUCCESS(F'Purged {purged} lessons'))
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from yourvocab import catalog, models
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the search index of the public course catalog'
+
+    def handle(self, *args, **options):
+        models.CatalogTerm.objects.exclude(course__public=True).delete()
+        count = 0
+        for course in models.Course.objects.filter(public=True).iterator():
+            catalog.index_course(course)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(F'Indexed {count} public courses'))
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from yourvocab import progress
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per-student progress rollups from the attempts history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = progress.rebuild_lesson_progress(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(F'Rebuilt {count} lesson progress rows'))
+        count = progress.rebuild_course_progress(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(F'Rebuilt {count} course progress rows'))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand
+
+from yourvocab import jobs, quiz
+
+# Seconds between two clean-ups of the expired run claims
+EXPIRE_CLAIMS_EVERY = 60 * 60
+
+
+class Command(BaseCommand):
+    help = 'Runs the queued background jobs, such as outgoing email, and forgets expired run claims'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit when no job is due instead of waiting')
+        parser.add_argument('--batch-size', type=int, default=jobs.BATCH_SIZE)
+        parser.add_argument('--sleep', type=float, default=2.0, help='Seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        total = 0
+        claims_expired = None
+        while True:
+            if claims_expired is None or time.monotonic() - claims_expired > EXPIRE_CLAIMS_EVERY:
+                quiz.expire_claims()
+                claims_expired = time.monotonic()
+            taken = jobs.run_pending(options['batch_size'])
+            total += taken
+            if not taken:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS(F'Ran {total} jobs'))
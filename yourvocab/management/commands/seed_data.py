@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import datetime
+import random
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from yourvocab import editing, models, progress
+
+ATTEMPTS_BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Seeds a synthetic dataset of users, courses, lessons and attempt histories for benchmarking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=3)
+        parser.add_argument('--courses', type=int, default=2, help='Courses per user')
+        parser.add_argument('--lessons', type=int, default=5, help='Lessons per course')
+        parser.add_argument('--questions', type=int, default=1000, help='Questions per lesson')
+        parser.add_argument('--attempts', type=int, default=200, help='Attempts per lesson')
+        parser.add_argument('--prefix', default='bench', help='Prefix of the generated usernames')
+        parser.add_argument('--password', default='bench-password')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        now = timezone.now()
+
+        for u in range(options['users']):
+            username = F'{options["prefix"]}-user-{u}'
+            if User.objects.filter(username=username).exists():
+                self.stdout.write(F'{username} exists already, skipping')
+                continue
+
+            with transaction.atomic():
+                user = User.objects.create_user(username, F'{username}@example.com', options['password'])
+                for c in range(options['courses']):
+                    course = models.Course.objects.create(author=user, name=F'Course {c}', helper_symbols='ÄäÖöÜüß')
+                    models.CourseStudent.objects.create(student=user, course=course)
+
+                    for l in range(options['lessons']):
+                        lesson = models.Lesson.objects.create(course=course, name=F'Lesson {l}',
+                                                              attendance_count=options['attempts'])
+                        editing.create_questions(lesson, [
+                            models.Question(question_text=F'question {c}.{l}.{q}',
+                                            answer_text=F'answer {c}.{l}.{q}',
+                                            position=q)
+                            for q in range(options['questions'])])
+
+                        attempts = []
+                        for a in range(options['attempts']):
+                            attempts.append(models.LessonStudent(
+                                student=user,
+                                lesson=lesson,
+                                date_time=now - datetime.timedelta(hours=rnd.randint(1, 24 * 365 * 3)),
+                                elapsed_time=rnd.randint(60, 3600),
+                                points=rnd.randint(-options['questions'], 5 * options['questions']),
+                                mistakes_count=rnd.randint(0, options['questions'])))
+                        models.LessonStudent.objects.bulk_create(attempts, batch_size=ATTEMPTS_BATCH_SIZE)
+
+            self.stdout.write(F'Created {username}')
+
+        count = progress.rebuild_lesson_progress()
+        self.stdout.write(self.style.SUCCESS(F'Rebuilt {count} lesson progress rows'))
+        count = progress.rebuild_course_progress()
+        self.stdout.write(self.style.SUCCESS(F'Rebuilt {count} course progress rows'))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Tolerant answer matching.
+
+When a lesson is saved, every answer gets an answer key: its accepted forms, already
+normalized with the matching options of the course, behind a one-line header holding
+those options (e.g. "cd1": ignore case, ignore diacritics, one typo allowed). Grading
+then only normalizes the typed answer and compares it with the stored forms, using an
+edit distance that gives up as soon as the typo limit is exceeded, so a check costs
+O(answer length). static/js/yourvocab.js grades with the same rules in the browser.
+"""
+import re
+import unicodedata
+from collections import namedtuple
+
+MAX_TYPOS = 3
+ALTERNATIVES = re.compile(r'[;/]')
+
+
+class Options(namedtuple('Options', 'ignore_case ignore_diacritics alternatives max_typos')):
+    @classmethod
+    def for_course(cls, course):
+        return cls(course.ignore_case, course.ignore_diacritics, course.split_alternatives,
+                   min(course.max_typos, MAX_TYPOS))
+
+    @property
+    def header(self):
+        return (('c' if self.ignore_case else '') + ('d' if self.ignore_diacritics else '')
+                + str(self.max_typos))
+
+
+def normalize(text, ignore_case, ignore_diacritics):
+    text = ' '.join(text.split())
+    if ignore_case:
+        # Full case folding, so that 'Straße' matches 'STRASSE'; before the diacritics,
+        # as some letters fold to a combining mark
+        text = text.casefold()
+    if ignore_diacritics:
+        decomposed = unicodedata.normalize('NFKD', text)
+        text = unicodedata.normalize('NFC', ''.join(c for c in decomposed if unicodedata.category(c) != 'Mn'))
+    return text
+
+
+def answer_key(options, answer_text):
+    forms = ALTERNATIVES.split(answer_text) if options.alternatives else [answer_text]
+    normalized = []
+    for form in forms:
+        form = normalize(form, options.ignore_case, options.ignore_diacritics)
+        if form and form not in normalized:
+            normalized.append(form)
+    return '\n'.join([options.header] + normalized)
+
+
+def within_distance(a, b, limit):
+    """Whether the Levenshtein distance of `a` and `b` is at most `limit`.
+
+    Only the diagonal band of width 2 * limit + 1 is computed and the loop stops once
+    a whole row is over the limit, so this is O(len(a) * limit).
+    """
+    if abs(len(a) - len(b)) > limit:
+        return False
+    if limit == 0:
+        return a == b
+    over = limit + 1
+    width = 2 * limit + 1
+    # Cell d of a row i holds the distance of a[:i] and b[:i - limit + d]
+    previous = [j if 0 <= j <= len(b) else over for j in range(-limit, limit + 1)]
+    for i in range(1, len(a) + 1):
+        current = [over] * width
+        for d in range(width):
+            j = i - limit + d
+            if j < 0 or j > len(b):
+                continue
+            if j == 0:
+                current[d] = min(i, over)
+                continue
+            best = previous[d] + (a[i - 1] != b[j - 1])
+            if d + 1 < width:
+                best = min(best, previous[d + 1] + 1)
+            if d > 0:
+                best = min(best, current[d - 1] + 1)
+            current[d] = min(best, over)
+        if min(current) > limit:
+            return False
+        previous = current
+    return previous[len(b) - len(a) + limit] <= limit
+
+
+def matches(key, answer):
+    header, *forms = key.split('\n')
+    typos = int(header.lstrip('cd'))
+    answer = normalize(answer, 'c' in header, 'd' in header)
+    if 'c' in header:
+        # Keys saved before case folding hold lower-cased forms
+        forms = [form.casefold() for form in forms]
+    return any(form == answer or (typos and within_distance(answer, form, typos)) for form in forms)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+
+# Upper bounds of the histogram buckets, +Inf is implied
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        # label value -> [per-bucket counts (+Inf last), sum]
+        self.series = {}
+
+    def observe(self, label, value):
+        series = self.series.get(label)
+        if series is None:
+            series = self.series.setdefault(label, [[0] * (len(self.buckets) + 1), 0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self, label_name):
+        lines = [F'# HELP {self.name} {self.documentation}', F'# TYPE {self.name} histogram']
+        for label, (counts, total) in sorted(self.series.items()):
+            label = label.replace('\\', '\\\\').replace('"', '\\"')
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(F'{self.name}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+            lines.append(F'{self.name}_sum{{{label_name}="{label}"}} {total}')
+            lines.append(F'{self.name}_count{{{label_name}="{label}"}} {cumulative}')
+        return lines
+
+
+class Registry:
+    """Per-process request metrics grouped by URL pattern."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {
+            'wall': Histogram('yourvocab_request_seconds', 'Wall time of the request', SECONDS_BUCKETS),
+            'db': Histogram('yourvocab_request_db_seconds', 'Time spent in database queries', SECONDS_BUCKETS),
+            'queries': Histogram('yourvocab_request_queries', 'Number of database queries', COUNT_BUCKETS),
+            'session': Histogram('yourvocab_request_session_bytes', 'Size of the session data written',
+                                 BYTES_BUCKETS),
+            'response': Histogram('yourvocab_response_bytes', 'Size of the response body', BYTES_BUCKETS),
+        }
+
+    def observe(self, route, **values):
+        with self.lock:
+            for key, value in values.items():
+                if value is not None:
+                    self.histograms[key].observe(route, value)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for histogram in self.histograms.values():
+                lines.extend(histogram.render('route'))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            for histogram in self.histograms.values():
+                histogram.series = {}
+
+
+registry = Registry()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import heapq
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from yourvocab.budgets import view_budget
+from yourvocab.metrics import registry
+
+logger = logging.getLogger('yourvocab.performance')
+
+SLOW_SQL_SHOWN = 3
+
+
+class QueryRecorder:
+    """Database execute wrapper that sums up query time and keeps the slowest statements."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.count += 1
+            self.duration += duration
+            if len(self.slowest) < SLOW_SQL_SHOWN:
+                heapq.heappush(self.slowest, (duration, self.count, sql))
+            elif duration > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (duration, self.count, sql))
+
+
+current_recorder = contextvars.ContextVar('yourvocab_query_recorder', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper of every connection, passes the query to the recorder of the current request.
+
+    The recorder is found through a context variable rather than installed on the connections
+    of one thread, since under ASGI the queries of a request run in several threads.
+    """
+    recorder = current_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_recorder(sender, connection, **kwargs):
+    """connection_created receiver, see YourvocabConfig.ready."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def session_size(request):
+    session = getattr(request, 'session', None)
+    if session is None or not session.modified:
+        return None
+    return len(session.encode(dict(session.items())))
+
+
+def response_size(response):
+    if response.streaming:
+        return None
+    return len(response.content)
+
+
+class PerformanceMiddleware:
+    """Records wall time, DB time, query count, session write and response sizes per URL pattern.
+
+    Should come first in MIDDLEWARE so that the session save is inside the measured time.
+    Requests over YOURVOCAB_SLOW_REQUEST_MS, YOURVOCAB_SLOW_REQUEST_QUERIES or the query
+    budget of their view (see yourvocab.budgets) are logged with their slowest SQL.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_seconds = getattr(settings, 'YOURVOCAB_SLOW_REQUEST_MS', 500) / 1000
+        self.slow_queries = getattr(settings, 'YOURVOCAB_SLOW_REQUEST_QUERIES', 50)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        token = current_recorder.set(recorder)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_recorder.reset(token)
+        self.observe(request, response, recorder, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder()
+        token = current_recorder.set(recorder)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_recorder.reset(token)
+        self.observe(request, response, recorder, time.perf_counter() - started)
+        return response
+
+    def observe(self, request, response, recorder, wall):
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match and match.route else 'unmatched'
+        registry.observe(route,
+                         wall=wall,
+                         db=recorder.duration,
+                         queries=recorder.count,
+                         session=session_size(request),
+                         response=response_size(response))
+
+        limit = view_budget(match.func) if match else None
+        over_budget = limit is not None and recorder.count > limit.queries
+        if wall > self.slow_seconds or recorder.count > self.slow_queries or over_budget:
+            slowest = '\n'.join(F'  {duration * 1000:.1f}ms {sql}'
+                                for (duration, _, sql) in sorted(recorder.slowest, reverse=True))
+            logger.warning('%s request %s %s (%s): %.1fms, %d queries in %.1fms\n%s',
+                           'Over budget' if over_budget else 'Slow', request.method, request.path, route,
+                           wall * 1000, recorder.count, recorder.duration * 1000, slowest)
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoise that also takes async requests, put in its place by the settings.
+
+    WhiteNoiseMiddleware is sync only, and as the first middleware it would make Django run
+    every request under ASGI in a thread of its own. Here only static files are served from
+    a thread, the other requests pass straight through.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings=settings)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file, thread_sensitive=False)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is None:
+            return await self.get_response(request)
+        return await sync_to_async(self.serve, thread_sensitive=False)(static_file, request)
@@ -24,18 +24,46 @@ class Course(models.Model):
     name = models.CharField(max_length=200)
     public = models.BooleanField(default=False)
     helper_symbols = models.CharField(max_length=200)
+    # Answer matching, see yourvocab.matching
+    ignore_case = models.BooleanField(default=False)
+    ignore_diacritics = models.BooleanField(default=False)
+    split_alternatives = models.BooleanField(default=False)
+    max_typos = models.SmallIntegerField(default=0)
+
+
+class LiveLessonManager(models.Manager):
+    """Lessons that have not been deleted."""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at=None)
 
 
 class Lesson(models.Model):
     course = models.ForeignKey(Course, on_delete=models.CASCADE, editable=False)
     name = models.CharField(max_length=200)
     attendance_count = models.IntegerField(default=0)
+    version = models.IntegerField(default=0, editable=False)
+    # Deleted lessons are hidden at once and removed later, see yourvocab.purging
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = LiveLessonManager()
+    all_objects = models.Manager()
+
+    class Meta:
+        # Course pages list lessons by id, a page at a time
+        indexes = [models.Index(fields=['course', 'id']), models.Index(fields=['deleted_at'])]
 
 
 class Question(models.Model):
     question_text = models.TextField()
     answer_text = models.TextField()
     lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE, editable=False)
+    position = models.IntegerField(default=0)
+    # Normalized accepted answers, see yourvocab.matching; empty for rows saved before matching options
+    answer_key = models.TextField(blank=True, editable=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['lesson', 'position'])]
 
 
 class CourseStudent(models.Model):
@@ -45,6 +73,9 @@ class CourseStudent(models.Model):
     mistake_penalty = models.SmallIntegerField(default=1)
     show_answer_penalty = models.SmallIntegerField(default=2)
 
+    class Meta:
+        indexes = [models.Index(fields=['student', 'course'])]
+
 
 class LessonStudent(models.Model):
     student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, editable=False)
@@ -54,8 +85,130 @@ class LessonStudent(models.Model):
     points = models.IntegerField()
     mistakes_count = models.IntegerField()
 
+    class Meta:
+        indexes = [models.Index(fields=['student', 'lesson', 'date_time'])]
+
+
+class LessonAttemptSummary(models.Model):
+    """LessonStudent attempts of a day or a week rolled into one row, see yourvocab.retention."""
+    DAY = 'day'
+    WEEK = 'week'
+    GRANULARITIES = ((DAY, 'Day'), (WEEK, 'Week'))
+
+    student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, editable=False)
+    lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE, editable=False)
+    granularity = models.CharField(max_length=8, choices=GRANULARITIES)
+    # Start of the day or week, in TIME_ZONE
+    period = models.DateTimeField()
+    count = models.IntegerField()
+    points_total = models.BigIntegerField()
+    points_min = models.IntegerField()
+    points_max = models.IntegerField()
+    elapsed_time_total = models.BigIntegerField()
+    mistakes_total = models.BigIntegerField()
+    # The latest attempt of the period, so that rollups can be rebuilt
+    last_date_time = models.DateTimeField()
+    last_points = models.IntegerField()
+
+    class Meta:
+        unique_together = ('student', 'lesson', 'granularity', 'period')
+
 
 class QuestionStudent(models.Model):
     question = models.ForeignKey(Question, on_delete=models.CASCADE)
     student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     mistakes_count = models.IntegerField(default=0)
+    # Spaced repetition schedule, see yourvocab.review
+    ease = models.FloatField(default=2.5)
+    interval = models.IntegerField(default=0)
+    repetitions = models.IntegerField(default=0)
+    due = models.DateTimeField(null=True)
+
+    class Meta:
+        # Rows are created lazily, on the first mistake or review of a question
+        unique_together = ('question', 'student')
+        indexes = [models.Index(fields=['student', 'due'])]
+
+
+class CatalogTerm(models.Model):
+    """Inverted index of the public courses, see yourvocab.catalog."""
+    term = models.CharField(max_length=64, db_index=True)
+    course = models.ForeignKey(Course, on_delete=models.CASCADE)
+    # Empty for the terms of the course name
+    lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE, null=True)
+    # How many of the lesson's questions, and its name, hold the term, so edits can update it
+    count = models.IntegerField(default=1)
+
+
+class LessonProgress(models.Model):
+    student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, editable=False)
+    lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE, editable=False)
+    attempts_count = models.IntegerField(default=0)
+    best_points = models.IntegerField(null=True)
+    last_points = models.IntegerField(null=True)
+    points_total = models.BigIntegerField(default=0)
+    elapsed_time_total = models.BigIntegerField(default=0)
+    mistakes_total = models.BigIntegerField(default=0)
+    last_date_time = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = ('student', 'lesson')
+
+    @property
+    def mean_points(self):
+        return self.points_total / self.attempts_count if self.attempts_count else None
+
+
+class CourseProgress(models.Model):
+    """Per-student rollup of a course, updated with every finished lesson run, see yourvocab.progress."""
+    student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, editable=False)
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, editable=False)
+    lessons_attempted = models.IntegerField(default=0)
+    attempts_count = models.IntegerField(default=0)
+    points_total = models.BigIntegerField(default=0)
+    elapsed_time_total = models.BigIntegerField(default=0)
+    mistakes_total = models.BigIntegerField(default=0)
+    last_date_time = models.DateTimeField(null=True)
+    # Days in a row with at least one finished run, counted in TIME_ZONE
+    last_study_date = models.DateField(null=True)
+    current_streak = models.IntegerField(default=0)
+    longest_streak = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('student', 'course')
+
+    def streak_on(self, day):
+        """The current streak as seen on `day`: it is broken once a whole day goes by without a run."""
+        if self.last_study_date is None or (day - self.last_study_date).days > 1:
+            return 0
+        return self.current_streak
+
+
+class Job(models.Model):
+    """Background work waiting for the run_jobs worker, see yourvocab.jobs."""
+    kind = models.CharField(max_length=64)
+    # JSON arguments of the handler
+    payload = models.TextField()
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField()
+    failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['failed', 'run_after'])]
+
+
+class RunClaim(models.Model):
+    """A run token that has been used, see yourvocab.quiz.SignedRun.claim."""
+    run_id = models.CharField(max_length=16)
+    seq = models.IntegerField()
+    # Of the request that used the token, to tell a repeated request from another one
+    digest = models.CharField(max_length=64)
+    student = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
+    # The run's buffered mistakes after the request, as JSON, see yourvocab.quiz.flush_abandoned
+    pending = models.TextField(blank=True, default='')
+    claimed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ('run_id', 'seq')
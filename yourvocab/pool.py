@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Thread pool for the blocking work of the async views.
+
+Under ASGI the async views must not touch the ORM, the sessions or the cache from the
+event loop. They hand that work to `run`, which executes it in a pool of
+YOURVOCAB_DB_THREADS threads. The pool bounds the database connections a process holds
+(each thread keeps its own, like a sync worker would) and queues the work beyond that,
+while the event loop goes on reading and writing the requests of slow clients.
+
+With YOURVOCAB_DB_THREADS set to 0 the work runs in the thread of the request instead, as
+asgiref's sync_to_async does by default. The tests do that, so that the work sees the data
+of their transaction.
+"""
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(settings.YOURVOCAB_DB_THREADS, thread_name_prefix='yourvocab-db')
+        return _executor
+
+
+def call(func, *args, **kwargs):
+    # Pool threads live outside the request cycle that closes the connections of a request
+    # thread, so they drop broken and expired connections (CONN_MAX_AGE) themselves
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run(func, *args, **kwargs):
+    """Run the blocking `func(*args, **kwargs)` in the pool and return its result."""
+    if not settings.YOURVOCAB_DB_THREADS:
+        return await sync_to_async(func)(*args, **kwargs)
+    return await sync_to_async(call, thread_sensitive=False, executor=executor())(func, *args, **kwargs)
+
+
+def is_authenticated(request):
+    # Loads the session and the user
+    return request.user.is_authenticated
+
+
+def login_required(view):
+    """django.contrib.auth's login_required for async views."""
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if not await run(is_authenticated, request):
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+async def read_in_request_thread(content):
+    # Pieces one at a time, in the thread of the request like the view that made the stream,
+    # which keeps the server-side cursor of a queryset iterator on its connection
+    read = sync_to_async(next, thread_sensitive=True)
+    while True:
+        piece = await read(content, None)
+        if piece is None:
+            return
+        yield piece
+
+
+def streamed_under_asgi(view):
+    """For sync views that stream their response.
+
+    Under ASGI, Django reads a sync iterator into memory whole before it sends anything. Here
+    it becomes an async iterator that reads a piece at a time instead, as the WSGI server
+    would.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if isinstance(request, ASGIRequest) and response.streaming and not response.is_async:
+            response.streaming_content = read_in_request_thread(response.streaming_content)
+        return response
+    return wrapper
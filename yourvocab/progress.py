@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import datetime
+import heapq
+import itertools
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Greatest, TruncDate
+from django.utils import timezone
+
+from yourvocab import caching, models, review
+
+HARDEST_QUESTIONS = 10
+
+
+def record_attempt(attempt):
+    """Fold a finished LessonStudent attempt into the student's LessonProgress and CourseProgress rollups."""
+    rows = models.LessonProgress.objects.filter(student_id=attempt.student_id, lesson_id=attempt.lesson_id)
+    changes = {
+        'attempts_count': F('attempts_count') + 1,
+        'best_points': Greatest(Coalesce(F('best_points'), attempt.points), attempt.points),
+        'last_points': attempt.points,
+        'points_total': F('points_total') + attempt.points,
+        'elapsed_time_total': F('elapsed_time_total') + attempt.elapsed_time,
+        'mistakes_total': F('mistakes_total') + attempt.mistakes_count,
+        'last_date_time': attempt.date_time,
+    }
+
+    if rows.update(**changes):
+        record_course_attempt(attempt, new_lesson=False)
+        return
+
+    new_lesson = True
+    try:
+        with transaction.atomic():
+            models.LessonProgress.objects.create(student_id=attempt.student_id,
+                                                 lesson_id=attempt.lesson_id,
+                                                 attempts_count=1,
+                                                 best_points=attempt.points,
+                                                 last_points=attempt.points,
+                                                 points_total=attempt.points,
+                                                 elapsed_time_total=attempt.elapsed_time,
+                                                 mistakes_total=attempt.mistakes_count,
+                                                 last_date_time=attempt.date_time)
+    except IntegrityError:
+        # Somebody else created the row in the meantime
+        rows.update(**changes)
+        new_lesson = False
+    record_course_attempt(attempt, new_lesson)
+
+
+def next_streak(last_study_date, streak, day):
+    if last_study_date is None or day - last_study_date > datetime.timedelta(days=1):
+        return 1
+    if day - last_study_date == datetime.timedelta(days=1):
+        return streak + 1
+    # Another run on the same day, or a late one from an earlier day
+    return streak
+
+
+def record_course_attempt(attempt, new_lesson):
+    """Update the CourseProgress row of the attempt with a constant amount of work."""
+    course_id = caching.lesson_course_id(attempt.lesson_id)
+    day = timezone.localdate(attempt.date_time)
+    with transaction.atomic():
+        row, _ = (models.CourseProgress.objects
+                  .select_for_update()
+                  .get_or_create(student_id=attempt.student_id, course_id=course_id))
+        row.lessons_attempted += int(new_lesson)
+        row.attempts_count += 1
+        row.points_total += attempt.points
+        row.elapsed_time_total += attempt.elapsed_time
+        row.mistakes_total += attempt.mistakes_count
+        row.last_date_time = max(row.last_date_time or attempt.date_time, attempt.date_time)
+        row.current_streak = next_streak(row.last_study_date, row.current_streak, day)
+        row.longest_streak = max(row.longest_streak, row.current_streak)
+        row.last_study_date = max(row.last_study_date or day, day)
+        row.save()
+
+
+def student_lesson(row):
+    return row['student'], row['lesson']
+
+
+def lesson_totals():
+    """LessonProgress values per (student, lesson) of the attempts and of the compacted attempts.
+
+    Both queries are ordered by (student, lesson) and merged as they stream in.
+    """
+    last = models.LessonStudent.objects.filter(student=OuterRef('student'),
+                                               lesson=OuterRef('lesson')).order_by('-date_time', '-id')
+    recent = (models.LessonStudent.objects
+              .values('student', 'lesson')
+              .annotate(attempts_count=Count('id'),
+                        best_points=Max('points'),
+                        last_points=Subquery(last.values('points')[:1]),
+                        points_total=Sum('points'),
+                        elapsed_time_total=Sum('elapsed_time'),
+                        mistakes_total=Sum('mistakes_count'),
+                        last_date_time=Max('date_time'))
+              .order_by('student', 'lesson'))
+    last = models.LessonAttemptSummary.objects.filter(student=OuterRef('student'),
+                                                      lesson=OuterRef('lesson')).order_by('-last_date_time')
+    compacted = (models.LessonAttemptSummary.objects
+                 .values('student', 'lesson')
+                 .annotate(attempts_count=Sum('count'),
+                           best_points=Max('points_max'),
+                           last_points=Subquery(last.values('last_points')[:1]),
+                           points_total=Sum('points_total'),
+                           elapsed_time_total=Sum('elapsed_time_total'),
+                           mistakes_total=Sum('mistakes_total'),
+                           last_date_time=Max('last_date_time'))
+                 .order_by('student', 'lesson'))
+
+    merged = heapq.merge(recent.iterator(), compacted.iterator(), key=student_lesson)
+    for _, rows in itertools.groupby(merged, key=student_lesson):
+        total, *others = rows
+        for other in others:
+            if other['last_date_time'] > total['last_date_time']:
+                total['last_date_time'], total['last_points'] = other['last_date_time'], other['last_points']
+            total['best_points'] = max(total['best_points'], other['best_points'])
+            for field in ('attempts_count', 'points_total', 'elapsed_time_total', 'mistakes_total'):
+                total[field] += other[field]
+        yield total
+
+
+def rebuild_lesson_progress(batch_size=1000):
+    """Recompute every LessonProgress row from the attempts history, compacted attempts included."""
+    created = 0
+    with transaction.atomic():
+        models.LessonProgress.objects.all().delete()
+        batch = []
+        for row in lesson_totals():
+            row['student_id'] = row.pop('student')
+            row['lesson_id'] = row.pop('lesson')
+            batch.append(models.LessonProgress(**row))
+            if len(batch) >= batch_size:
+                created += len(models.LessonProgress.objects.bulk_create(batch))
+                batch = []
+        created += len(models.LessonProgress.objects.bulk_create(batch))
+    return created
+
+
+def study_days():
+    """Distinct (student, course, day) of the attempts history, in order.
+
+    Weekly summaries only tell the week, they count as a single day at its start.
+    """
+    recent = (models.LessonStudent.objects
+              .annotate(day=TruncDate('date_time'))
+              .values_list('student', 'lesson__course', 'day')
+              .distinct()
+              .order_by('student', 'lesson__course', 'day'))
+    compacted = (models.LessonAttemptSummary.objects
+                 .annotate(day=TruncDate('period'))
+                 .values_list('student', 'lesson__course', 'day')
+                 .distinct()
+                 .order_by('student', 'lesson__course', 'day'))
+    for key, _ in itertools.groupby(heapq.merge(recent.iterator(), compacted.iterator())):
+        yield key
+
+
+def rebuild_course_progress(batch_size=1000):
+    """Recompute every CourseProgress row, streaks included.
+
+    Totals are summed up from the LessonProgress rows, so rebuild those first; streaks are
+    replayed from the attempts history.
+    """
+    totals = (models.LessonProgress.objects
+              .values('student', 'lesson__course')
+              .annotate(lessons_attempted=Count('id'),
+                        attempts_count=Sum('attempts_count'),
+                        points_total=Sum('points_total'),
+                        elapsed_time_total=Sum('elapsed_time_total'),
+                        mistakes_total=Sum('mistakes_total'),
+                        last_date_time=Max('last_date_time'))
+              .order_by('student', 'lesson__course'))
+
+    streaks = {}
+    for student_id, course_id, day in study_days():
+        last_study_date, current, longest = streaks.get((student_id, course_id), (None, 0, 0))
+        current = next_streak(last_study_date, current, day)
+        streaks[student_id, course_id] = (day, current, max(longest, current))
+
+    created = 0
+    with transaction.atomic():
+        models.CourseProgress.objects.all().delete()
+        batch = []
+        for row in totals.iterator():
+            row['student_id'] = row.pop('student')
+            row['course_id'] = row.pop('lesson__course')
+            (row['last_study_date'], row['current_streak'],
+             row['longest_streak']) = streaks.get((row['student_id'], row['course_id']), (None, 0, 0))
+            batch.append(models.CourseProgress(**row))
+            if len(batch) >= batch_size:
+                created += len(models.CourseProgress.objects.bulk_create(batch))
+                batch = []
+        created += len(models.CourseProgress.objects.bulk_create(batch))
+    return created
+
+
+def lesson_mastery(student, course_id):
+    """{lesson_id: number of questions the student has reviewed right enough times in a row}."""
+    return dict(models.QuestionStudent.objects
+                .filter(student=student,
+                        question__lesson__course_id=course_id,
+                        question__lesson__deleted_at=None,
+                        repetitions__gte=review.MASTERED_REPETITIONS)
+                .values('question__lesson')
+                .annotate(mastered=Count('id'))
+                .values_list('question__lesson', 'mastered')
+                .order_by())
+
+
+def hardest_questions(student, course_id, limit=HARDEST_QUESTIONS):
+    return list(models.QuestionStudent.objects
+                .filter(student=student, question__lesson__course_id=course_id, question__lesson__deleted_at=None,
+                        mistakes_count__gt=0)
+                .order_by('-mistakes_count')
+                .values('question__question_text', 'question__answer_text', 'question__lesson__name',
+                        'mistakes_count')[:limit])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Deletion of lessons.
+
+Deleting a lesson only stamps Lesson.deleted_at, which hides it everywhere at once, and
+queues a purge for when the undo window (YOURVOCAB_LESSON_UNDO_SECONDS) is over. The
+purge removes the rows of the lesson table by table, leaf tables first, in batches of
+bounded size with one short transaction each, and the lesson row last. The rows left are
+the only progress there is, so an interrupted purge carries on where it stopped.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from yourvocab import caching, jobs, models
+
+BATCH_SIZE = 1000
+# Rows a single purge job removes before it queues the rest of the work as a new job
+ROWS_PER_JOB = 20000
+# The worker may run on another machine than the web process; purge a bit after the window
+CLOCK_MARGIN_SECONDS = 60
+
+# (description, model, filter by lesson id) of the rows removed ahead of the lesson row
+DEPENDENTS = (
+    ('question statistics', models.QuestionStudent, 'question__lesson_id'),
+    ('questions', models.Question, 'lesson_id'),
+    ('attempts', models.LessonStudent, 'lesson_id'),
+    ('attempt summaries', models.LessonAttemptSummary, 'lesson_id'),
+    ('progress rows', models.LessonProgress, 'lesson_id'),
+    ('catalog terms', models.CatalogTerm, 'lesson_id'),
+)
+
+
+def undo_seconds():
+    return settings.YOURVOCAB_LESSON_UNDO_SECONDS
+
+
+def purge_cutoff(now=None):
+    """Lessons deleted before this moment can no longer be restored."""
+    now = now or timezone.now()
+    return now - datetime.timedelta(seconds=undo_seconds() + CLOCK_MARGIN_SECONDS)
+
+
+def lessons_changed(course_id):
+    # The lesson count shows on the course lists, the lessons on the course pages
+    transaction.on_commit(lambda: caching.course_changed(course_id))
+    transaction.on_commit(lambda: caching.course_students_changed(course_id))
+
+
+def delete_lesson(lesson):
+    """Hide a lesson and queue its purge; a single UPDATE whatever the size of the lesson."""
+    with transaction.atomic():
+        deleted = (models.Lesson.objects
+                   .filter(pk=lesson.pk)
+                   .update(deleted_at=timezone.now()))
+        if deleted:
+            lessons_changed(lesson.course_id)
+            jobs.enqueue('purge_lesson', {'lesson_id': lesson.pk}, delay=undo_seconds() + CLOCK_MARGIN_SECONDS)
+    return bool(deleted)
+
+
+def restore_lesson(course_id, lesson_id):
+    """Bring a deleted lesson back while the undo window lasts; the queued purge then skips it."""
+    window_start = timezone.now() - datetime.timedelta(seconds=undo_seconds())
+    with transaction.atomic():
+        restored = (models.Lesson.all_objects
+                    .filter(pk=lesson_id, course_id=course_id, deleted_at__gt=window_start)
+                    .update(deleted_at=None))
+        if restored:
+            lessons_changed(course_id)
+    return bool(restored)
+
+
+def purgeable(lesson_id, cutoff):
+    return models.Lesson.all_objects.filter(pk=lesson_id, deleted_at__lte=cutoff)
+
+
+def purge_batch(lesson_id, cutoff, batch_size=BATCH_SIZE):
+    """Remove up to `batch_size` rows of a deleted lesson, the lesson row once nothing else is left.
+
+    Returns (description, number of rows removed); (None, 0) when there is nothing to purge.
+    """
+    with transaction.atomic():
+        # Locks the lesson row, so a purge does not run twice at once
+        if not purgeable(lesson_id, cutoff).select_for_update().exists():
+            return None, 0
+        for description, model, lesson_field in DEPENDENTS:
+            ids = list(model.objects
+                       .filter(**{lesson_field: lesson_id})
+                       .values_list('pk', flat=True)[:batch_size])
+            if ids:
+                batch = model.objects.filter(pk__in=ids)
+                # The collector would look for dependent rows that are already gone
+                batch._raw_delete(batch.db)
+                return description, len(ids)
+        purgeable(lesson_id, cutoff).delete()
+        return 'lesson', 1
+
+
+def purge_lesson(lesson_id, cutoff=None, batch_size=BATCH_SIZE, max_rows=None, progress=None):
+    """Purge a deleted lesson, at most `max_rows` rows of it; returns True when it is gone.
+
+    `progress` is called with (description, rows) after every batch.
+    """
+    cutoff = cutoff or purge_cutoff()
+    removed = 0
+    while max_rows is None or removed < max_rows:
+        description, count = purge_batch(lesson_id, cutoff, batch_size)
+        if description is None:
+            return True
+        if progress:
+            progress(description, count)
+        if description == 'lesson':
+            return True
+        removed += count
+    return False
+
+
+@jobs.handler('purge_lesson')
+def purge_lesson_jobs(payloads):
+    """Purge job handler; a batch of jobs removes about ROWS_PER_JOB rows between them.
+
+    run_pending calls it outside of any transaction, so every batch commits on its own.
+    The work of one job is bounded to finish well within the job lease, and the rest is
+    queued as a new job.
+    """
+    share = max(BATCH_SIZE, ROWS_PER_JOB // len(payloads))
+    for payload in payloads:
+        if not purge_lesson(payload['lesson_id'], max_rows=share):
+            jobs.enqueue('purge_lesson', payload)
+    return [None] * len(payloads)
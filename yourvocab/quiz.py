@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+import datetime
+import hashlib
+import json
+import random
+
+from django.conf import settings
+from django.core import signing
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from yourvocab import caching, matching, models, review
+
+PAYLOAD_TIMEOUT = 24 * 60 * 60
+
+RUN_SALT = 'yourvocab.quiz.run'
+RUN_MAX_AGE = 24 * 60 * 60
+
+# What SignedRun.claim found
+CLAIMED = 'claimed'
+REPEATED = 'repeated'
+REUSED = 'reused'
+
+# Digest of the claim that closes an abandoned run, which no request has
+CLOSED = 'closed'
+
+
+def payload_key(lesson_id, version):
+    return F'yourvocab:lesson-payload:{lesson_id}:{version}:keyed'
+
+
+def lesson_payload(lesson_id, version):
+    """Return [(id, question_text, answer_text, answer_key), ...] of a lesson in the editor order.
+
+    The list is cached per lesson version, so saving the lesson makes the old payload unreachable.
+    None is returned when the lesson has changed since `version`.
+    """
+    cache = caching.get_cache()
+    key = payload_key(lesson_id, version)
+    payload = cache.get(key)
+    if payload is not None:
+        return payload
+
+    if not models.Lesson.objects.filter(pk=lesson_id, version=version).exists():
+        return None
+
+    payload = list(models.Question.objects
+                   .filter(lesson_id=lesson_id)
+                   .order_by('position', 'id')
+                   .values_list('id', 'question_text', 'answer_text', 'answer_key'))
+    cache.set(key, payload, PAYLOAD_TIMEOUT)
+    return payload
+
+
+def invalidate_payload(lesson_id, version):
+    caching.get_cache().delete(payload_key(lesson_id, version))
+
+
+def is_correct(answer_text, answer_key, answer):
+    if not answer_key:
+        # Saved before answer keys existed
+        return answer_text.strip() == answer.strip()
+    return matching.matches(answer_key, answer)
+
+
+def add_mistakes(student, deltas):
+    """Add {question_id: count} to the student's mistake counters.
+
+    Existing counters are bumped with a single UPDATE; questions the student has never
+    missed before get their row created at zero and are bumped by a second one, so a row
+    another request creates meanwhile still gets the count.
+    """
+    if not deltas:
+        return 0
+    increment = Case(*[When(question_id=question_id, then=Value(count)) for question_id, count in deltas.items()],
+                     default=Value(0), output_field=IntegerField())
+    updated = (models.QuestionStudent.objects
+               .filter(student=student, question_id__in=list(deltas))
+               .update(mistakes_count=F('mistakes_count') + increment))
+    if updated < len(deltas):
+        existing = set(models.QuestionStudent.objects
+                       .filter(student=student, question_id__in=list(deltas))
+                       .values_list('question_id', flat=True))
+        missing = [question_id for question_id in deltas if question_id not in existing]
+        models.QuestionStudent.objects.bulk_create(
+            [models.QuestionStudent(question_id=question_id, student=student, mistakes_count=0)
+             for question_id in missing],
+            ignore_conflicts=True)
+        (models.QuestionStudent.objects
+         .filter(student=student, question_id__in=missing)
+         .update(mistakes_count=F('mistakes_count') + increment))
+    return len(deltas)
+
+
+class SignedRun:
+    """Run state carried between requests in a signed token rather than on the server.
+
+    Every request that changes the run hands the client a new token, and a token can be
+    used only once (see claim), so an answer cannot be replayed.
+    """
+    SALT = None
+
+    @classmethod
+    def from_token(cls, token):
+        """Raises signing.BadSignature for forged or expired tokens."""
+        return cls(**signing.loads(token, salt=cls.SALT, max_age=RUN_MAX_AGE))
+
+    def state(self):
+        return {name: value for name, value in vars(self).items() if not name.startswith('_')}
+
+    def token(self):
+        return signing.dumps(self.state(), salt=self.SALT, compress=True)
+
+    def buffered(self):
+        """Mistakes held in the run rather than written, as JSON; kept with the claims."""
+        return ''
+
+    def claim(self, digest):
+        """Mark the current token as used by the request with `digest` (see request_digest).
+
+        Returns CLAIMED the first time, REPEATED when the token has been used by the same
+        request already (a client sending it again after losing the response) and REUSED
+        when another request used it. Call it in the transaction that records the request,
+        so that the token is used exactly when the request has been recorded. The claims
+        are rows rather than cache entries to hold across processes.
+        """
+        try:
+            with transaction.atomic():
+                models.RunClaim.objects.create(run_id=self.run_id, seq=self.seq, digest=digest,
+                                               student_id=self.user_id, pending=self.buffered())
+        except IntegrityError:
+            used = models.RunClaim.objects.filter(run_id=self.run_id, seq=self.seq).values_list('digest', flat=True)
+            return REPEATED if list(used) == [digest] else REUSED
+        return CLAIMED
+
+
+def request_digest(*values):
+    """Digest of what a run request sent, for SignedRun.claim."""
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def flush_abandoned(student=None, claimed_before=None):
+    """Write the mistakes buffered by QuizRuns left unfinished.
+
+    Either the runs of `student`, who is starting another one, or those last claimed before
+    `claimed_before`, whose tokens have expired. Every flushed run gets one more claim,
+    so a tab still answering it gets a conflict rather than writing its mistakes again.
+    Returns the number of runs flushed.
+    """
+    claims = models.RunClaim.objects.exclude(pending='')
+    if student is not None:
+        claims = claims.filter(student=student)
+    if claimed_before is not None:
+        claims = claims.filter(claimed_at__lt=claimed_before)
+
+    # The buffer only grows until the run finishes, so the latest claim of a run holds it all
+    latest = {}
+    for run_id, seq, student_id, pending, claimed_at in (models.RunClaim.objects
+                                                         .filter(run_id__in=claims.values('run_id'))
+                                                         .values_list('run_id', 'seq', 'student_id', 'pending',
+                                                                      'claimed_at')):
+        if run_id not in latest or seq > latest[run_id][0]:
+            latest[run_id] = (seq, student_id, pending, claimed_at)
+
+    deltas = {}
+    flushed = 0
+    with transaction.atomic():
+        for run_id, (seq, student_id, pending, claimed_at) in latest.items():
+            if not pending or (claimed_before is not None and claimed_at >= claimed_before):
+                continue
+            try:
+                with transaction.atomic():
+                    models.RunClaim.objects.create(run_id=run_id, seq=seq + 1, digest=CLOSED, student_id=student_id)
+            except IntegrityError:
+                # The run has just been answered again; it is flushed with its next claim
+                continue
+            student_deltas = deltas.setdefault(student_id, {})
+            for question_id, count in json.loads(pending).items():
+                student_deltas[int(question_id)] = student_deltas.get(int(question_id), 0) + count
+            flushed += 1
+        for student_id, student_deltas in deltas.items():
+            add_mistakes(models.User(pk=student_id), student_deltas)
+    return flushed
+
+
+def expire_claims():
+    """Forget the claims of tokens too old to be accepted anyway; the run_jobs worker calls this.
+
+    The mistakes buffered by runs abandoned meanwhile are written first.
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=RUN_MAX_AGE)
+    if getattr(settings, 'YOURVOCAB_BUFFER_MISTAKES', False):
+        flush_abandoned(claimed_before=cutoff)
+    return models.RunClaim.objects.filter(claimed_at__lt=cutoff).delete()[0]
+
+
+class QuizRun(SignedRun):
+    """Lesson run answered one question per request, graded on the server.
+
+    Only counters and a shuffle seed are kept; the question order is derived from the seed
+    and the question content comes from the cached lesson payload, so an answer is graded
+    without the session or any query. Questions whose answer was shown are repeated at the
+    end of the run.
+
+    With YOURVOCAB_BUFFER_MISTAKES enabled, per-question mistakes are collected in the run
+    and written once, when the run is finished. Each claim keeps the buffer too, so those of
+    an abandoned run are written when the student starts another one or when its token
+    expires (see flush_abandoned).
+    """
+    SALT = 'yourvocab.quiz.answers'
+
+    def __init__(self, user_id, lesson_id, version, run_id, count, seed, bonus, wrong_a_penalty, show_a_penalty,
+                 start_time, seq=0, index=0, score=0, mistakes_count=0, repeats=None, missed=None, pending=None):
+        self.user_id = user_id
+        self.lesson_id = lesson_id
+        self.version = version
+        self.run_id = run_id
+        self.count = count
+        self.seed = seed
+        self.bonus = bonus
+        self.wrong_a_penalty = wrong_a_penalty
+        self.show_a_penalty = show_a_penalty
+        self.start_time = start_time
+        self.seq = seq
+        self.index = index
+        self.score = score
+        self.mistakes_count = mistakes_count
+        self.repeats = repeats or []
+        self.missed = missed or []
+        self.pending = pending or {}
+        self._order = None
+
+    @classmethod
+    def start(cls, user, lesson, setup, count):
+        return cls(user_id=user.id,
+                   lesson_id=lesson.id,
+                   version=lesson.version,
+                   run_id='%016x' % random.getrandbits(64),
+                   count=count,
+                   seed=random.getrandbits(32),
+                   bonus=setup.answer_bonus,
+                   wrong_a_penalty=setup.mistake_penalty,
+                   show_a_penalty=setup.show_answer_penalty,
+                   start_time=datetime.datetime.now().timestamp())
+
+    @property
+    def order(self):
+        if self._order is None:
+            self._order = list(range(self.count))
+            random.Random(self.seed).shuffle(self._order)
+        return self._order
+
+    @property
+    def total(self):
+        return self.count + len(self.repeats)
+
+    @property
+    def is_last(self):
+        return self.index >= self.total - 1
+
+    def position(self, index=None):
+        """Position in the lesson payload of the question asked at `index` (the current one by default)."""
+        index = self.index if index is None else index
+        return self.order[index] if index < self.count else self.repeats[index - self.count]
+
+    def repeat_current(self):
+        self.repeats.append(self.position())
+
+    def miss_current(self):
+        if self.position() not in self.missed:
+            self.missed.append(self.position())
+
+    def quality(self):
+        """Review quality of the current question once it is answered right."""
+        position = self.position()
+        return review.quality(position in self.missed, position in self.repeats)
+
+    def answer(self, target, answer, show_answer=False, no_score_upd=False):
+        """Grade an answer to the current question, `target` being its payload row.
+
+        Returns whether the run moves on from the question, with the mistakes to write
+        {question_id: count} and the review qualities {question_id: quality} like
+        BatchRun.apply. `no_score_upd` moves on without grading, after a shown answer.
+        """
+        self.seq += 1
+        if no_score_upd:
+            return True, {}, {}
+
+        question_id, _, answer_text, answer_key = target
+        if show_answer:
+            self.repeat_current()
+            self.score -= self.show_a_penalty
+            return False, self.record_mistake(question_id), {}
+
+        if is_correct(answer_text, answer_key, answer):
+            self.score += self.bonus
+            return True, {}, {question_id: self.quality()}
+
+        self.miss_current()
+        self.score -= self.wrong_a_penalty
+        return False, self.record_mistake(question_id), {}
+
+    def record_mistake(self, question_id):
+        """Count a mistake; returns it to be written now unless it is buffered."""
+        self.mistakes_count += 1
+        if getattr(settings, 'YOURVOCAB_BUFFER_MISTAKES', False):
+            # Token data goes through JSON, so the keys are kept as strings
+            key = str(question_id)
+            self.pending[key] = self.pending.get(key, 0) + 1
+            return {}
+        return {question_id: 1}
+
+    def buffered(self):
+        return json.dumps(self.pending) if self.pending else ''
+
+    def take_pending(self, mistakes):
+        """Add the buffered mistakes to `mistakes`, to be written at the end of the run."""
+        for question_id, count in self.pending.items():
+            mistakes[int(question_id)] = mistakes.get(int(question_id), 0) + count
+        self.pending = {}
+        return mistakes
+
+
+class BatchRun(SignedRun):
+    """Lesson run graded on the client.
+
+    The client gets the whole shuffled lesson at once and posts its events (answers and
+    "show answer" clicks) in batches. Every batch is regraded against the lesson payload,
+    and a new token with the updated counters is handed back.
+    """
+    SALT = RUN_SALT
+
+    def __init__(self, user_id, lesson_id, version, run_id, start_time, bonus, wrong_a_penalty, show_a_penalty,
+                 seq=0, score=0, mistakes_count=0, done=0, missed=0, shown=0, current=None):
+        self.user_id = user_id
+        self.lesson_id = lesson_id
+        self.version = version
+        self.run_id = run_id
+        self.start_time = start_time
+        self.bonus = bonus
+        self.wrong_a_penalty = wrong_a_penalty
+        self.show_a_penalty = show_a_penalty
+        self.seq = seq
+        self.score = score
+        self.mistakes_count = mistakes_count
+        # Bit masks over the payload positions of the questions answered right, answered wrong
+        # and with the answer shown
+        self.done = done
+        self.missed = missed
+        self.shown = shown
+        # Payload position of a question answered wrong, which the client keeps asking until
+        # it is answered right or its answer is shown
+        self.current = current
+
+    @classmethod
+    def start(cls, user, lesson, setup):
+        return cls(user_id=user.id,
+                   lesson_id=lesson.id,
+                   version=lesson.version,
+                   run_id='%016x' % random.getrandbits(64),
+                   start_time=datetime.datetime.now().timestamp(),
+                   bonus=setup.answer_bonus,
+                   wrong_a_penalty=setup.mistake_penalty,
+                   show_a_penalty=setup.show_answer_penalty)
+
+    def client_data(self, payload):
+        """Everything the client needs to run the lesson on its own."""
+        questions = [{'id': question_id, 'question': question_text, 'answer': answer_text, 'key': answer_key}
+                     for (question_id, question_text, answer_text, answer_key) in payload]
+        random.shuffle(questions)
+        return {'token': self.token(),
+                'questions': questions,
+                'bonus': self.bonus,
+                'wrong_a_penalty': self.wrong_a_penalty,
+                'show_a_penalty': self.show_a_penalty}
+
+    def apply(self, payload, events):
+        """Regrade a batch of events.
+
+        Returns the per-question mistakes {question_id: count} and the review qualities
+        {question_id: quality} of the questions answered right for the first time.
+
+        An event is {"question": <id>, "answer": <text>} or {"question": <id>, "show_answer": true}.
+        A question takes events until it is answered right, so the bonus is given once per
+        question; after a wrong answer the next event is about the same question, like the
+        client asks it. Raises ValueError for malformed events, questions outside the lesson
+        and events out of that order.
+        """
+        positions = {question_id: position for position, (question_id, *_) in enumerate(payload)}
+        mistakes = {}
+        outcomes = {}
+        for event in events:
+            try:
+                position = positions[event['question']]
+            except (KeyError, TypeError):
+                raise ValueError('Unknown question')
+
+            question_id, _, answer_text, answer_key = payload[position]
+            bit = 1 << position
+            if self.done & bit:
+                raise ValueError('The question has been answered already')
+            if self.current is not None and self.current != position:
+                raise ValueError('Another question is being answered')
+            if event.get('show_answer'):
+                self.score -= self.show_a_penalty
+                self.shown |= bit
+                self.current = None
+            elif is_correct(answer_text, answer_key, str(event.get('answer', ''))):
+                self.score += self.bonus
+                self.done |= bit
+                self.current = None
+                outcomes[question_id] = review.quality(self.missed & bit, self.shown & bit)
+                continue
+            else:
+                self.score -= self.wrong_a_penalty
+                self.missed |= bit
+                self.current = position
+
+            self.mistakes_count += 1
+            mistakes[question_id] = mistakes.get(question_id, 0) + 1
+
+        self.seq += 1
+        return mistakes, outcomes
+
+    def is_complete(self, payload):
+        return self.done == (1 << len(payload)) - 1
+
+
+class ReviewRun(BatchRun):
+    """Client-graded run over a fixed set of due items from any of the student's courses."""
+    SALT = 'yourvocab.quiz.review'
+
+    def __init__(self, question_ids, **kwargs):
+        super().__init__(**kwargs)
+        self.question_ids = question_ids
+
+    @classmethod
+    def start(cls, user, items):
+        return cls(question_ids=[question_id for (question_id, *_) in items],
+                   user_id=user.id,
+                   lesson_id=None,
+                   version=None,
+                   run_id='%016x' % random.getrandbits(64),
+                   start_time=datetime.datetime.now().timestamp(),
+                   bonus=1,
+                   wrong_a_penalty=0,
+                   show_a_penalty=0)
+
+    def payload(self):
+        """Question content in the run order, or None if some of the items have been deleted."""
+        questions = models.Question.objects.in_bulk(self.question_ids)
+        if len(questions) != len(self.question_ids):
+            return None
+        return [(question_id, questions[question_id].question_text, questions[question_id].answer_text,
+                 questions[question_id].answer_key)
+                for question_id in self.question_ids]
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Retention of the attempt history.
+
+Every finished run adds a LessonStudent row. Rows older than YOURVOCAB_ATTEMPTS_RAW_DAYS
+are compacted into LessonAttemptSummary rows, one per student, lesson and day (or week,
+see YOURVOCAB_ATTEMPTS_SUMMARY), and deleted. With YOURVOCAB_ATTEMPTS_ARCHIVE_DIR set they
+are written to a gzipped JSON Lines file there first. The statistics and the progress
+rebuilds read both tables, so old history is kept, only coarser.
+
+Only whole periods before the retention boundary are compacted. The old rows are taken
+by id in batches, each folded into the summaries and deleted in a transaction of its own,
+so compaction can be stopped and started again at any time.
+"""
+import datetime
+import gzip
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from yourvocab import exporting, models
+
+BATCH_SIZE = 5000
+
+ARCHIVE_FIELDS = ('id', 'student_id', 'lesson_id', 'date_time', 'elapsed_time', 'points', 'mistakes_count')
+SUMMARY_FIELDS = ('count', 'points_total', 'points_min', 'points_max', 'elapsed_time_total', 'mistakes_total',
+                  'last_date_time', 'last_points')
+
+
+def period_start(date_time, granularity):
+    """Start of the day or week (from Monday, like TruncWeek) of `date_time`, in TIME_ZONE."""
+    day = timezone.localtime(date_time).date()
+    if granularity == models.LessonAttemptSummary.WEEK:
+        day -= datetime.timedelta(days=day.weekday())
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time()))
+
+
+def compaction_cutoff(keep_days, granularity, now=None):
+    """Attempts before this moment are compacted: the start of the period `keep_days` ago."""
+    now = now or timezone.now()
+    return period_start(now - datetime.timedelta(days=keep_days), granularity)
+
+
+def fold(summary, other):
+    """Add the attempts of `other` into `summary`."""
+    summary.count += other.count
+    summary.points_total += other.points_total
+    summary.points_min = min(summary.points_min, other.points_min)
+    summary.points_max = max(summary.points_max, other.points_max)
+    summary.elapsed_time_total += other.elapsed_time_total
+    summary.mistakes_total += other.mistakes_total
+    if other.last_date_time > summary.last_date_time:
+        summary.last_date_time = other.last_date_time
+        summary.last_points = other.last_points
+
+
+def summarize(rows, granularity):
+    """Fold attempts, given as ARCHIVE_FIELDS tuples, into the stored summaries of their periods."""
+    summaries = {}
+    for _, student_id, lesson_id, date_time, elapsed_time, points, mistakes_count in rows:
+        attempt = models.LessonAttemptSummary(student_id=student_id,
+                                              lesson_id=lesson_id,
+                                              granularity=granularity,
+                                              period=period_start(date_time, granularity),
+                                              count=1,
+                                              points_total=points,
+                                              points_min=points,
+                                              points_max=points,
+                                              elapsed_time_total=elapsed_time,
+                                              mistakes_total=mistakes_count,
+                                              last_date_time=date_time,
+                                              last_points=points)
+        key = (student_id, lesson_id, attempt.period)
+        if key in summaries:
+            fold(summaries[key], attempt)
+        else:
+            summaries[key] = attempt
+
+    # A period may have been started by an earlier batch
+    stored = (models.LessonAttemptSummary.objects
+              .select_for_update()
+              .filter(granularity=granularity,
+                      student_id__in={student_id for (student_id, _, _) in summaries},
+                      lesson_id__in={lesson_id for (_, lesson_id, _) in summaries},
+                      period__in={period for (_, _, period) in summaries}))
+    updated = []
+    for summary in stored:
+        new = summaries.pop((summary.student_id, summary.lesson_id, summary.period), None)
+        if new is not None:
+            fold(summary, new)
+            updated.append(summary)
+
+    models.LessonAttemptSummary.objects.bulk_update(updated, SUMMARY_FIELDS)
+    models.LessonAttemptSummary.objects.bulk_create(summaries.values())
+    return len(updated) + len(summaries)
+
+
+def open_archive(archive_dir, now):
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, F'attempts-{now:%Y%m%dT%H%M%S}.jsonl.gz')
+    return path, gzip.open(path, 'at', encoding='utf-8')
+
+
+def compact(keep_days=None, granularity=None, archive_dir=None, batch_size=BATCH_SIZE, now=None, progress=None):
+    """Compact the attempts older than `keep_days` into summaries; returns the number of attempts compacted.
+
+    Settings supply the arguments left out. `progress` is called with the running total
+    after every batch. Archived rows are flushed before their batch commits, so a crash
+    can only repeat rows in the archive (they carry their ids), never lose them.
+    """
+    keep_days = settings.YOURVOCAB_ATTEMPTS_RAW_DAYS if keep_days is None else keep_days
+    granularity = granularity or settings.YOURVOCAB_ATTEMPTS_SUMMARY
+    archive_dir = settings.YOURVOCAB_ATTEMPTS_ARCHIVE_DIR if archive_dir is None else archive_dir
+    now = now or timezone.now()
+    cutoff = compaction_cutoff(keep_days, granularity, now)
+
+    archive = None
+    if archive_dir:
+        path, archive = open_archive(archive_dir, now)
+    compacted = 0
+    last_id = 0
+    try:
+        while True:
+            with transaction.atomic():
+                rows = list(models.LessonStudent.objects
+                            .filter(date_time__lt=cutoff, id__gt=last_id)
+                            .order_by('id')
+                            .values_list(*ARCHIVE_FIELDS)[:batch_size])
+                if not rows:
+                    break
+                summarize(rows, granularity)
+                if archive:
+                    archive.writelines(exporting.jsonl_lines([('attempt', ARCHIVE_FIELDS, rows)]))
+                    archive.flush()
+                done = models.LessonStudent.objects.filter(id__in=[row[0] for row in rows])
+                # Nothing refers to attempts, no need for the cascade collector
+                done._raw_delete(done.db)
+
+            last_id = rows[-1][0]
+            compacted += len(rows)
+            if progress:
+                progress(compacted)
+    finally:
+        if archive:
+            archive.close()
+            if not compacted:
+                os.remove(path)
+    return compacted
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from django.utils import timezone
+
+from yourvocab import models
+
+MIN_EASE = 1.3
+
+# Answer qualities on the SM-2 0..5 scale
+QUALITY_PERFECT = 5
+QUALITY_AFTER_MISTAKE = 3
+QUALITY_SHOWN = 1
+
+# An item counts as mastered after this many right reviews in a row
+MASTERED_REPETITIONS = 3
+
+REVIEW_SIZE = 20
+MAX_REVIEW_SIZE = 100
+
+
+def quality(missed, shown):
+    """Grade a question that has finally been answered right."""
+    if shown:
+        return QUALITY_SHOWN
+    if missed:
+        return QUALITY_AFTER_MISTAKE
+    return QUALITY_PERFECT
+
+
+def sm2(ease, interval, repetitions, quality):
+    """Return the next (ease, interval in days, repetitions) of an item after a review."""
+    if quality < 3:
+        repetitions, interval = 0, 1
+    else:
+        repetitions += 1
+        if repetitions == 1:
+            interval = 1
+        elif repetitions == 2:
+            interval = 6
+        else:
+            interval = round(interval * ease)
+    ease = max(MIN_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return ease, interval, repetitions
+
+
+def schedule(student, outcomes, now=None):
+    """Reschedule the student's items from {question_id: quality}.
+
+    Takes a select and a bulk update, plus a bulk insert for the questions the student
+    sees for the first time.
+    """
+    if not outcomes:
+        return
+    now = now or timezone.now()
+
+    rows = list(models.QuestionStudent.objects.filter(student=student, question_id__in=list(outcomes)))
+    seen = {row.question_id for row in rows}
+    new_rows = [models.QuestionStudent(question_id=question_id, student=student)
+                for question_id in outcomes if question_id not in seen]
+    for row in rows + new_rows:
+        row.ease, row.interval, row.repetitions = sm2(row.ease, row.interval, row.repetitions,
+                                                      outcomes[row.question_id])
+        row.due = now + datetime.timedelta(days=row.interval)
+    if rows:
+        models.QuestionStudent.objects.bulk_update(rows, ['ease', 'interval', 'repetitions', 'due'])
+    if new_rows:
+        models.QuestionStudent.objects.bulk_create(new_rows, ignore_conflicts=True)
+
+
+def due_items(student, limit=REVIEW_SIZE, now=None):
+    """The student's most overdue items from every course they are enrolled in.
+
+    Walks the (student, due) index in due order and stops after `limit` rows, so the cost
+    does not depend on how many items the student has.
+    """
+    now = now or timezone.now()
+    return list(models.QuestionStudent.objects
+                .filter(student=student,
+                        due__lte=now,
+                        question__lesson__deleted_at=None,
+                        question__lesson__course__coursestudent__student=student)
+                .order_by('due')
+                .values_list('question_id', 'question__question_text', 'question__answer_text',
+                             'question__answer_key')[:limit])
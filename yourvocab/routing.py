@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Read replica routing.
+
+Views opt in with @replica_reads; their reads go to the YOURVOCAB_REPLICA database
+alias when it is configured, everything else (and every write) uses the primary. A
+user who has just written something is pinned to the primary for
+YOURVOCAB_STICKY_SECONDS by a cookie, so they never read their own changes from a
+lagging replica.
+"""
+import contextvars
+import functools
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+STICKY_COOKIE = 'yourvocab_primary'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+read_alias = contextvars.ContextVar('yourvocab_read_alias', default=None)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # Objects read from the replica must still be saved to the primary
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != settings.YOURVOCAB_REPLICA
+
+
+def replica_alias(request):
+    """The alias reads of this request may go to, or None for the primary."""
+    alias = settings.YOURVOCAB_REPLICA
+    if alias not in settings.DATABASES:
+        return None
+    if request.method not in SAFE_METHODS or STICKY_COOKIE in request.COOKIES:
+        return None
+    return alias
+
+
+def streamed_with(alias, content):
+    """Keep reading from `alias` while a streaming response is sent.
+
+    The alias is set around each piece rather than the whole stream: under ASGI the pieces
+    are read by separate calls in the thread of the request, each in a context of its own.
+    """
+    content = iter(content)
+    while True:
+        token = read_alias.set(alias)
+        try:
+            piece = next(content, None)
+        finally:
+            read_alias.reset(token)
+        if piece is None:
+            return
+        yield piece
+
+
+def replica_reads(view):
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        alias = replica_alias(request)
+        if alias is None:
+            return view(request, *args, **kwargs)
+
+        token = read_alias.set(alias)
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            read_alias.reset(token)
+        if response.streaming:
+            response.streaming_content = streamed_with(alias, response.streaming_content)
+        return response
+    return wrapper
+
+
+class StickyPrimaryMiddleware:
+    """Pins the user to the primary for a while after any request that may have written."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.pin(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.pin(request, await self.get_response(request))
+
+    def pin(self, request, response):
+        if request.method not in SAFE_METHODS and settings.YOURVOCAB_REPLICA in settings.DATABASES:
+            response.set_cookie(STICKY_COOKIE, '1', max_age=settings.YOURVOCAB_STICKY_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
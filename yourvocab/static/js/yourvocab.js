@@ -1,39 +1,58 @@
 "use strict";
 
+function showResponse(resp) {
+    if (resp['result'] === 'ok') {
+        $('#hint_row').hide();
+        if (resp['last']) {
+            $('#RespondingPart').hide();
+        } else {
+            $('#RespondingPart').show();
+        }
+        $('#mistake_field').hide();
+        $('#Question').text(resp['question']);
+        $('#answer_field').val('');
+    } else if (resp['result'] === 'show_answer') {
+        $('#RespondingPart').hide();
+        $('#mistake_field').hide();
+        $('#hint_field').text(resp['answer']);
+        $('#hint_row').show()
+    } else if (resp['result'] === 'mistake') {
+        $('#hint_row').hide();
+        $('#mistake_field').show();
+        $('#RespondingPart').show();
+    } else if (resp['result'] === 'expired') {
+        window.location.reload();
+        return;
+    } else {
+        alert(JSON.stringify(resp));
+    }
+
+    $('#score_field').text(resp['score']);
+}
+
+// A run token can be sent only once, so one answer at a time
+var answerPending = false;
+
 function submitForm(show_answer, no_upd) {
+    if (batchRun !== null) {
+        return batchAnswer(show_answer, no_upd);
+    }
+    if (answerPending) {
+        return false;
+    }
+    answerPending = true;
     var oFormElement = $('#test_form').get(0);
-    console.log(oFormElement);
     var xhr = new XMLHttpRequest();
     xhr.onload = function () {
+        answerPending = false;
         var resp = JSON.parse(xhr.responseText);
-        if (resp['result'] === 'ok') {
-            $('#hint_row').hide();
-            if (resp['last']) {
-                $('#RespondingPart').hide();
-            } else {
-                $('#RespondingPart').show();
-            }
-            $('#mistake_field').hide();
-            $('#Question').text(resp['question']);
-            $('#answer_field').val('');
-        } else if (resp['result'] === 'show_answer') {
-            $('#RespondingPart').hide();
-            $('#mistake_field').hide();
-            $('#hint_field').text(resp['answer']);
-            $('#hint_row').show()
-        } else if (resp['result'] === 'mistake') {
-            $('#hint_row').hide();
-            $('#mistake_field').show();
-            $('#RespondingPart').show();
-        } else {
-            alert(xhr.responseText);
+        if (resp['token']) {
+            $('#test_form input[name=token]').val(resp['token']);
         }
-
-        $('#score_field').text(resp['score']);
-
-        console.log(xhr.responseText)
+        showResponse(resp);
     }; // success case
     xhr.onerror = function () {
+        answerPending = false;
         alert(xhr.responseText);
         console.log(xhr.responseText)
     }; // failure case
@@ -41,11 +60,236 @@ function submitForm(show_answer, no_upd) {
     var fd = new FormData(oFormElement);
     fd.append('show_answer', show_answer);
     fd.append('no_score_upd', no_upd);
-    console.log(fd.entries());
     xhr.send(fd);
     return false;
 }
 
+// Lesson run graded in the browser: answers are checked locally and sent to the server in batches.
+var BATCH_SIZE = 20;
+// Seconds before sending a batch again after a failure, the last one repeating
+var RETRY_DELAYS = [1, 2, 4, 8, 15, 30, 60];
+var batchRun = null;
+
+function startBatchRun(data, url) {
+    batchRun = {
+        url: url,
+        token: data['token'],
+        queue: data['questions'],
+        index: 0,
+        score: 0,
+        bonus: data['bonus'],
+        wrong_a_penalty: data['wrong_a_penalty'],
+        show_a_penalty: data['show_a_penalty'],
+        events: [],
+        // The batch on its way or to be sent again, as it was first sent
+        unsent: null,
+        sending: false,
+        failures: 0,
+        retry: null,
+        finished: false,
+        saved: false
+    };
+    window.addEventListener('online', function () {
+        if (batchRun.unsent !== null && !batchRun.sending) {
+            flushBatch(batchRun.finished);
+        }
+    });
+    window.addEventListener('beforeunload', function (event) {
+        if (batchRun.finished && !batchRun.saved) {
+            event.preventDefault();
+            event.returnValue = '';
+        }
+    });
+}
+
+function flushBatch(finish) {
+    var run = batchRun;
+    if (run.sending) {
+        return;
+    }
+    if (run.unsent === null) {
+        if (!finish && run.events.length === 0) {
+            return;
+        }
+        run.unsent = {'token': run.token, 'events': run.events, 'finish': finish};
+        run.events = [];
+    }
+    if (run.retry !== null) {
+        clearTimeout(run.retry);
+        run.retry = null;
+    }
+    run.sending = true;
+
+    var xhr = new XMLHttpRequest();
+    xhr.onload = function () {
+        if (xhr.status >= 500) {
+            // Proxies and crashed workers answer so as well, try again
+            retryBatch();
+            return;
+        }
+        var resp;
+        try {
+            resp = JSON.parse(xhr.responseText);
+        } catch (e) {
+            resp = {'result': 'error', 'status': xhr.status};
+        }
+        run.sending = false;
+        run.unsent = null;
+        run.failures = 0;
+        if (resp['result'] === 'ok') {
+            run.token = resp['token'];
+            if (run.finished || run.events.length >= BATCH_SIZE) {
+                flushBatch(run.finished);
+            }
+        } else if (resp['result'] === 'finished') {
+            run.saved = true;
+            $('#run_status').text('');
+        } else {
+            showResponse(resp);
+        }
+    };
+    xhr.onerror = retryBatch;
+    xhr.open('POST', run.url, true);
+    xhr.setRequestHeader('Content-Type', 'application/json');
+    xhr.setRequestHeader('X-CSRFToken', $('#test_form input[name=csrfmiddlewaretoken]').val());
+    // Sent again exactly as before: the server tells a repeated batch from a new one and
+    // answers it without recording it twice
+    xhr.send(JSON.stringify(run.unsent));
+}
+
+function retryBatch() {
+    var run = batchRun;
+    run.sending = false;
+    run.failures += 1;
+    var delay = RETRY_DELAYS[Math.min(run.failures, RETRY_DELAYS.length) - 1];
+    if (run.finished) {
+        $('#run_status').text(run.failures < RETRY_DELAYS.length
+            ? 'Saving your results...'
+            : 'Your results have not been saved yet. Keep this page open, they are sent as soon as you are online.');
+    }
+    run.retry = setTimeout(function () {
+        run.retry = null;
+        flushBatch(run.finished);
+    }, delay * 1000);
+}
+
+// Answer matching, the same rules as yourvocab/matching.py
+function normalizeAnswer(text, ignore_case, ignore_diacritics) {
+    text = text.trim().split(/\s+/).join(' ');
+    if (ignore_case) {
+        // JavaScript has no str.casefold(); going through upper case folds 'ß' to 'ss' likewise
+        text = text.toUpperCase().toLowerCase();
+    }
+    if (ignore_diacritics) {
+        text = text.normalize('NFKD').replace(/\p{Mn}/gu, '').normalize('NFC');
+    }
+    return text;
+}
+
+function withinDistance(a, b, limit) {
+    a = Array.from(a);
+    b = Array.from(b);
+    if (Math.abs(a.length - b.length) > limit) {
+        return false;
+    }
+    if (limit === 0) {
+        return a.join('') === b.join('');
+    }
+    var over = limit + 1, width = 2 * limit + 1, previous = [], current, i, d, j, best;
+    for (d = 0; d < width; d++) {
+        j = d - limit;
+        previous.push(j >= 0 && j <= b.length ? j : over);
+    }
+    for (i = 1; i <= a.length; i++) {
+        current = [];
+        for (d = 0; d < width; d++) {
+            current.push(over);
+            j = i - limit + d;
+            if (j < 0 || j > b.length) {
+                continue;
+            }
+            if (j === 0) {
+                current[d] = Math.min(i, over);
+                continue;
+            }
+            best = previous[d] + (a[i - 1] === b[j - 1] ? 0 : 1);
+            if (d + 1 < width) {
+                best = Math.min(best, previous[d + 1] + 1);
+            }
+            if (d > 0) {
+                best = Math.min(best, current[d - 1] + 1);
+            }
+            current[d] = Math.min(best, over);
+        }
+        if (Math.min.apply(null, current) > limit) {
+            return false;
+        }
+        previous = current;
+    }
+    return previous[b.length - a.length + limit] <= limit;
+}
+
+function isCorrect(target, answer) {
+    if (!target['key']) {
+        return target['answer'].trim() === answer.trim();
+    }
+    var forms = target['key'].split('\n');
+    var header = forms.shift();
+    var typos = parseInt(header.replace(/[cd]/g, ''), 10);
+    answer = normalizeAnswer(answer, header.indexOf('c') >= 0, header.indexOf('d') >= 0);
+    if (header.indexOf('c') >= 0) {
+        // Keys saved before case folding hold lower-cased forms
+        forms = forms.map(function (form) { return form.toUpperCase().toLowerCase(); });
+    }
+    return forms.some(function (form) {
+        return form === answer || (typos > 0 && withinDistance(answer, form, typos));
+    });
+}
+
+function batchAnswer(show_answer, no_upd) {
+    var run = batchRun;
+    var target = run.queue[run.index];
+    var answer = $('#answer_field').val();
+
+    if (!no_upd) {
+        if (show_answer) {
+            run.queue.push(target);
+            run.events.push({'question': target['id'], 'show_answer': true});
+            run.score -= run.show_a_penalty;
+            showResponse({'result': 'show_answer',
+                          'score': 'Your score: ' + run.score + '.',
+                          'answer': 'The right answer was: ' + target['answer']});
+            return false;
+        }
+        run.events.push({'question': target['id'], 'answer': answer});
+        if (!isCorrect(target, answer)) {
+            run.score -= run.wrong_a_penalty;
+            showResponse({'result': 'mistake', 'score': 'Your score: ' + run.score + '.'});
+            return false;
+        }
+        run.score += run.bonus;
+    }
+
+    if (run.index < run.queue.length - 1) {
+        run.index += 1;
+        showResponse({'result': 'ok',
+                      'last': false,
+                      'question': 'Question ' + (run.index + 1) + ' out of ' + run.queue.length + '. ' + run.queue[run.index]['question'],
+                      'score': 'Your score: ' + run.score + '. ' + (run.score <= 0 ? 'Learning is a process and progress!' : 'Well done!')});
+        if (run.events.length >= BATCH_SIZE) {
+            flushBatch(false);
+        }
+    } else {
+        run.finished = true;
+        showResponse({'result': 'ok',
+                      'last': true,
+                      'question': 'Well done! You have finished the lesson with score ' + run.score + '.',
+                      'score': run.score <= 0 ? 'Keep learning! No pain no gain!' : 'You are awesome.'});
+        flushBatch(true);
+    }
+    return false;
+}
+
 function insert_symbol(editor, symbol) {
     var inserted = false;
     for (var m in editor.session.getMarkers(false)) {
@@ -69,14 +313,215 @@ function delete_lesson(form, url) {
             var resp = JSON.parse(xhr.responseText);
             if (resp['result'] === 'ok') {
                 form.style.display = 'none';
+                offer_undo(form, resp['undo']);
             }
         };
         xhr.onerror = function () {
             alert(xhr.responseText);
             console.log(xhr.responseText)
         };
-        xhr.open('GET', url, true);
+        xhr.open('POST', url, true);
+        xhr.setRequestHeader('X-CSRFToken', $('#lessons input[name=csrfmiddlewaretoken]').val());
         xhr.send();
     }
     return false;
-}
\ No newline at end of file
+}
+
+// Deleted lessons stay restorable for a while, see yourvocab/purging.py
+function offer_undo(form, url) {
+    var notice = $('<p class="text-muted">The lesson has been deleted. </p>');
+    var undo = $('<a href="#" class="btn btn-outline-primary btn-sm">Undo</a>');
+    undo.on('click', function () {
+        var xhr = new XMLHttpRequest();
+        xhr.onload = function () {
+            var resp = JSON.parse(xhr.responseText);
+            if (resp['result'] === 'ok') {
+                notice.remove();
+                form.style.display = '';
+            } else {
+                notice.text(resp['message']);
+            }
+        };
+        xhr.open('POST', url, true);
+        xhr.setRequestHeader('X-CSRFToken', $('#lessons input[name=csrfmiddlewaretoken]').val());
+        xhr.send();
+        return false;
+    });
+    notice.append(undo).insertAfter(form);
+}
+// Lesson editor: remembers the lines of the last save and which rows changed since, and
+// saves an existing lesson by sending only the changed ranges as hunks.
+var lessonEdit = null;
+
+function trackChangedRows(editor, dirty) {
+    // dirty.top: leading rows untouched since the last save, dirty.bottom: trailing ones
+    editor.session.on('change', function (delta) {
+        var lastChanged = delta.action === 'insert' ? delta.end.row : delta.start.row;
+        dirty.top = Math.min(dirty.top, delta.start.row);
+        dirty.bottom = Math.min(dirty.bottom, editor.session.getLength() - 1 - lastChanged);
+    });
+}
+
+function startLessonEdit(form, questionsEditor, answersEditor, nameInput) {
+    var editors = [questionsEditor, answersEditor];
+    if (!form.dataset.patchUrl) {
+        // New lessons are posted whole with the form
+        $(form).on('submit', function () {
+            $('#' + form.id + ' textarea').each(function (i, textarea) {
+                textarea.value = editors[i].session.getValue();
+            });
+        });
+        return;
+    }
+
+    var lines = parseInt(form.dataset.lines);
+    lessonEdit = {
+        url: form.dataset.patchUrl,
+        version: parseInt(form.dataset.version),
+        editors: editors,
+        nameInput: nameInput,
+        name: nameInput.val(),
+        saved: editors.map(function (editor) {
+            return editor.session.getDocument().getAllLines().slice(0, lines);
+        }),
+        dirty: [{top: lines, bottom: lines}, {top: lines, bottom: lines}],
+        sending: false
+    };
+    trackChangedRows(questionsEditor, lessonEdit.dirty[0]);
+    trackChangedRows(answersEditor, lessonEdit.dirty[1]);
+    // The textareas are only read for new lessons
+    $('#' + form.id + ' textarea').val('');
+
+    $(form).on('submit', function () {
+        saveLesson();
+        return false;
+    });
+}
+
+function lessonHunks(edit) {
+    var length = edit.editors[0].session.getLength();
+    if (edit.editors[1].session.getLength() !== length) {
+        throw 'Questions should have as many lines as answers';
+    }
+    var saved = edit.saved[0].length;
+    var top = Math.min(edit.dirty[0].top, edit.dirty[1].top, saved, length);
+    var bottom = Math.max(0, Math.min(edit.dirty[0].bottom, edit.dirty[1].bottom, saved - top, length - top));
+
+    // Only the rows between the untouched head and tail are compared with the last save
+    var before = edit.saved.map(function (savedLines) {
+        return savedLines.slice(top, saved - bottom);
+    });
+    var after = edit.editors.map(function (editor) {
+        return length - bottom > top ? editor.session.getLines(top, length - bottom - 1) : [];
+    });
+    var same = function (i, j) {
+        return before[0][i] === after[0][j] && before[1][i] === after[1][j];
+    };
+
+    var hunks = [], i;
+    if (before[0].length === after[0].length) {
+        // Rows were only edited in place: a hunk per run of changed rows
+        for (i = 0; i < after[0].length; i++) {
+            if (same(i, i)) {
+                continue;
+            }
+            var last = hunks[hunks.length - 1];
+            if (last && last.start + last.delete === top + i) {
+                last.delete += 1;
+                last.questions.push(after[0][i]);
+                last.answers.push(after[1][i]);
+            } else {
+                hunks.push({start: top + i, delete: 1, questions: [after[0][i]], answers: [after[1][i]]});
+            }
+        }
+    } else {
+        var head = 0, tail = 0;
+        while (head < before[0].length && head < after[0].length && same(head, head)) {
+            head++;
+        }
+        while (tail < before[0].length - head && tail < after[0].length - head &&
+               same(before[0].length - 1 - tail, after[0].length - 1 - tail)) {
+            tail++;
+        }
+        hunks.push({start: top + head,
+                    delete: before[0].length - head - tail,
+                    questions: after[0].slice(head, after[0].length - tail),
+                    answers: after[1].slice(head, after[1].length - tail)});
+    }
+    return hunks;
+}
+
+function saveLesson() {
+    var edit = lessonEdit;
+    if (edit.sending) {
+        return;
+    }
+    var hunks;
+    try {
+        hunks = lessonHunks(edit);
+    } catch (message) {
+        $('#save_status').text(message);
+        return;
+    }
+    var name = edit.nameInput.val();
+    var data = {'version': edit.version, 'hunks': hunks};
+    if (name !== edit.name) {
+        data['name'] = name;
+    }
+    if (hunks.length === 0 && data['name'] === undefined) {
+        $('#save_status').text('Saved');
+        return;
+    }
+
+    // Edits made while the patch is on its way are tracked against what is being sent
+    var sent = edit.editors.map(function (editor) {
+        return editor.session.getDocument().getAllLines();
+    });
+    var dirty = edit.dirty.map(function (d) {
+        var before = {top: d.top, bottom: d.bottom};
+        d.top = d.bottom = sent[0].length;
+        return before;
+    });
+    edit.sending = true;
+    $('#save_status').text('Saving...');
+
+    var xhr = new XMLHttpRequest();
+    var failed = function (message) {
+        edit.sending = false;
+        edit.dirty.forEach(function (d, i) {
+            d.top = Math.min(d.top, dirty[i].top);
+            d.bottom = Math.min(d.bottom, dirty[i].bottom);
+        });
+        $('#save_status').text(message);
+    };
+    xhr.onload = function () {
+        var resp;
+        try {
+            resp = JSON.parse(xhr.responseText);
+        } catch (e) {
+            failed('The lesson could not be saved (' + xhr.status + ')');
+            return;
+        }
+        if (resp['result'] === 'ok') {
+            edit.sending = false;
+            edit.version = resp['version'];
+            edit.saved = sent;
+            edit.name = name;
+            $('#save_status').text('Saved');
+        } else if (resp['result'] === 'conflict') {
+            failed(resp['message']);
+            if (confirm(resp['message'] + '. Load the current lesson? Your changes will be lost.')) {
+                window.location.reload();
+            }
+        } else {
+            failed(resp['message']);
+        }
+    };
+    xhr.onerror = function () {
+        failed('The lesson could not be saved, try again');
+    };
+    xhr.open('POST', edit.url, true);
+    xhr.setRequestHeader('Content-Type', 'application/json');
+    xhr.setRequestHeader('X-CSRFToken', $('#lesson_form input[name=csrfmiddlewaretoken]').val());
+    xhr.send(JSON.stringify(data));
+}
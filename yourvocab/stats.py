@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Progress series of a student's attempts, bucketed by the database.
+
+Recent attempts are LessonStudent rows, older ones have been compacted into
+LessonAttemptSummary rows (see yourvocab.retention); both are bucketed and merged.
+"""
+import datetime
+import hashlib
+import math
+
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek
+
+from yourvocab import models
+
+BUCKETS = {
+    'day': (TruncDay, datetime.timedelta(days=1)),
+    'week': (TruncWeek, datetime.timedelta(weeks=1)),
+    'month': (TruncMonth, datetime.timedelta(days=30)),
+}
+
+DEFAULT_POINTS = 60
+MAX_POINTS = 500
+
+
+def attempts(student, course_id, lesson_id=None):
+    rows = models.LessonStudent.objects.filter(student=student, lesson__course_id=course_id, lesson__deleted_at=None)
+    if lesson_id is not None:
+        rows = rows.filter(lesson_id=lesson_id)
+    return rows
+
+
+def summaries(student, course_id, lesson_id=None):
+    rows = models.LessonAttemptSummary.objects.filter(student=student, lesson__course_id=course_id,
+                                                      lesson__deleted_at=None)
+    if lesson_id is not None:
+        rows = rows.filter(lesson_id=lesson_id)
+    return rows
+
+
+def auto_bucket(rows, summary_rows, points):
+    """The finest bucket that covers the attempts with at most `points` points."""
+    span = rows.aggregate(first=Min('date_time'), last=Max('date_time'))
+    old = summary_rows.aggregate(first=Min('period'), last=Max('last_date_time'))
+    firsts = [value for value in (span['first'], old['first']) if value is not None]
+    if not firsts:
+        return 'day'
+    length = max(value for value in (span['last'], old['last']) if value is not None) - min(firsts)
+    for name, (_, size) in BUCKETS.items():
+        if length / size < points:
+            return name
+    return 'month'
+
+
+def merge(points):
+    count = sum(p['count'] for p in points)
+    return {
+        'period': points[0]['period'],
+        'count': count,
+        'mean_points': sum(p['mean_points'] * p['count'] for p in points) / count,
+        'max_points': max(p['max_points'] for p in points),
+        'elapsed_time': sum(p['elapsed_time'] for p in points),
+        'mistakes': sum(p['mistakes'] for p in points),
+    }
+
+
+def downsample(points, budget):
+    """Merge neighbouring buckets until there are at most `budget` of them."""
+    if len(points) <= budget:
+        return points
+    size = math.ceil(len(points) / budget)
+    return [merge(points[i:i + size]) for i in range(0, len(points), size)]
+
+
+def series(rows, summary_rows, bucket='auto', points=DEFAULT_POINTS):
+    """Returns (bucket, [{period, count, mean_points, max_points, elapsed_time, mistakes}]).
+
+    `rows` are attempts, `summary_rows` compacted attempts; a summary counts in the bucket
+    its period starts in.
+    """
+    if bucket not in BUCKETS:
+        bucket = auto_bucket(rows, summary_rows, points)
+    trunc, _ = BUCKETS[bucket]
+    raw = (rows
+           .values(period=trunc('date_time'))
+           .annotate(count=Count('id'),
+                     points_total=Sum('points'),
+                     max_points=Max('points'),
+                     elapsed_time=Sum('elapsed_time'),
+                     mistakes=Sum('mistakes_count'))
+           .order_by('period'))
+    compacted = (summary_rows
+                 .values(start=trunc('period'))
+                 .annotate(count=Sum('count'),
+                           points_total=Sum('points_total'),
+                           max_points=Max('points_max'),
+                           elapsed_time=Sum('elapsed_time_total'),
+                           mistakes=Sum('mistakes_total'))
+                 .order_by('start'))
+
+    buckets = {}
+    for point in compacted:
+        point['period'] = point.pop('start')
+        buckets[point['period']] = point
+    for point in raw:
+        other = buckets.get(point['period'])
+        if other is not None:
+            point['count'] += other['count']
+            point['points_total'] += other['points_total']
+            point['max_points'] = max(point['max_points'], other['max_points'])
+            point['elapsed_time'] += other['elapsed_time']
+            point['mistakes'] += other['mistakes']
+        buckets[point['period']] = point
+
+    merged = []
+    for period in sorted(buckets):
+        point = buckets[period]
+        point['mean_points'] = point.pop('points_total') / point['count']
+        merged.append(point)
+    return bucket, downsample(merged, points)
+
+
+def etag(student, course_id, lesson_id=None, *parameters):
+    """Changes whenever the student finishes an attempt in the lesson (or course).
+
+    And when attempts are compacted, which leaves the progress alone but moves them into
+    the bucket their summary period starts in.
+    """
+    progress = models.LessonProgress.objects.filter(student=student, lesson__course_id=course_id,
+                                                    lesson__deleted_at=None)
+    if lesson_id is not None:
+        progress = progress.filter(lesson_id=lesson_id)
+    state = progress.aggregate(attempts=Sum('attempts_count'), last=Max('last_date_time'))
+    compacted = summaries(student, course_id, lesson_id).aggregate(attempts=Sum('count'))
+    key = (F'{student.id}:{course_id}:{lesson_id}:{state["attempts"]}:{state["last"]}:{compacted["attempts"]}:'
+           F'{parameters}')
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from django import template
+from django.conf import settings
+from django.templatetags.static import static
+from django.utils.html import format_html_join
+
+from yourvocab import assets
+
+register = template.Library()
+
+
+@register.simple_tag
+def bundle(name):
+    """<link> or deferred <script> tags of a bundle from yourvocab.assets."""
+    if settings.DEBUG:
+        urls = [static(path) for path in assets.BUNDLES[name]]
+    else:
+        urls = [static(F'{assets.OUTPUT_DIR}/{name}')]
+
+    if name.endswith('.css'):
+        return format_html_join('\n', '<link rel="stylesheet" href="{}">', ((url,) for url in urls))
+    return format_html_join('\n', '<script defer src="{}"></script>', ((url,) for url in urls))
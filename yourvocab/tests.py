@@ -1,3 +1,1387 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
+"""Tests of yourvocab: the query and session budgets of the views, then the behavior of
+the modules behind them, one TestCase per feature.
 
-# Create your tests here.
+For the budgets (see yourvocab.budgets), every URL of yourvocab/urls.py is requested
+against a small and a large dataset made by the seed_data command, with cold caches. A
+request over the budget of its view fails the test with a report of its SQL. With
+YOURVOCAB_QUERY_REPORT_DIR set, the reports of all requests are written there as well,
+one file per dataset, to be diffed between runs.
+"""
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import random
+import tempfile
+from collections import namedtuple
+from contextlib import ExitStack
+from unittest import skipUnless
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connections, transaction
+from django.db.models.query import QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from yourvocab import (budgets, caching, catalog, checks, editing, exporting, importing, jobs, matching, models,
+                       progress, purging, quiz, retention, review, routing, stats, urls, views)
+from yourvocab.metrics import registry
+from yourvocab.middleware import session_size
+from yourvocab.tokens import account_activation_token
+
+PASSWORD = 'budget-password'
+
+
+class Measurement(namedtuple('Measurement', 'route method path status queries session_bytes budget')):
+    @property
+    def over_budget(self):
+        return (self.budget is None
+                or len(self.queries) > self.budget.queries
+                or self.session_bytes > self.budget.session_bytes)
+
+    def report(self):
+        if self.budget is None:
+            limits = 'no budget'
+        else:
+            limits = F'budget {self.budget.queries} queries, {self.budget.session_bytes} session bytes'
+        return (F'{self.method.upper()} {self.route} ({self.path} -> {self.status}): {len(self.queries)} queries, '
+                F'{self.session_bytes} session bytes; {limits}\n{budgets.report(self.queries)}')
+
+
+def view_routes():
+    return {str(pattern.pattern) for pattern in urls.urlpatterns
+            if isinstance(pattern, URLPattern) and pattern.callback.__module__ == views.__name__}
+
+
+class QueryBudgets:
+    """Requests every view the way the pages do; subclasses pick the dataset size."""
+    name = None
+    # seed_data options
+    dataset = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', prefix='budget', users=2, password=PASSWORD, stdout=io.StringIO(), **cls.dataset)
+        cls.user = User.objects.get(username='budget-user-0')
+        cls.course = models.Course.objects.filter(author=cls.user).order_by('id').first()
+        cls.lesson = models.Lesson.objects.filter(course=cls.course).order_by('id').first()
+
+        other = User.objects.get(username='budget-user-1')
+        cls.public = models.Course.objects.filter(author=other).order_by('id').first()
+        cls.public.public = True
+        cls.public.save()
+
+        # Due review items in every lesson of the course
+        yesterday = timezone.now() - timezone.timedelta(days=1)
+        models.QuestionStudent.objects.bulk_create([
+            models.QuestionStudent(question_id=question_id, student=cls.user, due=yesterday, repetitions=1, interval=1)
+            for question_id in models.Question.objects.filter(lesson__course=cls.course).values_list('id', flat=True)])
+
+    def setUp(self):
+        self.measured = []
+        self.client.force_login(self.user)
+
+    def measure(self, method, path, **kwargs):
+        """Make a request with cold caches and record its queries and session write."""
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        caching.lesson_course_id.cache_clear()
+
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+            response = getattr(self.client, method)(path, **kwargs)
+            if response.streaming:
+                b''.join(response.streaming_content)
+
+        match = response.resolver_match
+        self.measured.append(Measurement(route=match.route,
+                                         method=method,
+                                         path=path,
+                                         status=response.status_code,
+                                         queries=[query['sql'] for c in captured for query in c.captured_queries],
+                                         session_bytes=session_size(response.wsgi_request) or 0,
+                                         budget=budgets.view_budget(match.func)))
+        self.assertLess(response.status_code, 400, F'{method.upper()} {path} answered {response.status_code}')
+        return response
+
+    def test_query_budgets(self):
+        self.request_pages()
+        self.request_lesson_runs()
+        self.request_editing()
+        self.request_accounts()
+
+        report_dir = os.environ.get('YOURVOCAB_QUERY_REPORT_DIR')
+        if report_dir:
+            os.makedirs(report_dir, exist_ok=True)
+            with open(os.path.join(report_dir, F'{self.name}.txt'), 'w', encoding='utf-8') as f:
+                f.write('\n\n'.join(measurement.report() for measurement in self.measured) + '\n')
+
+        self.assertEqual(view_routes() - {measurement.route for measurement in self.measured}, set(),
+                         'Views that the budget tests do not request')
+        over = [measurement.report() for measurement in self.measured if measurement.over_budget]
+        self.assertFalse(over, F'Requests over budget with the {self.name} dataset:\n\n' + '\n\n'.join(over))
+
+    def request_pages(self):
+        course, lesson = self.course.id, self.lesson.id
+        self.measure('get', '/')
+        page = self.measure('get', F'/course/{course}')
+        if page.context['next']:
+            self.measure('get', F'/course/{course}?after={page.context["next"]}')
+        self.measure('get', F'/course/{course}/dashboard')
+        self.measure('get', F'/course/{course}/stats/series')
+        self.measure('get', F'/course/{course}/lesson/{lesson}/stats')
+        self.measure('get', F'/course/{course}/lesson/{lesson}/stats/series?bucket=day')
+        self.measure('get', '/catalog?q=course')
+        self.measure('post', F'/course/{self.public.id}/subscribe')
+        self.measure('get', '/review')
+        self.measure('get', F'/course/{course}/export?format=csv')
+        self.measure('get', '/export')
+        self.measure('get', '/metrics')
+
+    def request_lesson_runs(self):
+        url = F'/course/{self.course.id}/lesson/{self.lesson.id}'
+
+        self.measure('get', url + '/check')
+        run = self.measure('get', url + '/run').json()
+        events = [{'question': question['id'], 'answer': question['answer']} for question in run['questions']]
+        self.measure('post', url + '/run', data=json.dumps({'token': run['token'], 'events': events, 'finish': True}),
+                     content_type='application/json')
+
+        items = review.due_items(self.user)
+        token = quiz.ReviewRun.start(self.user, items).token()
+        events = [{'question': question_id, 'answer': answer_text} for (question_id, _, answer_text, _) in items]
+        self.measure('post', '/review/run', data=json.dumps({'token': token, 'events': events, 'finish': True}),
+                     content_type='application/json')
+
+        # Lesson runs graded on the server, answered one request at a time
+        with override_settings(YOURVOCAB_BATCH_ANSWERS=False):
+            token = self.measure('get', url + '/check').context['token']
+            token = self.measure('post', url + '/check', data={'token': token, 'answer': 'wrong',
+                                                               'show_answer': 'false',
+                                                               'no_score_upd': 'false'}).json()['token']
+            while True:
+                state = quiz.QuizRun.from_token(token)
+                answer = quiz.lesson_payload(self.lesson.id, state.version)[state.position()][2]
+                response = self.measure('post', url + '/check', data={'token': token, 'answer': answer,
+                                                                      'show_answer': 'false', 'no_score_upd': 'false'})
+                if response.json()['last']:
+                    break
+                token = response.json()['token']
+
+    def request_editing(self):
+        course, lesson = self.course.id, self.lesson.id
+        lines = list(models.Question.objects
+                     .filter(lesson=self.lesson)
+                     .order_by('position', 'id')
+                     .values_list('question_text', 'answer_text'))
+
+        self.measure('get', '/course')
+        self.measure('post', '/course', data={'name': 'New course', 'helper_symbols': 'ß', 'right_answer_bonus': 5,
+                                              'wrong_answer_penalty': 1, 'show_answer_penalty': 2, 'max_typos': 0})
+        self.measure('get', F'/course/{course}/lesson')
+        self.measure('post', F'/course/{course}/lesson', data={
+            'name': 'New lesson',
+            'questions': '\r\n'.join(F'new {question}' for (question, _) in lines),
+            'answers': '\r\n'.join(answer for (_, answer) in lines)})
+
+        self.measure('get', F'/course/{course}/lesson/{lesson}')
+        edited = [(question + '*', answer) if i % 2 else (question, answer) for i, (question, answer) in enumerate(lines)]
+        self.measure('post', F'/course/{course}/lesson/{lesson}', data={
+            'name': self.lesson.name,
+            'questions': '\r\n'.join(question for (question, _) in edited),
+            'answers': '\r\n'.join(answer for (_, answer) in edited)})
+
+        version = models.Lesson.objects.filter(pk=lesson).values_list('version', flat=True).get()
+        self.measure('post', F'/course/{course}/lesson/{lesson}/patch', content_type='application/json', data=json.dumps({
+            'version': version,
+            'hunks': [{'start': 0, 'delete': 1, 'questions': ['patched'], 'answers': ['answer']},
+                      {'start': len(lines) - 1, 'delete': 0, 'questions': ['inserted'], 'answers': ['answer']}]}))
+
+        self.measure('get', F'/course/{course}/import')
+        upload = SimpleUploadedFile('words.csv', '\n'.join(F'{q},{a}' for (q, a) in lines).encode('utf-8'))
+        self.measure('post', F'/course/{course}/import', data={'file': upload, 'name': 'Imported'})
+
+        self.measure('post', F'/course/{course}/lesson/{lesson}/delete')
+        self.measure('post', F'/course/{course}/lesson/{lesson}/restore')
+
+    def request_accounts(self):
+        self.client.logout()
+        self.measure('get', '/')
+        self.measure('get', '/signup')
+        self.measure('post', '/signup', data={'username': 'budget-new', 'email': 'budget-new@example.com',
+                                              'password1': PASSWORD, 'password2': PASSWORD})
+        self.measure('get', '/account_activation_sent')
+
+        user = User.objects.get(username='budget-new')
+        self.measure('get', F'/activate/{urlsafe_base64_encode(force_bytes(user.pk))}/'
+                            F'{account_activation_token.make_token(user)}/')
+        self.client.logout()
+        self.measure('get', '/passreset/')
+        self.measure('post', '/passreset/', data={'email': self.user.email})
+
+
+# The pool threads would not see the data of the test transaction
+@override_settings(YOURVOCAB_DB_THREADS=0)
+class SmallDatasetBudgets(QueryBudgets, TestCase):
+    name = 'small'
+    dataset = {'courses': 1, 'lessons': 3, 'questions': 5, 'attempts': 5}
+
+
+@override_settings(YOURVOCAB_DB_THREADS=0)
+class LargeDatasetBudgets(QueryBudgets, TestCase):
+    """More lessons than a course page shows, and lessons ten times longer."""
+    name = 'large'
+    dataset = {'courses': 2, 'lessons': 55, 'questions': 50, 'attempts': 40}
+
+
+class ExportUnderASGITests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', prefix='export', users=1, courses=1, lessons=2, questions=5, attempts=3,
+                     stdout=io.StringIO())
+        cls.user = User.objects.get(username='export-user-0')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+
+    async def test_streamed_a_piece_at_a_time(self):
+        with patch.object(exporting, 'ROWS_PER_PIECE', 2):
+            response = await self.async_client.get('/export?format=csv')
+            self.assertTrue(response.is_async)
+            pieces = [piece async for piece in response.streaming_content]
+            expected = await sync_to_async(self.export_under_wsgi)()
+            self.assertGreater(len(pieces), 1)
+            self.assertEqual(b''.join(pieces), expected)
+
+    def export_under_wsgi(self):
+        response = self.client.get('/export?format=csv')
+        self.assertFalse(response.is_async)
+        return b''.join(response.streaming_content)
+
+
+class LessonEditingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', prefix='editing', users=2, courses=1, lessons=1, questions=5, attempts=0,
+                     stdout=io.StringIO())
+        cls.user = User.objects.get(username='editing-user-0')
+        cls.course = models.Course.objects.get(author=cls.user)
+        cls.lesson = models.Lesson.objects.get(course=cls.course)
+        cls.other_lesson = models.Lesson.objects.get(course__author__username='editing-user-1')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def questions(self, lesson):
+        return list(models.Question.objects.filter(lesson=lesson).order_by('position', 'id')
+                    .values_list('question_text', 'answer_text'))
+
+    def test_lesson_of_another_course_is_not_found(self):
+        before = self.questions(self.other_lesson)
+        response = self.client.post(F'/course/{self.course.id}/lesson/{self.other_lesson.id}',
+                                    data={'name': 'Taken', 'questions': 'q', 'answers': 'a'})
+        self.assertEqual(response.status_code, 404)
+        lesson = models.Lesson.objects.get(pk=self.other_lesson.id)
+        self.assertEqual((lesson.course_id, lesson.name), (self.other_lesson.course_id, self.other_lesson.name))
+        self.assertEqual(self.questions(lesson), before)
+
+    def post_lesson(self, version, lines):
+        return self.client.post(F'/course/{self.course.id}/lesson/{self.lesson.id}', data={
+            'name': 'Edited', 'version': version,
+            'questions': '\r\n'.join(q for (q, _) in lines), 'answers': '\r\n'.join(a for (_, a) in lines)})
+
+    def test_whole_lesson_saved_from_the_current_version(self):
+        lines = self.questions(self.lesson) + [('new', 'answer')]
+        response = self.post_lesson(self.lesson.version, lines)
+        self.assertRedirects(response, F'/course/{self.course.id}', fetch_redirect_response=False)
+        lesson = models.Lesson.objects.get(pk=self.lesson.id)
+        self.assertEqual((lesson.name, lesson.version), ('Edited', self.lesson.version + 1))
+        self.assertEqual(self.questions(lesson), lines)
+
+    def test_whole_lesson_from_an_older_version_does_not_overwrite(self):
+        patched = self.client.post(F'/course/{self.course.id}/lesson/{self.lesson.id}/patch',
+                                   content_type='application/json',
+                                   data=json.dumps({'version': self.lesson.version, 'hunks': [
+                                       {'start': 0, 'delete': 1, 'questions': ['patched'], 'answers': ['answer']}]}))
+        self.assertEqual(patched.status_code, 200)
+        after_patch = self.questions(self.lesson)
+
+        response = self.post_lesson(self.lesson.version, [('stale', 'answer')])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'The lesson has been changed since it was opened')
+        self.assertEqual(self.questions(self.lesson), after_patch)
+        self.assertEqual(models.Lesson.objects.get(pk=self.lesson.id).name, self.lesson.name)
+
+    def test_edit_page_does_not_write(self):
+        models.Question.objects.filter(lesson=self.lesson).update(position=0)
+        with CaptureQueriesContext(connections['default']) as queries:
+            self.client.get(F'/course/{self.course.id}/lesson/{self.lesson.id}')
+        self.assertFalse([query['sql'] for query in queries if not query['sql'].startswith('SELECT')])
+        self.assertEqual(set(models.Question.objects.filter(lesson=self.lesson).values_list('position', flat=True)),
+                         {0})
+
+    def test_patch_numbers_rows_saved_without_positions(self):
+        models.Question.objects.filter(lesson=self.lesson).update(position=0)
+        before = self.questions(self.lesson)
+        response = self.client.post(F'/course/{self.course.id}/lesson/{self.lesson.id}/patch',
+                                    content_type='application/json',
+                                    data=json.dumps({'version': self.lesson.version, 'hunks': [
+                                        {'start': 1, 'delete': 1, 'questions': ['patched'], 'answers': ['answer']}]}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.questions(self.lesson), before[:1] + [('patched', 'answer')] + before[2:])
+        self.assertEqual(list(models.Question.objects.filter(lesson=self.lesson).order_by('position')
+                              .values_list('position', flat=True)), list(range(len(before))))
+
+
+
+class LessonPatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', prefix='patch', users=1, courses=1, lessons=1, questions=8, attempts=0,
+                     stdout=io.StringIO())
+        cls.user = User.objects.get(username='patch-user-0')
+        cls.lesson = models.Lesson.objects.select_related('course').get(course__author=cls.user)
+
+    def lines(self):
+        return list(models.Question.objects.filter(lesson=self.lesson).order_by('position', 'id')
+                    .values_list('question_text', 'answer_text'))
+
+    def patch(self, *hunks):
+        lesson = models.Lesson.objects.select_related('course').get(pk=self.lesson.id)
+        editing.patch_lesson(lesson, lesson.version, editing.parse_hunks(hunks))
+
+    def test_hunks_out_of_order_or_overlapping_are_rejected(self):
+        for hunks in ([{'start': 4, 'delete': 1, 'questions': [], 'answers': []},
+                       {'start': 2, 'delete': 1, 'questions': [], 'answers': []}],
+                      [{'start': 2, 'delete': 3, 'questions': [], 'answers': []},
+                       {'start': 4, 'delete': 1, 'questions': [], 'answers': []}]):
+            with self.subTest(hunks=hunks), self.assertRaises(editing.PatchRejected):
+                editing.parse_hunks(hunks)
+
+    def test_malformed_hunks(self):
+        for hunk, error in (({'start': -1, 'delete': 0, 'questions': [], 'answers': []}, TypeError),
+                            ({'start': 0, 'delete': 0, 'questions': ['q'], 'answers': []}, editing.PatchRejected),
+                            ({'start': 0, 'delete': 0, 'questions': ['q\nq'], 'answers': ['a']},
+                             editing.PatchRejected),
+                            ({'start': 0, 'delete': 0, 'questions': [' '], 'answers': ['a']}, editing.PatchRejected),
+                            ({'start': 0, 'questions': [], 'answers': []}, KeyError)):
+            with self.subTest(hunk=hunk), self.assertRaises(error):
+                editing.parse_hunks([hunk])
+
+    def test_delete_to_the_end(self):
+        before = self.lines()
+        self.patch({'start': 5, 'delete': 3, 'questions': [], 'answers': []})
+        self.assertEqual(self.lines(), before[:5])
+
+    def test_past_the_end_is_rejected(self):
+        with self.assertRaises(editing.PatchRejected):
+            self.patch({'start': 6, 'delete': 3, 'questions': [], 'answers': []})
+
+    def test_patch_from_an_older_version_conflicts(self):
+        self.client.force_login(self.user)
+        url = F'/course/{self.lesson.course_id}/lesson/{self.lesson.id}/patch'
+        body = {'version': self.lesson.version,
+                'hunks': [{'start': 0, 'delete': 1, 'questions': ['first'], 'answers': ['answer']}]}
+        self.assertEqual(self.client.post(url, json.dumps(body), content_type='application/json').status_code, 200)
+        after = self.lines()
+        body['hunks'][0]['questions'] = ['second']
+        response = self.client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.lines(), after)
+
+    def test_random_patches_match_a_list(self):
+        rnd = random.Random(0)
+        texts = ['apple', 'pear', 'plum', 'fig']
+        expected = self.lines()
+        for _ in range(40):
+            hunks, end = [], 0
+            while end <= len(expected) and rnd.random() < 0.7:
+                start = rnd.randint(end, len(expected))
+                delete = rnd.randint(0, min(3, len(expected) - start))
+                new = [(rnd.choice(texts), rnd.choice(texts)) for _ in range(rnd.randint(0, 3))]
+                hunks.append({'start': start, 'delete': delete,
+                              'questions': [q for (q, _) in new], 'answers': [a for (_, a) in new]})
+                end = start + delete
+            for hunk in reversed(hunks):
+                expected[hunk['start']:hunk['start'] + hunk['delete']] = list(zip(hunk['questions'], hunk['answers']))
+
+            self.patch(*hunks)
+            self.assertEqual(self.lines(), expected, hunks)
+            self.assertEqual(list(models.Question.objects.filter(lesson=self.lesson).order_by('position')
+                                  .values_list('position', flat=True)), list(range(len(expected))))
+
+
+@override_settings(YOURVOCAB_DB_THREADS=0)
+class RunClaimTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', prefix='claim', users=1, courses=1, lessons=1, questions=4, attempts=0,
+                     stdout=io.StringIO())
+        cls.user = User.objects.get(username='claim-user-0')
+        cls.lesson = models.Lesson.objects.get(course__author=cls.user)
+        cls.url = F'/course/{cls.lesson.course_id}/lesson/{cls.lesson.id}/run'
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.run = self.client.get(self.url).json()
+
+    def post(self, token, events, finish=False):
+        return self.client.post(self.url, content_type='application/json',
+                                data=json.dumps({'token': token, 'events': events, 'finish': finish}))
+
+    def answers(self):
+        return [{'question': question['id'], 'answer': question['answer']} for question in self.run['questions']]
+
+    def mistake(self):
+        return [{'question': self.run['questions'][0]['id'], 'answer': 'wrong'}]
+
+    def test_repeated_batch_is_answered_but_recorded_once(self):
+        first = self.post(self.run['token'], self.answers(), finish=True)
+        # Every process sees the claim, not just the one whose cache has it
+        caches[settings.YOURVOCAB_CACHE].clear()
+        again = self.post(self.run['token'], self.answers(), finish=True)
+        self.assertEqual(first.json(), again.json())
+        self.assertEqual(models.LessonStudent.objects.filter(lesson=self.lesson, student=self.user).count(), 1)
+
+    def test_used_token_refuses_other_events(self):
+        self.assertEqual(self.post(self.run['token'], self.mistake()).status_code, 200)
+        response = self.post(self.run['token'], self.answers(), finish=True)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(models.LessonStudent.objects.filter(lesson=self.lesson, student=self.user).exists())
+
+    def test_replayed_events_are_refused(self):
+        response = self.post(self.run['token'], self.answers() * 200, finish=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(models.LessonStudent.objects.filter(lesson=self.lesson, student=self.user).exists())
+        finished = self.post(self.run['token'], self.answers(), finish=True).json()
+        self.assertEqual(finished['score'], len(self.run['questions']) * self.run['bonus'])
+
+    def test_expired_claims_are_forgotten(self):
+        token = self.post(self.run['token'], self.mistake()).json()['token']
+        models.RunClaim.objects.update(claimed_at=timezone.now() - timezone.timedelta(seconds=quiz.RUN_MAX_AGE + 1))
+        self.post(token, self.mistake())
+        self.assertEqual(quiz.expire_claims(), 1)
+        self.assertEqual(models.RunClaim.objects.count(), 1)
+
+
+@override_settings(YOURVOCAB_DB_THREADS=0, YOURVOCAB_BATCH_ANSWERS=False, YOURVOCAB_BUFFER_MISTAKES=True)
+class BufferedMistakeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', prefix='buffer', users=1, courses=1, lessons=1, questions=4, attempts=0,
+                     stdout=io.StringIO())
+        cls.user = User.objects.get(username='buffer-user-0')
+        cls.lesson = models.Lesson.objects.get(course__author=cls.user)
+        cls.url = F'/course/{cls.lesson.course_id}/lesson/{cls.lesson.id}/check'
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def miss(self, token):
+        return self.client.post(self.url, {'token': token, 'answer': 'wrong', 'show_answer': 'false',
+                                           'no_score_upd': 'false'})
+
+    def mistakes(self):
+        return sum(models.QuestionStudent.objects.filter(student=self.user).values_list('mistakes_count', flat=True))
+
+    def test_new_run_writes_the_mistakes_of_the_abandoned_one(self):
+        token = self.client.get(self.url).context['token']
+        token = self.miss(token).json()['token']
+        token = self.miss(token).json()['token']
+        self.assertEqual(self.mistakes(), 0)
+        self.client.get(self.url)
+        self.assertEqual(self.mistakes(), 2)
+        # The abandoned run is closed, so its buffer is not written twice
+        self.assertEqual(self.miss(token).status_code, 409)
+        self.client.get(self.url)
+        self.assertEqual(self.mistakes(), 2)
+
+    def test_expired_runs_are_flushed(self):
+        token = self.client.get(self.url).context['token']
+        self.miss(token)
+        models.RunClaim.objects.update(claimed_at=timezone.now() - timezone.timedelta(seconds=quiz.RUN_MAX_AGE + 1))
+        self.assertEqual(quiz.expire_claims(), 1)
+        self.assertEqual(self.mistakes(), 1)
+
+
+class JobTests(TestCase):
+    def setUp(self):
+        self.ran = []
+        handlers = patch.dict(jobs.handlers, {'test': self.handle})
+        handlers.start()
+        self.addCleanup(handlers.stop)
+
+    def handle(self, payloads):
+        # The lease is already in the database while the handler runs
+        self.ran.append([job.run_after > timezone.now() for job in models.Job.objects.all()])
+        return [None if payload['ok'] else RuntimeError('down') for payload in payloads]
+
+    def test_jobs_are_leased_while_they_run(self):
+        jobs.enqueue('test', {'ok': True})
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(self.ran, [[True]])
+        self.assertFalse(models.Job.objects.exists())
+
+    def test_failed_job_is_retried_later(self):
+        job = jobs.enqueue('test', {'ok': False})
+        self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.attempts, job.last_error, job.failed), (1, 'down', False))
+        self.assertEqual(jobs.run_pending(), 0)
+
+    def test_job_of_a_dead_worker_is_taken_again_after_the_lease(self):
+        job = jobs.enqueue('test', {'ok': True})
+        self.assertEqual(len(jobs.take()), 1)
+        self.assertEqual(jobs.run_pending(), 0)
+        models.Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(self.ran, [[True]])
+
+
+class LessonPurgeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', prefix='purge', users=1, courses=1, lessons=2, questions=30, attempts=5,
+                     stdout=io.StringIO())
+        cls.user = User.objects.get(username='purge-user-0')
+        cls.course = models.Course.objects.get(author=cls.user)
+        cls.lesson, cls.kept = models.Lesson.objects.filter(course=cls.course).order_by('pk')
+
+    def rows(self, lesson):
+        return {description: model.objects.filter(**{lesson_field: lesson.pk}).count()
+                for description, model, lesson_field in purging.DEPENDENTS}
+
+    def test_delete_needs_a_post_by_the_author(self):
+        url = F'/course/{self.course.pk}/lesson/{self.lesson.pk}/delete'
+        self.assertRedirects(self.client.post(url), F'/accounts/login/?next={url}', fetch_redirect_response=False)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertTrue(models.Lesson.objects.filter(pk=self.lesson.pk).exists())
+        self.assertEqual(self.client.post(url).json()['result'], 'ok')
+        self.assertFalse(models.Lesson.objects.filter(pk=self.lesson.pk).exists())
+
+    def test_deleted_lesson_is_not_exported(self):
+        purging.delete_lesson(self.lesson)
+        exported = {name: list(rows) for name, fields, rows in exporting.tables([self.course.pk])}
+        self.assertEqual([row[0] for row in exported['lesson']], [self.kept.pk])
+        self.assertEqual({row[1] for row in exported['question']}, {self.kept.pk})
+
+    def test_interrupted_purge_carries_on(self):
+        before = self.rows(self.kept)
+        purging.delete_lesson(self.lesson)
+        progress = []
+        self.assertFalse(purging.purge_lesson(self.lesson.pk, cutoff=timezone.now(), batch_size=7, max_rows=20,
+                                              progress=lambda *args: progress.append(args)))
+        self.assertEqual(sum(count for description, count in progress), 21)
+        self.assertTrue(models.Lesson.all_objects.filter(pk=self.lesson.pk).exists())
+
+        self.assertTrue(purging.purge_lesson(self.lesson.pk, cutoff=timezone.now(), batch_size=7))
+        self.assertFalse(models.Lesson.all_objects.filter(pk=self.lesson.pk).exists())
+        self.assertFalse(any(self.rows(self.lesson).values()))
+        self.assertEqual(self.rows(self.kept), before)
+
+    def test_lesson_is_kept_during_the_undo_window(self):
+        before = self.rows(self.lesson)
+        purging.delete_lesson(self.lesson)
+        purging.purge_lesson(self.lesson.pk)
+        self.assertTrue(models.Lesson.all_objects.filter(pk=self.lesson.pk).exists())
+        self.assertEqual(self.rows(self.lesson), before)
+
+    def test_purge_job_queues_the_rest(self):
+        purging.delete_lesson(self.lesson)
+        models.Lesson.all_objects.filter(pk=self.lesson.pk).update(deleted_at=purging.purge_cutoff())
+        models.Job.objects.update(run_after=timezone.now())
+        with patch.object(purging, 'BATCH_SIZE', 10), patch.object(purging, 'ROWS_PER_JOB', 10):
+            self.assertEqual(jobs.run_pending(), 1)
+            self.assertEqual(models.Job.objects.filter(kind='purge_lesson').count(), 1)
+            self.assertTrue(models.Lesson.all_objects.filter(pk=self.lesson.pk).exists())
+            while jobs.run_pending():
+                pass
+        self.assertFalse(models.Job.objects.exists())
+        self.assertFalse(models.Lesson.all_objects.filter(pk=self.lesson.pk).exists())
+
+
+class ImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed_data', prefix='import', users=1, courses=1, lessons=0, questions=0, attempts=0,
+                     stdout=io.StringIO())
+        cls.course = models.Course.objects.get(author__username='import-user-0')
+
+    def rows(self, text, delimiter=None):
+        return list(importing.read_rows(io.StringIO(text, newline=''), delimiter))
+
+    def imported(self, text, **options):
+        counts = importing.import_lessons(self.course, io.StringIO(text, newline=''), 'Imported', **options)
+        return {lesson.name: list(lesson.question_set.order_by('position').values_list('question_text',
+                                                                                        'answer_text'))
+                for lesson in counts}
+
+    def test_anki_header_sets_the_separator(self):
+        self.assertEqual(self.rows('#separator:semicolon\n#html:false\na;b, c\n'), [(3, ['a', 'b, c'])])
+
+    def test_hash_is_question_text(self):
+        self.assertEqual(self.rows('#1,one\n#define,macro\n'), [(1, ['#1', 'one']), (2, ['#define', 'macro'])])
+        self.assertEqual(self.rows('a,b\n#separator:tab,sep\n'), [(1, ['a', 'b']), (2, ['#separator:tab', 'sep'])])
+
+    def test_fields_of_several_lines_are_refused(self):
+        # Read as one row, so the rows after it keep their line numbers
+        text = 'q1,"first\r\nsecond"\r\n\r\nq2,a2\r\n'
+        self.assertEqual(self.rows(text), [(1, ['q1', 'first\r\nsecond']), (4, ['q2', 'a2'])])
+        for text in ('q1,"first\r\nsecond"\r\nq2,a2\r\n', '"q1\rmore",a1\nq2,a2\n'):
+            with self.assertRaises(importing.ImportFailed) as failed:
+                self.imported(text)
+            self.assertEqual(failed.exception.errors, [(1, 'A line should not span several lines')])
+        self.assertFalse(models.Lesson.objects.filter(course=self.course).exists())
+
+    def test_delimiter_is_guessed_from_the_first_row(self):
+        self.assertEqual(self.rows('\n\na\tb, c\n'), [(3, ['a', 'b, c'])])
+        self.assertEqual(self.rows('a;b\n'), [(1, ['a', 'b'])])
+
+    def test_rows_go_to_lessons(self):
+        self.assertEqual(self.imported('a,1\nb,2,Other\nc,3\n'),
+                         {'Imported': [('a', '1'), ('c', '3')], 'Other': [('b', '2')]})
+        self.assertEqual(self.imported('d,4\ne,5\nf,6\n', split_every=2),
+                         {'Imported 1': [('d', '4'), ('e', '5')], 'Imported 2': [('f', '6')]})
+
+    def test_invalid_rows_import_nothing(self):
+        with self.assertRaises(importing.ImportFailed) as failed:
+            self.imported('a,1\n"b\nc"\n ,2\nd,\n', batch_size=1)
+        self.assertEqual(failed.exception.errors, [(2, 'A row needs a question and an answer'),
+                                                   (4, 'Empty questions are not permitted'),
+                                                   (5, 'Empty answers are not permitted')])
+        self.assertFalse(models.Lesson.objects.filter(course=self.course).exists())
+
+
+class CacheGenerationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('generation-user')
+        cls.course = models.Course.objects.create(name='Generations', author=cls.user)
+        models.CourseStudent.objects.create(course=cls.course, student=cls.user)
+        cls.lesson = models.Lesson.objects.create(course=cls.course, name='Generations')
+        cls.question = models.Question.objects.create(lesson=cls.lesson, question_text='q', answer_text='a')
+
+    def setUp(self):
+        self.cache = caching.get_cache()
+        self.cache.clear()
+        caching.lesson_course_id.cache_clear()
+        self.keys = {'course': caching.course_generation_key(self.course.id),
+                     'user course': caching.course_user_generation_key(self.user.id, self.course.id),
+                     'course list': caching.course_list_generation_key(self.user.id)}
+        caching.generations(self.cache, *self.keys.values())
+
+    def bumped(self):
+        return {name for name, key in self.keys.items() if self.cache.get(key) > 1}
+
+    def test_course_save(self):
+        self.course.save()
+        self.assertEqual(self.bumped(), {'course', 'course list'})
+
+    def test_course_delete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.course.delete()
+        # The enrolments go with the course
+        self.assertEqual(self.bumped(), {'course', 'user course', 'course list'})
+
+    def test_course_student_save_and_delete(self):
+        setup = models.CourseStudent.objects.get(course=self.course, student=self.user)
+        setup.save()
+        self.assertEqual(self.bumped(), {'user course', 'course list'})
+        self.setUp()
+        setup.delete()
+        self.assertEqual(self.bumped(), {'user course', 'course list'})
+
+    def test_lesson_create_rename_and_delete(self):
+        lesson = models.Lesson.objects.create(course=self.course, name='New')
+        self.assertEqual(self.bumped(), {'course', 'course list'})
+        self.setUp()
+        lesson.name = 'Renamed'
+        lesson.save()
+        # Lesson names only show on the course page
+        self.assertEqual(self.bumped(), {'course'})
+        self.setUp()
+        lesson.delete()
+        self.assertEqual(self.bumped(), {'course', 'course list'})
+
+    def test_question_save_and_delete(self):
+        self.question.save()
+        self.assertEqual(self.bumped(), {'course'})
+        self.setUp()
+        self.question.delete()
+        self.assertEqual(self.bumped(), {'course'})
+
+    def test_lesson_student_save_and_delete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            attempt = models.LessonStudent.objects.create(student=self.user, lesson=self.lesson, date_time=timezone.now(),
+                                                          elapsed_time=1, points=1, mistakes_count=0)
+        self.assertEqual(self.bumped(), {'user course', 'course list'})
+        self.setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            attempt.delete()
+        self.assertEqual(self.bumped(), {'user course', 'course list'})
+
+    def test_process_local_cache_is_refused_without_debug(self):
+        local = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache'}}
+        with override_settings(CACHES=local, DEBUG=False):
+            self.assertEqual([error.id for error in checks.shared_cache_check(None)], ['yourvocab.E001'])
+        with override_settings(CACHES=local, DEBUG=True):
+            self.assertEqual(checks.shared_cache_check(None), [])
+        with override_settings(CACHES=shared, DEBUG=False):
+            self.assertEqual(checks.shared_cache_check(None), [])
+
+
+@skipUnless(settings.YOURVOCAB_REPLICA in settings.DATABASES, 'needs YourVocab.test_replica_settings')
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.user = User.objects.create_user('replica-user')
+        self.course = models.Course.objects.create(name='Replicated words', author=self.user, public=True)
+        self.client.force_login(self.user)
+
+    def queries(self, method, path):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections[settings.YOURVOCAB_REPLICA]) as replica:
+            response = getattr(self.client, method)(path)
+        return response, [query['sql'] for query in primary], [query['sql'] for query in replica]
+
+    def test_reads_go_to_the_replica(self):
+        response, _, replica = self.queries('get', '/catalog?q=replicated')
+        self.assertEqual(list(response.context['courses']), [self.course])
+        self.assertTrue(any('yourvocab_course' in sql for sql in replica))
+
+    def test_writes_go_to_the_primary(self):
+        response, primary, replica = self.queries('post', F'/course/{self.course.id}/subscribe')
+        self.assertTrue(any(sql.startswith('INSERT') and 'yourvocab_coursestudent' in sql for sql in primary))
+        self.assertFalse([sql for sql in replica if not sql.startswith('SELECT')])
+        self.assertIn(routing.STICKY_COOKIE, response.cookies)
+
+    def test_reads_stay_on_the_primary_after_a_write(self):
+        self.client.post(F'/course/{self.course.id}/subscribe')
+        _, primary, replica = self.queries('get', '/catalog?q=replicated')
+        self.assertEqual(replica, [])
+        self.assertTrue(any('yourvocab_course' in sql for sql in primary))
+        # Once the cookie has expired
+        del self.client.cookies[routing.STICKY_COOKIE]
+        _, _, replica = self.queries('get', '/catalog?q=replicated')
+        self.assertNotEqual(replica, [])
+
+
+@patch.object(caching, 'PAGE_SIZE', 2)
+class CachedListingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('listing-user')
+        cls.courses = [models.Course.objects.create(name=F'Listed {i}', author=cls.user) for i in range(3)]
+        for course in cls.courses:
+            models.CourseStudent.objects.create(course=course, student=cls.user)
+        cls.lessons = [models.Lesson.objects.create(course=cls.courses[0], name=F'Listed {i}') for i in range(4)]
+        for i, lesson in enumerate(cls.lessons):
+            models.Question.objects.bulk_create([models.Question(lesson=lesson, question_text='q', answer_text='a')
+                                                 for _ in range(i)])
+        purging.delete_lesson(cls.lessons[3])
+        models.LessonProgress.objects.create(student=cls.user, lesson=cls.lessons[1], attempts_count=2,
+                                             best_points=9, last_points=4, mistakes_total=3)
+
+    def setUp(self):
+        caching.get_cache().clear()
+        caching.lesson_course_id.cache_clear()
+
+    def pages(self, listing, *args):
+        pages, after = [], None
+        while True:
+            page = listing(self.user, *args, after=after)
+            pages.append(page)
+            after = page['next']
+            if after is None:
+                return pages
+
+    def test_course_list_pages(self):
+        pages = self.pages(caching.course_list)
+        self.assertEqual([[course['id'] for course in page['courses']] for page in pages],
+                         [[self.courses[0].id, self.courses[1].id], [self.courses[2].id]])
+        self.assertEqual(pages[0]['next'], self.courses[1].id)
+
+    def test_full_last_page_has_no_next(self):
+        models.CourseStudent.objects.filter(course=self.courses[2]).delete()
+        page = caching.course_list(self.user)
+        self.assertEqual(len(page['courses']), 2)
+        self.assertIsNone(page['next'])
+
+    def test_pages_past_the_end_are_empty(self):
+        self.assertEqual(caching.course_list(self.user, after=self.courses[2].id), {'courses': [], 'next': None})
+        detail = caching.course_detail(self.user, self.courses[0].id, after=self.lessons[3].id)
+        self.assertEqual((detail['lessons'], detail['next']), ([], None))
+
+    def test_course_list_counts_live_lessons(self):
+        first = caching.course_list(self.user)['courses'][0]
+        self.assertEqual((first['lessons_count'], first['progress']), (3, None))
+
+    def test_course_detail_pages_and_counts(self):
+        pages = self.pages(caching.course_detail, self.courses[0].id)
+        lessons = [lesson for page in pages for lesson in page['lessons']]
+        self.assertEqual([len(page['lessons']) for page in pages], [2, 1])
+        self.assertEqual([(lesson['id'], lesson['questions_count']) for lesson in lessons],
+                         [(lesson.id, i) for i, lesson in enumerate(self.lessons[:3])])
+        self.assertEqual(pages[0]['course']['lessons_count'], 3)
+        self.assertIsNone(lessons[0]['progress'])
+        self.assertEqual((lessons[1]['progress']['attempts_count'], lessons[1]['progress']['best_points'],
+                          lessons[1]['progress']['mistakes_total']), (2, 9, 3))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        registry.reset()
+        self.client.force_login(User.objects.create_user('metrics-user'))
+
+    def test_request_is_measured_by_route(self):
+        self.client.get('/catalog')
+        self.client.get('/catalog?q=words')
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('yourvocab_request_seconds_count{route="catalog"} 2', body)
+        self.assertIn('yourvocab_request_queries_count{route="catalog"} 2', body)
+        self.assertIn('yourvocab_response_bytes_bucket{route="catalog",le="+Inf"} 2', body)
+
+    @override_settings(YOURVOCAB_METRICS_TOKEN='secret')
+    def test_metrics_need_the_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer other').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+
+class CatalogTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('catalog-user')
+        cls.course = models.Course.objects.create(name='Español básico', author=cls.user, public=True)
+        cls.lesson = models.Lesson.objects.create(course=cls.course, name='Animals')
+        models.Question.objects.create(lesson=cls.lesson, question_text='el perro', answer_text='the dog')
+        catalog.index_lesson(cls.lesson)
+
+    def found(self, query):
+        return list(catalog.search(query)[0])
+
+    def test_search(self):
+        self.assertEqual(self.found('espan DOG anim'), [self.course])
+        self.assertEqual(self.found('el'), [self.course])
+        self.assertEqual(self.found('pe'), [])
+        self.assertEqual(self.found('perro cat'), [])
+
+    def test_pages(self):
+        newer = [models.Course.objects.create(name=F'Español {i}', author=self.user, public=True) for i in range(3)]
+        page, cursor = catalog.search('espanol', limit=2)
+        self.assertEqual(page, newer[:0:-1])
+        page, cursor = catalog.search('espanol', after=cursor, limit=2)
+        self.assertEqual((page, cursor), ([newer[0], self.course], None))
+
+    def test_save_without_index_changes_writes_nothing(self):
+        for name in ('Español básico', '1 2 3'):
+            self.course.name = name
+            self.course.save()
+            with CaptureQueriesContext(connections['default']) as queries:
+                self.course.save()
+            catalog_queries = [query['sql'] for query in queries if 'catalogterm' in query['sql']]
+            self.assertEqual(len(catalog_queries), 1, catalog_queries)
+            self.assertTrue(catalog_queries[0].startswith('SELECT'))
+        self.assertEqual(self.found('perro'), [self.course])
+
+    def indexed(self, lesson):
+        return dict(models.CatalogTerm.objects.filter(lesson=lesson).values_list('term', 'count'))
+
+    def test_edits_reindex_only_the_changed_questions(self):
+        lesson = models.Lesson.objects.create(course=self.course, name='Farm animals')
+        editing.save_questions(lesson, [('el gato', 'the cat'), ('la vaca', 'the cow'), ('el cerdo', 'the pig')])
+        catalog.index_lesson(lesson)
+        kept = models.CatalogTerm.objects.get(lesson=lesson, term='vaca').pk
+
+        changes = editing.save_lesson(lesson, lesson.version, 'Farm',
+                                      [('el caballo', 'the horse'), ('la vaca', 'the cow'), ('la oveja', 'the sheep')])
+        catalog.index_changes(lesson, changes)
+        incremental = self.indexed(lesson)
+        self.assertEqual(models.CatalogTerm.objects.get(lesson=lesson, term='vaca').pk, kept)
+        self.assertEqual((incremental['el'], incremental['la'], incremental['the']), (1, 2, 3))
+        self.assertNotIn('gato', incremental)
+        self.assertNotIn('animals', incremental)
+        catalog.index_lesson(lesson)
+        self.assertEqual(self.indexed(lesson), incremental)
+        self.assertEqual(self.found('caballo farm'), [self.course])
+        self.assertEqual(self.found('cerdo'), [])
+
+    def test_private_course_is_dropped(self):
+        self.course.public = False
+        self.course.save()
+        self.assertFalse(models.CatalogTerm.objects.exists())
+        self.course.public = True
+        self.course.save()
+        self.assertEqual(self.found('basico perro'), [self.course])
+
+
+class MistakeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('mistake-user')
+        course = models.Course.objects.create(name='Mistakes', author=cls.user)
+        lesson = models.Lesson.objects.create(course=course, name='Mistakes')
+        cls.questions = [models.Question.objects.create(lesson=lesson, question_text=F'q{i}', answer_text=F'a{i}',
+                                                        position=i)
+                         for i in range(2)]
+
+    def counts(self):
+        return dict(models.QuestionStudent.objects.filter(student=self.user)
+                    .values_list('question_id', 'mistakes_count'))
+
+    def test_counters_are_created_then_bumped(self):
+        first, second = self.questions
+        quiz.add_mistakes(self.user, {first.id: 2})
+        quiz.add_mistakes(self.user, {first.id: 1, second.id: 3})
+        self.assertEqual(self.counts(), {first.id: 3, second.id: 3})
+
+    def test_row_created_meanwhile_keeps_the_count(self):
+        question = self.questions[0]
+        bulk_create = QuerySet.bulk_create
+
+        def racing(queryset, objs, **kwargs):
+            # Another request creates the row between the UPDATE and the INSERT
+            models.QuestionStudent.objects.create(question=question, student=self.user, mistakes_count=4)
+            return bulk_create(queryset, objs, **kwargs)
+
+        with patch.object(QuerySet, 'bulk_create', racing):
+            quiz.add_mistakes(self.user, {question.id: 2})
+        self.assertEqual(self.counts(), {question.id: 6})
+
+
+class ReviewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('review-user')
+        cls.course = models.Course.objects.create(name='Review', author=cls.user)
+        models.CourseStudent.objects.create(course=cls.course, student=cls.user)
+        cls.lesson = models.Lesson.objects.create(course=cls.course, name='Review')
+        cls.questions = [models.Question.objects.create(lesson=cls.lesson, question_text=F'q{i}',
+                                                        answer_text=F'a{i}', position=i)
+                         for i in range(3)]
+
+    def assertSm2(self, actual, expected):
+        self.assertAlmostEqual(actual[0], expected[0])
+        self.assertEqual(actual[1:], expected[1:])
+
+    def test_quality(self):
+        self.assertEqual(review.quality(missed=False, shown=False), review.QUALITY_PERFECT)
+        self.assertEqual(review.quality(missed=True, shown=False), review.QUALITY_AFTER_MISTAKE)
+        self.assertEqual(review.quality(missed=True, shown=True), review.QUALITY_SHOWN)
+
+    def test_sm2_intervals_grow_with_right_answers(self):
+        state = (2.5, 0, 0)
+        for expected in ((2.6, 1, 1), (2.7, 6, 2), (2.8, 16, 3), (2.9, 45, 4)):
+            state = review.sm2(*state, review.QUALITY_PERFECT)
+            self.assertSm2(state, expected)
+        self.assertSm2(review.sm2(2.5, 6, 2, review.QUALITY_AFTER_MISTAKE), (2.36, 15, 3))
+
+    def test_sm2_lapse_starts_over_and_ease_has_a_floor(self):
+        self.assertSm2(review.sm2(2.5, 45, 4, review.QUALITY_SHOWN), (1.96, 1, 0))
+        self.assertSm2(review.sm2(1.4, 6, 2, review.QUALITY_SHOWN), (review.MIN_EASE, 1, 0))
+
+    def test_schedule(self):
+        now = timezone.now()
+        first, second, third = self.questions
+        review.schedule(self.user, {first.id: review.QUALITY_PERFECT, second.id: review.QUALITY_SHOWN}, now=now)
+        review.schedule(self.user, {first.id: review.QUALITY_PERFECT}, now=now)
+        rows = {row.question_id: row for row in models.QuestionStudent.objects.filter(student=self.user)}
+        self.assertEqual(set(rows), {first.id, second.id})
+        self.assertEqual((rows[first.id].repetitions, rows[first.id].interval), (2, 6))
+        self.assertEqual(rows[first.id].due, now + timezone.timedelta(days=6))
+        self.assertEqual((rows[second.id].repetitions, rows[second.id].interval), (0, 1))
+
+    def test_due_items_are_most_overdue_first(self):
+        now = timezone.now()
+        for days, question in zip((1, 3, -1), self.questions):
+            models.QuestionStudent.objects.create(question=question, student=self.user,
+                                                  due=now - timezone.timedelta(days=days))
+        due = [item[0] for item in review.due_items(self.user, now=now)]
+        self.assertEqual(due, [self.questions[1].id, self.questions[0].id])
+        self.assertEqual(len(review.due_items(self.user, limit=1, now=now)), 1)
+
+        models.Lesson.objects.filter(pk=self.lesson.pk).update(deleted_at=now)
+        self.assertEqual(review.due_items(self.user, now=now), [])
+        models.Lesson.all_objects.filter(pk=self.lesson.pk).update(deleted_at=None)
+        models.CourseStudent.objects.filter(course=self.course).delete()
+        self.assertEqual(review.due_items(self.user, now=now), [])
+
+
+class MatchingTests(TestCase):
+    def key(self, answer_text, ignore_case=False, ignore_diacritics=False, alternatives=False, max_typos=0):
+        return matching.answer_key(matching.Options(ignore_case, ignore_diacritics, alternatives, max_typos),
+                                   answer_text)
+
+    def distance(self, a, b):
+        previous = list(range(len(b) + 1))
+        for i, x in enumerate(a, start=1):
+            current = [i]
+            for j, y in enumerate(b, start=1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (x != y)))
+            previous = current
+        return previous[-1]
+
+    def test_within_distance_agrees_with_levenshtein(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            a = ''.join(rng.choice('abc') for _ in range(rng.randrange(8)))
+            b = ''.join(rng.choice('abc') for _ in range(rng.randrange(8)))
+            limit = rng.randrange(matching.MAX_TYPOS + 1)
+            self.assertEqual(matching.within_distance(a, b, limit), self.distance(a, b) <= limit, (a, b, limit))
+
+    def test_exact_by_default(self):
+        key = self.key('Der Hund')
+        self.assertTrue(matching.matches(key, ' Der   Hund '))
+        self.assertFalse(matching.matches(key, 'der Hund'))
+        self.assertFalse(matching.matches(key, 'Der Hun'))
+
+    def test_case_is_folded(self):
+        key = self.key('Straße', ignore_case=True)
+        self.assertEqual(key, 'c0\nstrasse')
+        self.assertTrue(matching.matches(key, 'STRASSE'))
+        self.assertTrue(matching.matches(key, 'straße'))
+        # A key saved when answers were only lower-cased
+        self.assertTrue(matching.matches('c0\nstraße', 'STRASSE'))
+        self.assertFalse(matching.matches(self.key('Straße'), 'STRASSE'))
+
+    def test_options(self):
+        self.assertEqual(self.key('Él; la Niña', ignore_case=True, ignore_diacritics=True, alternatives=True,
+                                  max_typos=1), 'cd1\nel\nla nina')
+        self.assertTrue(matching.matches(self.key('Café', ignore_case=True), 'CAFÉ'))
+        self.assertFalse(matching.matches(self.key('Café', ignore_case=True), 'cafe'))
+        self.assertTrue(matching.matches(self.key('Café', ignore_diacritics=True), 'Cafe'))
+        self.assertTrue(matching.matches(self.key('dog/hound', alternatives=True), 'hound'))
+        self.assertFalse(matching.matches(self.key('dog/hound'), 'hound'))
+
+    def test_typos(self):
+        key = self.key('elephant', max_typos=2)
+        for answer, accepted in (('elefant', True), ('elephnat', True), ('elephants', True), ('elefan', False),
+                                 ('ant', False)):
+            self.assertEqual(matching.matches(key, answer), accepted, answer)
+
+    def test_course_options_are_capped(self):
+        course = models.Course(ignore_case=True, max_typos=matching.MAX_TYPOS + 2)
+        self.assertEqual(matching.Options.for_course(course).header, F'c{matching.MAX_TYPOS}')
+
+
+class BatchRunTests(TestCase):
+    payload = [(11, 'der Hund', 'dog', ''),
+               (12, 'die Katze', 'cat', matching.answer_key(matching.Options(True, False, False, 1), 'cat')),
+               (13, 'das Pferd', 'horse', '')]
+
+    def run_for(self, **kwargs):
+        return quiz.BatchRun(user_id=1, lesson_id=2, version=3, run_id='00000000000000ab', start_time=0,
+                             bonus=5, wrong_a_penalty=1, show_a_penalty=2, **kwargs)
+
+    def test_events_are_regraded(self):
+        run = self.run_for()
+        mistakes, outcomes = run.apply(self.payload, [
+            {'question': 11, 'answer': 'cat'},
+            {'question': 11, 'answer': ' dog '},
+            {'question': 12, 'answer': 'CAR'},
+            {'question': 13, 'show_answer': True},
+            {'question': 13, 'answer': 'horse'},
+        ])
+        self.assertEqual(mistakes, {11: 1, 13: 1})
+        self.assertEqual(outcomes, {11: review.QUALITY_AFTER_MISTAKE, 12: review.QUALITY_PERFECT,
+                                    13: review.QUALITY_SHOWN})
+        self.assertEqual((run.score, run.mistakes_count, run.seq), (-1 + 5 + 5 - 2 + 5, 2, 1))
+        self.assertTrue(run.is_complete(self.payload))
+
+    def test_answered_questions_take_no_more_events(self):
+        run = self.run_for()
+        run.apply(self.payload, [{'question': 11, 'answer': 'dog'}])
+        for event in ({'question': 11, 'answer': 'dog'}, {'question': 11, 'show_answer': True}):
+            with self.assertRaises(ValueError):
+                quiz.BatchRun(**run.state()).apply(self.payload, [event])
+        with self.assertRaises(ValueError):
+            self.run_for().apply(self.payload, [{'question': 12, 'answer': 'cat'}] * 2)
+
+    def test_wrong_answer_keeps_the_question_current(self):
+        run = self.run_for()
+        run.apply(self.payload, [{'question': 11, 'answer': 'cat'}])
+        with self.assertRaises(ValueError):
+            quiz.BatchRun(**run.state()).apply(self.payload, [{'question': 12, 'answer': 'cat'}])
+        run.apply(self.payload, [{'question': 11, 'show_answer': True}, {'question': 12, 'answer': 'cat'},
+                                 {'question': 11, 'answer': 'dog'}])
+        self.assertEqual(run.score, -1 - 2 + 5 + 5)
+
+    def test_malformed_events_are_refused(self):
+        for event in ({'question': 99, 'answer': 'dog'}, {'answer': 'dog'}, 'dog', None):
+            with self.assertRaises(ValueError):
+                self.run_for().apply(self.payload, [event])
+
+    def test_token_round_trip(self):
+        run = self.run_for()
+        run.apply(self.payload, [{'question': 12, 'answer': 'cat'}])
+        self.assertEqual(quiz.BatchRun.from_token(run.token()).state(), run.state())
+        with self.assertRaises(signing.BadSignature):
+            quiz.BatchRun.from_token(run.token()[:-2])
+        with self.assertRaises(signing.BadSignature):
+            quiz.ReviewRun.from_token(run.token())
+
+    def test_claim(self):
+        run = self.run_for()
+        # Claims belong to the student of the run
+        run.user_id = User.objects.create_user('claim-owner').id
+        digest = quiz.request_digest([{'question': 11, 'answer': 'dog'}], False)
+        self.assertEqual(run.claim(digest), quiz.CLAIMED)
+        self.assertEqual(run.claim(quiz.request_digest([{'answer': 'dog', 'question': 11}], False)), quiz.REPEATED)
+        self.assertEqual(run.claim(quiz.request_digest([{'question': 11, 'answer': 'dog'}], True)), quiz.REUSED)
+        run.seq += 1
+        self.assertEqual(run.claim(digest), quiz.CLAIMED)
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, other = User.objects.create_user('export-user'), User.objects.create_user('export-other')
+        cls.course = models.Course.objects.create(name='Exported', author=cls.user)
+        models.Course.objects.create(name='Not studied', author=cls.user)
+        lesson = models.Lesson.objects.create(course=cls.course, name='Lesson, "one"')
+        question = models.Question.objects.create(lesson=lesson, question_text='der Hund', answer_text='dog')
+        for student, points in ((cls.user, 7), (other, 3)):
+            models.CourseStudent.objects.create(course=cls.course, student=student)
+            models.QuestionStudent.objects.create(question=question, student=student, mistakes_count=points)
+            models.LessonStudent.objects.create(lesson=lesson, student=student, date_time=timezone.now(),
+                                                elapsed_time=10, points=points, mistakes_count=1)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def export(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_jsonl(self):
+        records = [json.loads(line) for line in self.export('/export').splitlines()]
+        self.assertEqual([record['type'] for record in records],
+                         ['course', 'lesson', 'question', 'question_progress', 'attempt'])
+        by_type = {record['type']: record for record in records}
+        self.assertEqual(by_type['course']['name'], 'Exported')
+        self.assertEqual(by_type['lesson']['name'], 'Lesson, "one"')
+        self.assertEqual(by_type['question']['answer_text'], 'dog')
+        # Only the learning history of the user who exports
+        self.assertEqual(by_type['question_progress']['student__username'], 'export-user')
+        self.assertEqual(by_type['attempt']['points'], 7)
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export(F'/course/{self.course.id}/export?format=csv'))))
+        firsts = [row[0] for row in rows]
+        self.assertEqual([first for first in firsts if first], ['#course', '#lesson', '#question',
+                                                                '#question_progress', '#attempt', '#attempt_summary'])
+        self.assertEqual(rows[firsts.index('#lesson') + 1][3], 'Lesson, "one"')
+
+    def test_headers_and_format(self):
+        response = self.client.get(F'/course/{self.course.id}/export?format=csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], F'attachment; filename="course-{self.course.id}.csv"')
+        self.assertEqual(self.client.get('/export?format=xml').status_code, 400)
+
+
+class ProgressTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('progress-user')
+        cls.course = models.Course.objects.create(name='Progress', author=cls.user)
+        cls.lessons = [models.Lesson.objects.create(course=cls.course, name=F'Progress {i}') for i in range(2)]
+
+    def setUp(self):
+        caching.lesson_course_id.cache_clear()
+        self.start = timezone.make_aware(datetime.datetime(2024, 3, 4, 12))
+
+    def attempt(self, lesson, day, points, mistakes_count=0, elapsed_time=30):
+        attempt = models.LessonStudent.objects.create(student=self.user, lesson=lesson,
+                                                      date_time=self.start + datetime.timedelta(days=day),
+                                                      elapsed_time=elapsed_time, points=points,
+                                                      mistakes_count=mistakes_count)
+        progress.record_attempt(attempt)
+        return attempt
+
+    def lesson_progress(self):
+        return {row.pop('lesson'): row for row in models.LessonProgress.objects
+                .filter(student=self.user)
+                .values('lesson', 'attempts_count', 'best_points', 'last_points', 'points_total',
+                        'elapsed_time_total', 'mistakes_total', 'last_date_time')}
+
+    def test_first_attempt_creates_the_rollup(self):
+        self.attempt(self.lessons[0], 0, 7, mistakes_count=2)
+        self.assertEqual(self.lesson_progress(), {self.lessons[0].id: {
+            'attempts_count': 1, 'best_points': 7, 'last_points': 7, 'points_total': 7, 'elapsed_time_total': 30,
+            'mistakes_total': 2, 'last_date_time': self.start}})
+
+    def test_repeated_attempts_add_up_and_keep_the_best_score(self):
+        self.attempt(self.lessons[0], 0, 7, mistakes_count=2)
+        self.attempt(self.lessons[0], 1, 12)
+        last = self.attempt(self.lessons[0], 2, 3, mistakes_count=1)
+        self.assertEqual(self.lesson_progress(), {self.lessons[0].id: {
+            'attempts_count': 3, 'best_points': 12, 'last_points': 3, 'points_total': 22, 'elapsed_time_total': 90,
+            'mistakes_total': 3, 'last_date_time': last.date_time}})
+
+    def test_rebuild_matches_the_incremental_rollup(self):
+        for day, lesson, points in ((0, 0, 5), (0, 1, -2), (1, 0, 9), (3, 1, 4)):
+            self.attempt(self.lessons[lesson], day, points, mistakes_count=day)
+        incremental = self.lesson_progress()
+        self.assertEqual(progress.rebuild_lesson_progress(batch_size=1), 2)
+        self.assertEqual(self.lesson_progress(), incremental)
+
+    def course_progress(self):
+        return models.CourseProgress.objects.filter(student=self.user, course=self.course).values(
+            'lessons_attempted', 'attempts_count', 'points_total', 'elapsed_time_total', 'mistakes_total',
+            'last_date_time', 'last_study_date', 'current_streak', 'longest_streak').get()
+
+    def test_streak_grows_on_consecutive_days(self):
+        for day in (0, 0, 1, 2):
+            self.attempt(self.lessons[0], day, 1)
+        row = self.course_progress()
+        self.assertEqual((row['current_streak'], row['longest_streak']), (3, 3))
+        self.assertEqual(row['last_study_date'], (self.start + datetime.timedelta(days=2)).date())
+
+    def test_streak_resets_after_a_missed_day(self):
+        for day in (0, 1, 2, 4):
+            self.attempt(self.lessons[0], day, 1)
+        row = self.course_progress()
+        self.assertEqual((row['current_streak'], row['longest_streak']), (1, 3))
+
+    def test_course_rebuild_matches_the_incremental_rollup(self):
+        for day, lesson, points in ((0, 0, 5), (1, 1, -2), (1, 0, 9), (2, 1, 4), (5, 0, 1), (6, 1, 2)):
+            self.attempt(self.lessons[lesson], day, points, mistakes_count=day)
+        incremental = self.course_progress()
+        self.assertEqual(incremental['lessons_attempted'], 2)
+        progress.rebuild_lesson_progress()
+        self.assertEqual(progress.rebuild_course_progress(batch_size=1), 1)
+        self.assertEqual(self.course_progress(), incremental)
+
+
+class StatsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('stats-user')
+        cls.course = models.Course.objects.create(name='Stats', author=cls.user)
+        models.CourseStudent.objects.create(course=cls.course, student=cls.user)
+        cls.lesson = models.Lesson.objects.create(course=cls.course, name='Stats')
+        cls.now = timezone.now()
+
+    def setUp(self):
+        caching.lesson_course_id.cache_clear()
+        self.client.force_login(self.user)
+        self.url = F'/course/{self.course.id}/lesson/{self.lesson.id}/stats/series?bucket=day'
+
+    def finish(self, days_ago, points):
+        attempt = models.LessonStudent.objects.create(student=self.user, lesson=self.lesson,
+                                                      date_time=self.now - datetime.timedelta(days=days_ago),
+                                                      elapsed_time=10, points=points, mistakes_count=1)
+        progress.record_attempt(attempt)
+
+    def series(self, bucket='day', points=stats.DEFAULT_POINTS):
+        return stats.series(stats.attempts(self.user, self.course.id, self.lesson.id),
+                            stats.summaries(self.user, self.course.id, self.lesson.id), bucket, points)
+
+    def test_series_buckets_attempts_and_summaries(self):
+        for days_ago, points in ((20, 4), (20, 8), (2, 5)):
+            self.finish(days_ago, points)
+        bucket, before = self.series()
+        self.assertEqual(bucket, 'day')
+        self.assertEqual([(point['count'], point['mean_points'], point['max_points'], point['mistakes'])
+                          for point in before], [(2, 6, 8, 2), (1, 5, 5, 1)])
+        retention.compact(keep_days=7, granularity=models.LessonAttemptSummary.DAY, archive_dir='', now=self.now)
+        self.assertEqual(models.LessonStudent.objects.count(), 1)
+        self.assertEqual(self.series(), (bucket, before))
+        _, merged = self.series(points=1)
+        self.assertEqual([(point['count'], point['max_points']) for point in merged], [(3, 8)])
+        self.assertEqual(self.series(bucket='auto')[0], 'day')
+
+    def test_unchanged_series_is_not_sent_again(self):
+        self.finish(1, 3)
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        again = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.finish(0, 7)
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+
+    def test_etag_changes_with_the_parameters_and_compaction(self):
+        self.finish(20, 3)
+        etag = stats.etag(self.user, self.course.id, self.lesson.id, 'day', 60)
+        self.assertEqual(stats.etag(self.user, self.course.id, self.lesson.id, 'day', 60), etag)
+        self.assertNotEqual(stats.etag(self.user, self.course.id, self.lesson.id, 'week', 60), etag)
+        retention.compact(keep_days=7, granularity=models.LessonAttemptSummary.WEEK, archive_dir='', now=self.now)
+        self.assertNotEqual(stats.etag(self.user, self.course.id, self.lesson.id, 'day', 60), etag)
+
+
+class CompactionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.now = timezone.now()
+        rng = random.Random(0)
+        author = User.objects.create_user('compact-author')
+        course = models.Course.objects.create(name='Compacted', author=author)
+        lessons = [models.Lesson.objects.create(course=course, name=F'Lesson {i}') for i in range(2)]
+        students = [User.objects.create_user(F'compact-user-{i}') for i in range(2)]
+        models.LessonStudent.objects.bulk_create(
+            models.LessonStudent(student=rng.choice(students), lesson=rng.choice(lessons),
+                                 date_time=cls.now - timezone.timedelta(minutes=rng.randrange(60 * 24 * 40)),
+                                 elapsed_time=rng.randrange(1000), points=rng.randrange(-5, 50),
+                                 mistakes_count=rng.randrange(5))
+            for _ in range(300))
+
+    def totals(self):
+        return list(progress.lesson_totals())
+
+    def test_totals_are_kept(self):
+        for granularity in (models.LessonAttemptSummary.DAY, models.LessonAttemptSummary.WEEK):
+            # Each granularity starts over from the raw attempts
+            with self.subTest(granularity=granularity), transaction.atomic():
+                before = self.totals()
+                cutoff = retention.compaction_cutoff(7, granularity, self.now)
+                old = models.LessonStudent.objects.filter(date_time__lt=cutoff).count()
+                recent = models.LessonStudent.objects.filter(date_time__gte=cutoff).count()
+
+                compacted = retention.compact(keep_days=7, granularity=granularity, archive_dir='', batch_size=17,
+                                              now=self.now)
+                self.assertEqual(compacted, old)
+                self.assertEqual(models.LessonStudent.objects.count(), recent)
+                self.assertEqual(self.totals(), before)
+                periods = models.LessonAttemptSummary.objects.filter(granularity=granularity)
+                self.assertFalse(periods.filter(period__gte=cutoff).exists())
+                self.assertEqual(len(set(periods.values_list('student', 'lesson', 'period'))), periods.count())
+
+                self.assertEqual(retention.compact(keep_days=7, granularity=granularity, archive_dir='',
+                                                   now=self.now), 0)
+                self.assertEqual(self.totals(), before)
+                transaction.set_rollback(True)
+
+    def test_archive_has_every_compacted_attempt(self):
+        ids = set(models.LessonStudent.objects
+                  .filter(date_time__lt=retention.compaction_cutoff(7, models.LessonAttemptSummary.DAY, self.now))
+                  .values_list('id', flat=True))
+        with tempfile.TemporaryDirectory() as archive_dir:
+            retention.compact(keep_days=7, granularity=models.LessonAttemptSummary.DAY, archive_dir=archive_dir,
+                              batch_size=50, now=self.now)
+            [name] = os.listdir(archive_dir)
+            with gzip.open(os.path.join(archive_dir, name), 'rt', encoding='utf-8') as archive:
+                self.assertEqual({json.loads(line)['id'] for line in archive}, ids)
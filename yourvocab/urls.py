@@ -8,10 +8,24 @@ urlpatterns = [
     path('course', views.course),
     path('course/<int:course_id>', views.course),
     path('course/<int:course_id>/lesson', views.lesson),
+    path('course/<int:course_id>/import', views.lesson_import),
+    path('course/<int:course_id>/export', views.export),
+    path('course/<int:course_id>/subscribe', views.subscribe),
+    path('course/<int:course_id>/dashboard', views.course_dashboard),
+    path('course/<int:course_id>/stats/series', views.stats_series),
     path('course/<int:course_id>/lesson/<int:lesson_id>', views.lesson),
+    path('course/<int:course_id>/lesson/<int:lesson_id>/patch', views.lesson_patch),
     path('course/<int:course_id>/lesson/<int:lesson_id>/check', views.check),
+    path('course/<int:course_id>/lesson/<int:lesson_id>/run', views.lesson_run),
     path('course/<int:course_id>/lesson/<int:lesson_id>/stats', views.lesson_stats),
+    path('course/<int:course_id>/lesson/<int:lesson_id>/stats/series', views.stats_series),
     path('course/<int:course_id>/lesson/<int:lesson_id>/delete', views.lesson_delete),
+    path('course/<int:course_id>/lesson/<int:lesson_id>/restore', views.lesson_restore),
+    path('export', views.export),
+    path('catalog', views.public_courses),
+    path('review', views.review_due),
+    path('review/run', views.review_run),
+    path('metrics', views.metrics),
     path('signup', views.signup),
     path('account_activation_sent', views.account_activation_sent),
     path('activate/<slug:uidb64>/<slug:token>/', views.activate, name='activate'),
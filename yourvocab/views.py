@@ -1,21 +1,33 @@
 import datetime
-import random
+import io
+import json
 
+from django.conf import settings
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.forms import PasswordResetForm, SetPasswordForm
 from django.contrib.sites.shortcuts import get_current_site
-from django.http import JsonResponse
-from django.shortcuts import render, redirect
+from django.core import signing
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render, redirect
 from django.template.loader import render_to_string
-from django.utils.encoding import force_bytes, force_text
+from django.utils import timezone
+from django.utils.encoding import force_bytes, force_str
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from django.views.decorators.http import condition, require_POST
 from django.views.defaults import server_error
 
-from yourvocab import forms, models
+from yourvocab import (caching, catalog, editing, exporting, forms, importing, jobs, models, pool, progress, purging,
+                       quiz, review, stats)
+from yourvocab.budgets import budget
+from yourvocab.metrics import registry
+from yourvocab.routing import replica_reads
 from yourvocab.tokens import account_activation_token
 
 
+@budget(queries=6)
 def signup(request):
     if request.method == 'POST':
         form = forms.SignUpForm(request.POST)
@@ -31,21 +43,23 @@ def signup(request):
                 'uid': urlsafe_base64_encode(force_bytes(user.pk)),
                 'token': account_activation_token.make_token(user),
             })
-            user.email_user(subject, message, 'noreply@yourvocab.heroku.com')
+            jobs.send_mail(subject, message, 'noreply@yourvocab.heroku.com', [user.email])
             return redirect('/account_activation_sent')
     else:
         form = forms.SignUpForm()
     return render(request, 'signup.html', {'form': form})
 
 
+@budget(queries=0)
 def account_activation_sent(request):
     return render(request, 'instructions_message.html',
                   {'message':'Please confirm your email address to complete the registration. '})
 
 
+@budget(queries=13, session_bytes=512)
 def activate(request, uidb64, token):
     try:
-        uid = force_text(urlsafe_base64_decode(uidb64))
+        uid = force_str(urlsafe_base64_decode(uidb64))
         user = models.User.objects.get(pk=uid)
     except (TypeError, ValueError, OverflowError, models.User.DoesNotExist):
         user = None
@@ -61,30 +75,37 @@ def activate(request, uidb64, token):
                       {'message': 'The confirmation link was invalid, possibly because it has already been used.'})
 
 
+@budget(queries=2)
 def forgot_pass(request):
     if request.method == 'POST':
-        form = PasswordResetForm(request.POST)
+        form = forms.QueuedPasswordResetForm(request.POST)
         if form.is_valid():
             form.save(from_email='noreply@yourvocab.heroku.com', request=request)
             return render(request, 'instructions_message.html',
                           {'message': 'Please check your email. '})
 
     else:
-        form = PasswordResetForm()
+        form = forms.QueuedPasswordResetForm()
     return render(request, 'passreset.html', {'form': form})
 
 
+def page_cursor(request):
+    try:
+        return int(request.GET.get('after', 0)) or None
+    except ValueError:
+        return None
+
+
+@budget(queries=3)
 def courses(request):
     if request.user.is_authenticated:
-        user = request.user
-
-        mycourses = models.CourseStudent.objects.filter(student=user).all()
-        course_list = list([x.course for x in mycourses])
-        return render(request, 'yourvocab/courses_list.html', {'courses': course_list})
+        page = caching.course_list(request.user, page_cursor(request))
+        return render(request, 'yourvocab/courses_list.html', page)
     else:
         return render(request, 'yourvocab/index.html', {'user': request.user})
 
 
+@budget(queries=6)
 @login_required
 def course(request, course_id=None):
     if request.method == 'POST':
@@ -104,217 +125,547 @@ def course(request, course_id=None):
             return redirect(F'/course/{course.id}')
 
     if course_id:
-        cur_course = models.Course.objects.get(pk=course_id)
-        cur_setup = models.CourseStudent.objects.get(course=cur_course, student=request.user)
-        lessons = models.Lesson.objects.filter(course=cur_course).all()
-        return render(request, 'yourvocab/course.html', {'course': cur_course,
-                                                         'setup': cur_setup,
-                                                         'lessons': lessons})
+        detail = caching.course_detail(request.user, course_id, page_cursor(request))
+        return render(request, 'yourvocab/course.html', detail)
     else:
         return render(request, 'yourvocab/new_course.html', {'form': forms.CourseForm()})
 
 
-def assess_answer(target, answer, request, show_answer, no_score_upd):
-    session = request.session
-    if no_score_upd:
-        return True, session['score']
+@budget(queries=5)
+@login_required
+def subscribe(request, course_id):
+    """Enroll the user in a public course; the lessons stay shared with the author."""
+    if request.method != 'POST':
+        return redirect('/catalog')
+    course = models.Course.objects.get(pk=course_id)
+    if not course.public and course.author_id != request.user.id:
+        return HttpResponse(status=403)
 
-    q = models.Question.objects.get(pk=target['id'])
+    if not models.CourseStudent.objects.filter(course=course, student=request.user).exists():
+        models.CourseStudent.objects.create(course=course, student=request.user)
+    return redirect(F'/course/{course.id}')
 
-    if show_answer:
-        session['qa'].append(target)
-        session['mistakes_count'] += 1
-        qs = models.QuestionStudent.objects.filter(question=q, student=request.user).first()
-        qs.mistakes_count += 1
-        qs.save()
-        return False, session['score'] - session['show_a_penalty']
 
-    if target['answer_text'].strip() == answer.strip():
-        return True, session['score'] + session['bonus']
+@budget(queries=8)
+@login_required
+def course_dashboard(request, course_id):
+    detail = caching.course_detail(request.user, course_id, page_cursor(request))
+    summary = models.CourseProgress.objects.filter(course_id=course_id, student=request.user).first()
+
+    mastered = progress.lesson_mastery(request.user, course_id)
+    lessons = [dict(lesson, mastered=mastered.get(lesson['id'], 0)) for lesson in detail['lessons']]
+
+    return render(request, 'yourvocab/course_dashboard.html', {
+        'course': detail['course'],
+        'lessons': lessons,
+        'summary': summary,
+        'streak': summary.streak_on(timezone.localdate()) if summary else 0,
+        'hardest': progress.hardest_questions(request.user, course_id),
+        'next': detail['next'],
+    })
+
+
+@budget(queries=21)
+@pool.login_required
+async def check(request, course_id, lesson_id):
+    """The lesson page, and the answers of runs answered one question per request.
+
+    An async view: the run travels in a signed token (quiz.QuizRun), the answer is graded
+    from the cached lesson payload and only the database work goes to the thread pool.
+    """
+    if request.method != 'POST':
+        return await pool.run(lesson_page, request, course_id, lesson_id)
 
-    session['mistakes_count'] += 1
-    qs = models.QuestionStudent.objects.filter(question=q, student=request.user).first()
-    qs.mistakes_count += 1
-    qs.save()
-    return False, session['score'] - session['wrong_a_penalty']
+    try:
+        run = quiz.QuizRun.from_token(request.POST['token'])
+    except (KeyError, signing.BadSignature):
+        return JsonResponse({'result': 'expired'})
+    if run.user_id != request.user.id or run.lesson_id != lesson_id:
+        return JsonResponse({'result': 'expired'})
+
+    payload = await pool.run(quiz.lesson_payload, lesson_id, run.version)
+    if payload is None:
+        # The lesson has been edited since the run started
+        return JsonResponse({'result': 'expired'})
+
+    show_answer = request.POST['show_answer'] == 'true'
+    no_score_upd = request.POST['no_score_upd'] == 'true'
+
+    target = payload[run.position()]
+    to_next, mistakes, outcomes = run.answer(target, request.POST['answer'], show_answer, no_score_upd)
+    finish = to_next and run.is_last
+    if finish:
+        mistakes = run.take_pending(mistakes)
+
+    digest = quiz.request_digest(request.POST['answer'], show_answer, no_score_upd)
+    if await pool.run(record_run, request, run, digest, mistakes, outcomes, finish) == quiz.REUSED:
+        return JsonResponse({'result': 'error', 'message': 'The answer has been sent already'}, status=409)
+    score = run.score
+
+    if not to_next:
+        _, question_text, answer_text, _ = target
+
+        if show_answer:
+            return JsonResponse({'result': 'show_answer',
+                                 'question': question_text,
+                                 'score': F'Your score: {score}.',
+                                 'last': False,
+                                 'answer': 'The right answer was: ' + answer_text,
+                                 'token': run.token()})
+        else:
+            return JsonResponse({'result': 'mistake',
+                                 'question': question_text,
+                                 'score': F'Your score: {score}.',
+                                 'last': False,
+                                 'answer': 'The right answer was: ' + answer_text,
+                                 'token': run.token()
+                                 })
+
+    if not finish:
+        run.index += 1
+
+        title = F'Question {run.index + 1} out of {run.total}. {payload[run.position()][1]}'
+        return JsonResponse({'result': 'ok',
+                             'question': title,
+                             'last': False,
+                             'score': F'Your score: {score}. {"Learning is a process and progress!" if score <= 0 else "Well done!"}',
+                             'token': run.token()})
+    else:
+        title = F'Well done! You have finished the lesson with score {score}.'
+        return JsonResponse({'result': 'ok',
+                             'question': title,
+                             'last': True,
+                             'score': "Keep learning! No pain no gain!" if score <= 0 else "You are awesome."})
 
 
-@login_required
-def check(request, course_id, lesson_id):
+def lesson_page(request, course_id, lesson_id):
     course = models.Course.objects.get(pk=course_id)
     lesson = models.Lesson.objects.get(pk=lesson_id)
 
-    qa = list(models.Question.objects.filter(lesson=lesson).all())
-    if len(qa) == 0:
+    payload = quiz.lesson_payload(lesson.id, lesson.version)
+    if not payload:
         return server_error(request)
 
-    if request.method == 'POST':
-        show_answer = request.POST['show_answer'] == 'true'
-        no_score_upd = request.POST['no_score_upd'] == 'true'
+    setup = models.CourseStudent.objects.filter(course=course, student=request.user).first()
 
-        answer = request.POST['answer']
-        question_index = request.session['question_index']
-        qa = request.session['qa']
+    if settings.YOURVOCAB_BATCH_ANSWERS:
+        run_data = quiz.BatchRun.start(request.user, lesson, setup).client_data(payload)
+        question_text = run_data['questions'][0]['question']
+        token = None
+    else:
+        run_data = None
+        if settings.YOURVOCAB_BUFFER_MISTAKES:
+            quiz.flush_abandoned(request.user)
+        run = quiz.QuizRun.start(request.user, lesson, setup, len(payload))
+        question_text = payload[run.position()][1]
+        token = run.token()
 
-        target = qa[question_index]
+    return render(request, 'yourvocab/check.html', {'course': course,
+                                                    'lesson': lesson,
+                                                    'question_index': 1,
+                                                    'questions_count': len(payload),
+                                                    'qa': {'question_text': question_text},
+                                                    'run': run_data,
+                                                    'token': token,
+                                                    'run_url': F'/course/{course.id}/lesson/{lesson.id}/run'})
+
+
+def record_run(request, run, digest, mistakes, outcomes, finish):
+    """The database side of a graded check or lesson_run request.
+
+    Returns what claiming its run token found (see SignedRun.claim); only a request that
+    claims the token is recorded, a repeated one has been already.
+    """
+    with transaction.atomic():
+        claimed = run.claim(digest)
+        if claimed == quiz.CLAIMED:
+            quiz.add_mistakes(request.user, mistakes)
+            review.schedule(request.user, outcomes)
+            if finish:
+                finish_lesson(request, run.lesson_id, run.score, run.mistakes_count, run.start_time)
+    return claimed
+
+
+def finish_lesson(request, lesson_id, score, mistakes_count, start_time):
+    elapsed_time = datetime.datetime.now().timestamp() - start_time
+    with transaction.atomic():
+        models.Lesson.objects.filter(pk=lesson_id).update(attendance_count=F('attendance_count') + 1)
+        score_data = models.LessonStudent(student=request.user,
+                                          lesson_id=lesson_id,
+                                          date_time=timezone.now(),
+                                          elapsed_time=elapsed_time,
+                                          points=score,
+                                          mistakes_count=mistakes_count)
+        score_data.save()
+        progress.record_attempt(score_data)
+
+
+@budget(queries=21)
+@pool.login_required
+async def lesson_run(request, course_id, lesson_id):
+    """JSON API for lesson runs graded on the client.
+
+    GET starts a run and returns the shuffled questions with a run token. POST takes
+    {"token": ..., "events": [...], "finish": true|false}, records the batch and answers
+    with the next token, so a whole lesson can be submitted in a single request. Async
+    like check.
+    """
+    if request.method != 'POST':
+        return await pool.run(start_lesson_run, request, course_id, lesson_id)
 
-        to_next, score = assess_answer(target, answer, request, show_answer, no_score_upd)
-        request.session['score'] = score
-        qa = request.session['qa']  # could have been changed in assess_answer #TODO: smells, refactor
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        run = quiz.BatchRun.from_token(data['token'])
+        events = list(data.get('events', []))
+    except (ValueError, KeyError, TypeError, signing.BadSignature):
+        return JsonResponse({'result': 'error', 'message': 'Malformed request'}, status=400)
 
-        if not to_next:
+    if run.user_id != request.user.id or run.lesson_id != lesson_id:
+        return JsonResponse({'result': 'error', 'message': 'The run belongs to another lesson'}, status=400)
 
-            if show_answer:
-                return JsonResponse({'result': 'show_answer',
-                                     'question': target['question_text'],
-                                     'score': F'Your score: {score}.',
-                                     'last': False,
-                                     'answer': 'The right answer was: ' + target['answer_text']})
-            else:
-                return JsonResponse({'result': 'mistake',
-                                     'question': target['question_text'],
-                                     'score': F'Your score: {score}.',
-                                     'last': False,
-                                     'answer': 'The right answer was: ' + target['answer_text']
-                                     })
-
-        if question_index < len(qa) - 1:
-            question_index += 1
-            request.session['question_index'] = question_index
-
-            title = F'Question {question_index + 1} out of {len(qa)}. {qa[question_index]["question_text"]}'
-            return JsonResponse({'result': 'ok',
-                                 'question': title,
-                                 'last': False,
-                                 'score': F'Your score: {score}. {"Learning is a process and progress!" if score <= 0 else "Well done!"}'})
-        else:
-            title = F'Well done! You have finished the lesson with score {request.session["score"]}.'
-            lesson.attendance_count += 1
-            lesson.save()
-
-            elapsed_time = datetime.datetime.now().timestamp() - request.session['start_time']
-            score_data = models.LessonStudent(student=request.user,
-                                              lesson=lesson,
-                                              date_time=datetime.datetime.now(),
-                                              elapsed_time=elapsed_time,
-                                              points=score,
-                                              mistakes_count=request.session['mistakes_count'])
-            score_data.save()
-
-            return JsonResponse({'result': 'ok',
-                                 'question': title,
-                                 'last': True,
-                                 'score': "Keep learning! No pain no gain!" if score <= 0 else "You are awesome."})
-
-    if len(qa) == 0:
-        return server_error(request)
+    payload = await pool.run(quiz.lesson_payload, lesson_id, run.version)
+    if payload is None:
+        return JsonResponse({'result': 'expired'}, status=409)
 
-    random.shuffle(qa)
+    try:
+        mistakes, outcomes = run.apply(payload, events)
+    except ValueError as e:
+        return JsonResponse({'result': 'error', 'message': str(e)}, status=400)
 
-    request.session['qa'] = [{'question_text': i.question_text,
-                              'answer_text': i.answer_text,
-                              'id': i.id} for i in qa]
-    request.session['question_index'] = 0
-    request.session['score'] = 0
-    request.session['start_time'] = datetime.datetime.now().timestamp()
+    finish = bool(data.get('finish'))
+    if finish and not run.is_complete(payload):
+        return JsonResponse({'result': 'error', 'message': 'Not all questions have been answered'}, status=400)
 
-    setup = models.CourseStudent.objects.filter(course=course, student=request.user).first()
+    digest = quiz.request_digest(events, finish)
+    if await pool.run(record_run, request, run, digest, mistakes, outcomes, finish) == quiz.REUSED:
+        return JsonResponse({'result': 'error', 'message': 'The run token has been used already'}, status=409)
 
-    request.session['bonus'] = setup.answer_bonus
-    request.session['wrong_a_penalty'] = setup.mistake_penalty
-    request.session['show_a_penalty'] = setup.show_answer_penalty
-    request.session['mistakes_count'] = 0
+    if finish:
+        return JsonResponse({'result': 'finished', 'score': run.score, 'mistakes_count': run.mistakes_count})
+    return JsonResponse({'result': 'ok', 'token': run.token(), 'score': run.score})
 
-    qa_pair = qa[0]
-    questions_count = len(qa)
 
-    return render(request, 'yourvocab/check.html', {'course': course,
-                                                    'lesson': lesson,
-                                                    'question_index': 1,
-                                                    'questions_count': questions_count,
-                                                    'qa': qa_pair})
+def start_lesson_run(request, course_id, lesson_id):
+    lesson = models.Lesson.objects.get(pk=lesson_id, course_id=course_id)
+    payload = quiz.lesson_payload(lesson.id, lesson.version)
+    if not payload:
+        return JsonResponse({'result': 'error', 'message': 'The lesson has no questions'}, status=400)
+
+    setup = models.CourseStudent.objects.get(course_id=course_id, student=request.user)
+    return JsonResponse(quiz.BatchRun.start(request.user, lesson, setup).client_data(payload))
+
+
+@budget(queries=3)
+@login_required
+def review_due(request):
+    try:
+        count = min(int(request.GET.get('count', review.REVIEW_SIZE)), review.MAX_REVIEW_SIZE)
+    except ValueError:
+        count = review.REVIEW_SIZE
+
+    items = review.due_items(request.user, count)
+    if not items:
+        return render(request, 'instructions_message.html', {'message': 'Nothing to review yet. Come back later!'})
+
+    run = quiz.ReviewRun.start(request.user, items)
+    run_data = run.client_data(items)
+    return render(request, 'yourvocab/review.html', {'question_index': 1,
+                                                     'questions_count': len(items),
+                                                     'qa': {'question_text': run_data['questions'][0]['question']},
+                                                     'run': run_data,
+                                                     'run_url': '/review/run'})
+
+
+@budget(queries=10)
+@login_required
+def review_run(request):
+    """Takes the events of a review run in the same format as lesson_run."""
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        run = quiz.ReviewRun.from_token(data['token'])
+        events = list(data.get('events', []))
+    except (ValueError, KeyError, TypeError, signing.BadSignature):
+        return JsonResponse({'result': 'error', 'message': 'Malformed request'}, status=400)
+
+    if run.user_id != request.user.id:
+        return JsonResponse({'result': 'error', 'message': 'The run belongs to another user'}, status=400)
+
+    payload = run.payload()
+    if payload is None:
+        return JsonResponse({'result': 'expired'}, status=409)
+
+    try:
+        mistakes, outcomes = run.apply(payload, events)
+    except ValueError as e:
+        return JsonResponse({'result': 'error', 'message': str(e)}, status=400)
 
+    finish = bool(data.get('finish'))
+    with transaction.atomic():
+        claimed = run.claim(quiz.request_digest(events, finish))
+        if claimed == quiz.CLAIMED:
+            quiz.add_mistakes(request.user, mistakes)
+            review.schedule(request.user, outcomes)
+    if claimed == quiz.REUSED:
+        return JsonResponse({'result': 'error', 'message': 'The run token has been used already'}, status=409)
 
+    if finish:
+        return JsonResponse({'result': 'finished', 'mistakes_count': run.mistakes_count})
+    return JsonResponse({'result': 'ok', 'token': run.token()})
+
+
+@budget(queries=12)
 @login_required
 def lesson(request, course_id, lesson_id=None):
     course = models.Course.objects.get(pk=course_id)
-    lesson = models.Lesson.objects.get(pk=lesson_id) if lesson_id else None
+    if course.author_id != request.user.id:
+        # Lessons are shared with the subscribers, only the author may change them
+        return HttpResponse(status=403)
+    lesson = get_object_or_404(models.Lesson, pk=lesson_id, course=course) if lesson_id else None
 
     if request.method == 'POST':
         form = forms.LessonForm(request.POST, instance=lesson)
 
         if form.is_valid():
-            lesson = form.save(commit=False)
-            lesson.course = course
-
             questions = form.cleaned_data['questions'].split('\r\n')
             answers = form.cleaned_data['answers'].split('\r\n')
 
             if len(questions) != len(answers):
                 return server_error(request)
+            lines = [(q.strip(), a.strip()) for (q, a) in zip(questions, answers)]
+
+            try:
+                with transaction.atomic():
+                    if lesson is None:
+                        lesson = form.save(commit=False)
+                        lesson.course = course
+                        lesson.save()
+                        editing.save_questions(lesson, lines)
+                        transaction.on_commit(lambda: catalog.index_lesson(lesson))
+                    else:
+                        changes = editing.save_lesson(lesson, form.cleaned_data['version'], form.cleaned_data['name'],
+                                                      lines)
+                        transaction.on_commit(lambda: catalog.index_changes(lesson, changes))
+            except editing.PatchRejected as e:
+                form.add_error(None, F'{e}. Reload it and make your changes again.')
+            else:
+                return redirect(F'/course/{course.id}')
+    elif lesson:
+        qa = list(models.Question.objects
+                  .filter(lesson=lesson)
+                  .order_by('position', 'id')
+                  .only('question_text', 'answer_text'))
+        questions = '\n'.join([q.question_text for q in qa])
+        answers = '\n'.join([q.answer_text for q in qa])
+        form = forms.LessonForm({'name': lesson.name, 'questions': questions, 'answers': answers,
+                                 'version': lesson.version}, instance=lesson)
+        return render(request, 'yourvocab/new_lesson.html', {'form': form, 'helper_symbols': course.helper_symbols,
+                                                             'lesson': lesson, 'lines_count': len(qa)})
+    else:
+        form = forms.LessonForm()
+
+    return render(request, 'yourvocab/new_lesson.html', {'form': form, 'helper_symbols': course.helper_symbols})
 
-            lesson.save()
 
-            # Regenerating all questions for particular lesson:
+@budget(queries=15)
+@login_required
+@require_POST
+def lesson_patch(request, course_id, lesson_id):
+    """JSON API of the lesson editor, which sends the changed lines instead of the whole lesson.
+
+    Takes {"version": ..., "name": ..., "hunks": [{"start", "delete", "questions", "answers"}]},
+    each hunk replacing `delete` lines from line `start` of that lesson version, and answers
+    with the new version. A patch made against an older version is refused with 409.
+    """
+    if not models.Course.objects.filter(pk=course_id, author_id=request.user.id).exists():
+        return HttpResponse(status=403)
+    try:
+        lesson = models.Lesson.objects.select_related('course').get(pk=lesson_id, course_id=course_id)
+    except models.Lesson.DoesNotExist:
+        return JsonResponse({'result': 'error', 'message': 'No such lesson'}, status=404)
 
-            last_qa = models.Question.objects.filter(lesson=lesson)
-            q_stats = {}
-            for last_q in last_qa:
-                qs = models.QuestionStudent.objects.get(question=last_q, student=request.user)
-                q_stats[(last_q.question_text, last_q.answer_text)] = qs.mistakes_count
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        version = data['version']
+        name = data.get('name')
+        hunks = editing.parse_hunks(data['hunks'])
+        if type(version) is not int or not (name is None or isinstance(name, str)):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'result': 'error', 'message': 'Malformed request'}, status=400)
+    except editing.PatchRejected as e:
+        return JsonResponse({'result': 'error', 'message': str(e)}, status=400)
+
+    if name is not None:
+        name = name.strip()
+        if not name or len(name) > models.Lesson._meta.get_field('name').max_length:
+            return JsonResponse({'result': 'error', 'message': 'The lesson name should be 1 to 200 characters'},
+                                status=400)
+
+    renamed = name is not None and name != lesson.name
+    try:
+        with transaction.atomic():
+            changes = editing.patch_lesson(lesson, version, hunks, name=name)
+            if changes or renamed:
+                transaction.on_commit(lambda: catalog.index_changes(lesson, changes))
+    except editing.PatchRejected as e:
+        return JsonResponse({'result': 'conflict' if e.conflict else 'error', 'message': str(e)},
+                            status=409 if e.conflict else 400)
 
-            last_qa.delete()
+    return JsonResponse({'result': 'ok', 'version': lesson.version})
 
-            for (q, a) in zip(questions, answers):
-                qa = models.Question(question_text=q.strip(), answer_text=a.strip(), lesson=lesson)
-                qa.save()
 
-                q_key = (q.strip(), a.strip())
-                mistakes_count = q_stats[q_key] if q_key in q_stats else 0
+@budget(queries=8)
+@login_required
+def lesson_import(request, course_id):
+    course = models.Course.objects.get(pk=course_id)
+    if course.author_id != request.user.id:
+        return HttpResponse(status=403)
 
-                qs = models.QuestionStudent(question=qa, student=request.user, mistakes_count=mistakes_count)
-                qs.save()
+    if request.method == 'POST':
+        form = forms.ImportForm(request.POST, request.FILES)
 
-            return redirect(F'/course/{course.id}')
-    elif lesson:
-        qa = models.Question.objects.filter(lesson=lesson).all()
-        questions = '\n'.join([q.question_text for q in qa])
-        answers = '\n'.join([q.answer_text for q in qa])
-        form = forms.LessonForm({'name': lesson.name, 'questions': questions, 'answers': answers}, instance=lesson)
-        return render(request, 'yourvocab/new_lesson.html', {'form': form, 'helper_symbols': course.helper_symbols})
+        if form.is_valid():
+            lines = io.TextIOWrapper(form.cleaned_data['file'].file, encoding='utf-8-sig', newline='')
+            try:
+                imported = importing.import_lessons(course, lines,
+                                                    name=form.cleaned_data['name'],
+                                                    split_every=form.cleaned_data['split_every'])
+            except importing.ImportFailed as e:
+                for line_number, error in e.errors:
+                    form.add_error('file', F'Line {line_number}: {error}')
+            except UnicodeDecodeError:
+                form.add_error('file', 'The file should be UTF-8 encoded text')
+            else:
+                if imported:
+                    return redirect(F'/course/{course.id}')
+                form.add_error('file', 'The file has no words in it')
     else:
-        form = forms.LessonForm()
+        form = forms.ImportForm()
 
-    return render(request, 'yourvocab/new_lesson.html', {'form': form, 'helper_symbols': course.helper_symbols})
+    return render(request, 'yourvocab/import_lessons.html', {'form': form, 'course': course})
+
+
+@budget(queries=8)
+@login_required
+@pool.streamed_under_asgi
+@replica_reads
+def export(request, course_id=None):
+    """Streams the user's courses (or just one of them) with their learning history."""
+    output_format = request.GET.get('format', 'jsonl')
+    if output_format not in exporting.FORMATS:
+        return JsonResponse({'result': 'error', 'message': 'Unknown format'}, status=400)
+
+    courses = exporting.user_courses(request.user)
+    if course_id:
+        courses = courses.filter(pk=course_id)
+
+    response = StreamingHttpResponse(exporting.render(exporting.tables(courses, student=request.user), output_format),
+                                     content_type=exporting.FORMATS[output_format])
+    name = F'course-{course_id}' if course_id else F'yourvocab-{request.user.username}'
+    response['Content-Disposition'] = F'attachment; filename="{name}.{output_format}"'
+    return response
+
+
+@budget(queries=3)
+@replica_reads
+def public_courses(request):
+    query = request.GET.get('q', '')
+    courses, next_cursor = catalog.search(query, after=page_cursor(request))
+    return render(request, 'yourvocab/catalog.html', {'courses': courses,
+                                                      'query': query,
+                                                      'next_cursor': next_cursor})
 
 
+@budget(queries=6)
+@replica_reads
 def lesson_stats(request, course_id, lesson_id):
     course = models.Course.objects.get(pk=course_id)
     lesson = models.Lesson.objects.get(pk=lesson_id)
 
-    qa = models.Question.objects.filter(lesson=lesson)
-    qs = [models.QuestionStudent.objects.get(question=q, student=request.user) for q in qa]
+    summary = models.LessonProgress.objects.filter(lesson=lesson, student=request.user).first()
 
-    scores = models.LessonStudent.objects.filter(lesson=lesson, student=request.user)
+    mistakes = models.QuestionStudent.objects.filter(question=OuterRef('pk'), student=request.user)
+    qa = list(models.Question.objects
+              .filter(lesson=lesson)
+              .order_by('position', 'id')
+              .annotate(mistakes=Coalesce(Subquery(mistakes.values('mistakes_count')[:1]), 0))
+              .values_list('question_text', 'mistakes'))
 
-    count = qa.count()
+    count = len(qa)
     mistake_colors = ['rgba(255, 99, 132, 0.2)', ] * count
     mistake_borders = ['rgba(255, 99, 132, 1)', ] * count
-    mistake_data = [q.mistakes_count for q in qs]
-    mistake_label = [q.question_text for q in qa]
-
-    attendance_dict = [{'x': s.date_time.strftime('%Y-%m-%d %H:%M'), 'y': s.points} for s in scores]
+    mistake_data = [mistakes_count for (_, mistakes_count) in qa]
+    mistake_label = [question_text for (question_text, _) in qa]
 
     return render(request, 'yourvocab/lesson_stats.html', {'course': course,
                                                            'lesson': lesson,
-                                                           'attendance_dict': attendance_dict,
+                                                           'summary': summary,
+                                                           'series_url': F'/course/{course.id}/lesson/{lesson.id}/stats/series',
                                                            'mistake_colors': mistake_colors,
                                                            'mistake_borders': mistake_borders,
                                                            'mistake_data': mistake_data,
                                                            'mistake_label': mistake_label})
 
 
+def series_parameters(request):
+    bucket = request.GET.get('bucket', 'auto')
+    try:
+        points = max(1, min(int(request.GET.get('points', stats.DEFAULT_POINTS)), stats.MAX_POINTS))
+    except ValueError:
+        points = stats.DEFAULT_POINTS
+    return bucket, points
+
+
+def stats_etag(request, course_id, lesson_id=None):
+    return stats.etag(request.user, course_id, lesson_id, *series_parameters(request))
+
+
+@budget(queries=8)
+@login_required
+@replica_reads
+@condition(etag_func=stats_etag)
+def stats_series(request, course_id, lesson_id=None):
+    """The user's attempts in a lesson, or a whole course, bucketed by day, week or month.
+
+    Takes ?bucket=auto|day|week|month and ?points=<at most this many buckets>.
+    """
+    bucket, points = series_parameters(request)
+    bucket, series = stats.series(stats.attempts(request.user, course_id, lesson_id),
+                                  stats.summaries(request.user, course_id, lesson_id),
+                                  bucket, points)
+    response = JsonResponse({'bucket': bucket, 'series': series})
+    # Per user, and always revalidated with the ETag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@budget(queries=0)
+def metrics(request):
+    """Request metrics of this process in the Prometheus text format."""
+    token = settings.YOURVOCAB_METRICS_TOKEN
+    if token and request.META.get('HTTP_AUTHORIZATION') != F'Bearer {token}':
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4')
+
+
+@budget(queries=8)
+@login_required
+@require_POST
 def lesson_delete(request, course_id, lesson_id):
+    """Hides the lesson at once; its rows are purged by the worker once the undo window is over."""
     course = models.Course.objects.get(pk=course_id)
-    models.Lesson.objects.get(pk=lesson_id, course=course).delete()
+    if course.author_id != request.user.id:
+        return HttpResponse(status=403)
+    purging.delete_lesson(models.Lesson.objects.get(pk=lesson_id, course=course))
+    return JsonResponse({'result': 'ok', 'undo': F'/course/{course.id}/lesson/{lesson_id}/restore'})
+
+
+@budget(queries=6)
+@login_required
+@require_POST
+def lesson_restore(request, course_id, lesson_id):
+    if not models.Course.objects.filter(pk=course_id, author_id=request.user.id).exists():
+        return HttpResponse(status=403)
+    if not purging.restore_lesson(course_id, lesson_id):
+        return JsonResponse({'result': 'error', 'message': 'The lesson can no longer be restored'}, status=410)
     return JsonResponse({'result': 'ok'})